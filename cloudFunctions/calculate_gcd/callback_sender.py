@@ -0,0 +1,182 @@
+import heapq
+import itertools
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Posts callback results in the background over a pooled keep-alive session,
+# so that the request handlers only queue their results and go on calculating.
+# Results queued for the same callback URL within `linger` seconds of each other are merged into one POST
+# as {"results": [...]} (up to max_batch results), the format the callback route accepts for batches.
+# A dispatcher thread merges the results and hands the posts to pool_size sender threads, so a slow callback URL does not hold up the others.
+# Failed posts are retried with exponential backoff, without holding up the other posts.
+# The threads and session are started on the first send in each process, as the function is imported before gunicorn forks its worker.
+
+STOP = object()
+# queued by a sender thread when it is done with a post that is not retried
+DONE = object()
+
+
+@dataclass(order=True)
+class Post:
+    due: float
+    seq: int
+    callback_url: str = field(compare=False)
+    entries: List[Tuple[Dict[str, Any], Future]] = field(compare=False)
+    attempt: int = field(compare=False, default=0)
+
+
+class CallbackSender:
+
+    def __init__(self,
+                 max_batch: int = 20,
+                 max_retries: int = 3,
+                 linger: float = 0.05,
+                 timeout: float = 60,
+                 pool_size: int = 16,
+                 flush_timeout: float = 120):
+        self.max_batch = max_batch
+        self.max_retries = max_retries
+        self.linger = linger
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.flush_timeout = flush_timeout
+        self.start_lock = threading.Lock()
+        self.pid = None
+
+    def start(self):
+        with self.start_lock:
+            if self.pid == os.getpid():
+                return
+            self.session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+            self.queue: 'queue.Queue[Any]' = queue.Queue()
+            # posts waiting for their retry, by due time
+            self.retries: List[Post] = []
+            self.seq = itertools.count(1)
+            self.stopping = False
+            # posts handed to the sender threads and not done yet, counted by the dispatcher thread
+            self.in_flight = 0
+            self.executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix='callback-post')
+            self.thread = threading.Thread(target=self.run, name='callback-sender', daemon=True)
+            self.thread.start()
+            self.pid = os.getpid()
+
+    def send(self, callback_url: str, result: Dict[str, Any]) -> Future:
+        """Queues the result, the future resolves to True once it was accepted by the callback URL, False if it could not be delivered"""
+        if self.pid != os.getpid():
+            self.start()
+        future: Future = Future()
+        self.queue.put((callback_url, result, future))
+        return future
+
+    def flush(self, futures: List[Future], timeout: float = None) -> int:
+        """
+        Waits until the results of the futures are delivered or given up, at most timeout seconds (default: flush_timeout),
+        returns the number of results not delivered by then
+        """
+        deadline = time.monotonic() + (self.flush_timeout if timeout is None else timeout)
+        failed = 0
+        for future in futures:
+            try:
+                delivered = future.result(max(0, deadline - time.monotonic()))
+            except Exception:
+                delivered = False
+            failed += 0 if delivered else 1
+        return failed
+
+    def close(self):
+        if self.pid != os.getpid():
+            return
+        self.queue.put(STOP)
+        self.thread.join()
+        self.executor.shutdown()
+        self.session.close()
+        self.pid = None
+
+    def run(self):
+        while True:
+            timeout = max(0, self.retries[0].due - time.monotonic()) if self.retries else None
+            ready: Dict[str, List[Tuple[Dict[str, Any], Future]]] = {}
+            try:
+                item = self.queue.get(timeout=timeout)
+                linger_until = time.monotonic() + self.linger
+                while True:
+                    self.receive(item, ready)
+                    item = self.queue.get(timeout=max(0, linger_until - time.monotonic()))
+            except queue.Empty:
+                pass
+            for callback_url, entries in ready.items():
+                for i in range(0, len(entries), self.max_batch):
+                    self.dispatch(Post(0, 0, callback_url, entries[i:i + self.max_batch]))
+            now = time.monotonic()
+            while self.retries and self.retries[0].due <= now:
+                self.dispatch(heapq.heappop(self.retries))
+            if self.stopping and not self.retries and not self.in_flight:
+                return
+
+    def receive(self, item: Any, ready: Dict[str, List[Tuple[Dict[str, Any], Future]]]):
+        if item is STOP:
+            self.stopping = True
+        elif item is DONE:
+            self.in_flight -= 1
+        elif isinstance(item, Post):
+            # a failed post, due for its retry
+            self.in_flight -= 1
+            heapq.heappush(self.retries, item)
+        else:
+            callback_url, result, future = item
+            ready.setdefault(callback_url, []).append((result, future))
+
+    def dispatch(self, post: Post):
+        self.in_flight += 1
+        self.executor.submit(self.send_post, post)
+
+    def send_post(self, post: Post):
+        try:
+            retry = self.post(post)
+        except Exception as e:
+            # e.g. a result that is not JSON serializable, the futures must not be left unresolved
+            print(f"Callback to {post.callback_url} failed: {e}")
+            self.resolve(post, False)
+            retry = None
+        self.queue.put(retry or DONE)
+
+    def post(self, post: Post) -> Optional[Post]:
+        """Posts the results, returns the post to retry if it failed and can be retried"""
+        results = [result for result, _ in post.entries]
+        try:
+            response = self.session.post(post.callback_url, json={'results': results}, timeout=self.timeout)
+            if response.status_code == 200:
+                print(f"Successfully sent {len(results)} results to {post.callback_url}")
+                self.resolve(post, True)
+                return None
+            elif 400 <= response.status_code < 500:
+                print(f"Callback failed with client error {response.status_code}: {response.text}")
+                self.resolve(post, False)
+                return None
+            else:
+                print(f"Callback failed with status {response.status_code}: {response.text}")
+        except requests.exceptions.RequestException as e:
+            print(f"Callback attempt {post.attempt + 1} failed: {e}")
+
+        if post.attempt + 1 < self.max_retries:
+            print(f"Retrying callback in {2 ** post.attempt} seconds...")
+            return Post(time.monotonic() + 2 ** post.attempt, next(self.seq), post.callback_url, post.entries, post.attempt + 1)
+        print(f"Failed to send callback after {self.max_retries} attempts")
+        self.resolve(post, False)
+        return None
+
+    def resolve(self, post: Post, delivered: bool):
+        for _, future in post.entries:
+            if not future.done():
+                future.set_result(delivered)
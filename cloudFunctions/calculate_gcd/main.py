@@ -1,9 +1,20 @@
 # type: ignore
 import functions_framework
 import gmpy2
-import requests
+import base64
+import binascii
+import hashlib
 import json
-from typing import Dict, Any
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from multiprocessing import get_context
+from typing import Dict, Any, List
+from smooth_part import remove_smooth_part
+from pkcs1 import pkcs1_encode
+from callback_sender import CallbackSender
 
 
 mpz = gmpy2.mpz
@@ -12,69 +23,295 @@ pow_int = lambda base, exp: base**exp
 
 E = mpz(65537)  # The public exponent
 
-# https://stackoverflow.com/a/2212923/961254
-def gen_primes():
-	D: dict[int, list[int]] = {}
-	q = 2
-	while True:
-		if q not in D:
-			yield q
-			D[q * q] = [q]
-		else:
-			for p in D[q]:
-				D.setdefault(p + q, []).append(p)
-			del D[q]
-		q += 1
-
-def first_n_primes(n: int) -> list[int]:
-	x: set[int] = set()
-	y = 0
-	a = gen_primes()
-	while y < n:
-		x |= set([next(a)])
-		y += 1
-	return list(sorted(x))
-
-
-def remove_small_prime_factors(n: Any):
-	for p in first_n_primes(1500):
-		while n % p == 0:
-			n = n // p
-	return n
-
-
-def send_callback(callback_url: str, result_data: Dict[str, Any], max_retries: int = 3):
+# Payload versions. 1 (the default) has s1, s2, em1, em2 as decimal strings, em1 and em2 being the PKCS#1 encoded digests.
+# 2 has s1, s2 as base64 signatures and h1, h2 as base64 raw digests, with hashAlgorithm (sha256 or sha1) and modulusBytes,
+# and the padding is rebuilt here, which makes the payload several times smaller.
+REQUIRED_PARAMETERS = {
+    1: ['s1', 's2', 'em1', 'em2'],
+    2: ['s1', 's2', 'h1', 'h2', 'hashAlgorithm', 'modulusBytes'],
+}
+
+# Results are posted to the callback URL in chunks of up to this size, as {"results": [...]}
+CALLBACK_BATCH_SIZE = int(os.environ.get('CALLBACK_BATCH_SIZE', '20'))
+
+# Results of earlier calculations on this instance, keyed by a digest of the inputs,
+# so that a task redelivered by Cloud Tasks is answered without repeating the calculation
+RESULT_CACHE_SIZE = int(os.environ.get('RESULT_CACHE_SIZE', '1024'))
+result_cache: 'OrderedDict[str, Any]' = OrderedDict()
+result_cache_lock = threading.Lock()
+
+# Seconds a request may spend calculating before the calculation process is killed and a timed out result is sent,
+# below the function timeout (300 seconds in terraform/main.tf) so that the callback still goes out.
+# A request can set its own deadline with deadlineSeconds.
+SOLVE_DEADLINE_SECONDS = float(os.environ.get('SOLVE_DEADLINE_SECONDS', '270'))
+
+# Seconds after the calculation deadline of a request that its callbacks may take to be delivered,
+# within the 30 seconds between SOLVE_DEADLINE_SECONDS and the function timeout
+CALLBACK_FLUSH_SECONDS = float(os.environ.get('CALLBACK_FLUSH_SECONDS', '25'))
+
+# The calculation processes are forked by a forkserver, a single-threaded process with this module preloaded,
+# so they start without importing the function again, and without copying the locks held by the threads of the serving process
+# (request threads, the callback sender and the batch threads), which a plain fork could deadlock on.
+calculation_context = get_context('forkserver')
+calculation_context.set_forkserver_preload([__name__])
+
+callback_sender = CallbackSender(max_batch=CALLBACK_BATCH_SIZE,
+                                 max_retries=int(os.environ.get('CALLBACK_MAX_RETRIES', '3')),
+                                 linger=float(os.environ.get('CALLBACK_LINGER_SECONDS', '0.05')),
+                                 timeout=float(os.environ.get('CALLBACK_TIMEOUT_SECONDS', '60')),
+                                 pool_size=int(os.environ.get('CALLBACK_POOL_SIZE', '16')),
+                                 flush_timeout=CALLBACK_FLUSH_SECONDS)
+
+
+def callback_flush_timeout(deadline: float = None) -> float:
+    """Seconds to wait for the delivery of callbacks, until CALLBACK_FLUSH_SECONDS after the deadline of the request"""
+    if deadline is None:
+        return CALLBACK_FLUSH_SECONDS
+    return max(0, deadline - time.monotonic()) + CALLBACK_FLUSH_SECONDS
+
+
+def send_callback(callback_url: str, result_data: Dict[str, Any], deadline: float = None):
     """
-    Send the result back to the callback URL with retry logic.
+    Send the result back to the callback URL and wait until it is delivered, see callback_sender.py for the retries.
     """
-    for attempt in range(max_retries):
+    return callback_sender.flush([callback_sender.send(callback_url, result_data)], callback_flush_timeout(deadline)) == 0
+
+def available_cpus() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+# Calculation processes running at once, MAX_CALCULATIONS or one per CPU,
+# the other requests wait for a slot so that their processes do not exceed the memory of the instance
+calculation_slots = threading.BoundedSemaphore(int(os.environ.get('MAX_CALCULATIONS', '0')) or available_cpus())
+
+
+class InvalidPayload(ValueError):
+    pass
+
+
+class SolveTimeout(Exception):
+
+    def __init__(self, elapsed: float):
+        super().__init__(f"Calculation timed out after {elapsed:.1f} seconds")
+        self.elapsed = elapsed
+
+
+def request_deadline_seconds(payload: Dict[str, Any]) -> float:
+    """Seconds the calculations of the request may take, deadlineSeconds of the request or SOLVE_DEADLINE_SECONDS"""
+    try:
+        return float(payload.get('deadlineSeconds', SOLVE_DEADLINE_SECONDS))
+    except (ValueError, TypeError):
+        raise InvalidPayload(f"Invalid input: deadlineSeconds is not a number")
+
+
+def decode_base64(value: Any, name: str) -> bytes:
+    try:
+        return base64.b64decode(value, validate=True)
+    except (binascii.Error, TypeError, ValueError) as e:
+        raise InvalidPayload(f"Invalid input: {name} is not valid base64. Error: {e}")
+
+
+def parse_inputs(payload: Dict[str, Any]):
+    """
+    Returns s1, s2, em1, em2 as gmpy2.mpz integers from a payload of any supported version.
+    Raises InvalidPayload with the error message for the callback.
+    """
+    version = payload.get('version', 1)
+    if not isinstance(version, int) or version not in REQUIRED_PARAMETERS:
+        raise InvalidPayload(f"Unsupported payload version: {version}")
+    required = REQUIRED_PARAMETERS[version]
+    if not all(payload.get(name) for name in required):
+        raise InvalidPayload(f"Missing one or more required parameters: {', '.join(required)}")
+
+    if version == 1:
         try:
-            response = requests.post(
-                callback_url,
-                json=result_data,
-                headers={'Content-Type': 'application/json'},
-                timeout=300
-            )
-            
-            if response.status_code == 200:
-                print(f"Successfully sent callback to {callback_url}")
-                return True
-            elif 400 <= response.status_code < 500:
-                print(f"Callback failed with client error {response.status_code}: {response.text}")
-                return False
-            else:
-                print(f"Callback failed with status {response.status_code}: {response.text}")
-                
-        except requests.exceptions.RequestException as e:
-            print(f"Callback attempt {attempt + 1} failed: {e}")
-            
-        if attempt < max_retries - 1:
-            print(f"Retrying callback in {2 ** attempt} seconds...")
-            import time
-            time.sleep(2 ** attempt)
-    
-    print(f"Failed to send callback after {max_retries} attempts")
-    return False
+            # Convert string inputs to gmpy2.mpz integers
+            return mpz(payload['s1']), mpz(payload['s2']), mpz(payload['em1']), mpz(payload['em2'])
+        except (ValueError, TypeError) as e:
+            raise InvalidPayload(f"Invalid input: one or more parameters are not valid integers. Error: {e}")
+
+    hash_algorithm = str(payload['hashAlgorithm']).lower().removeprefix('rsa-')
+    try:
+        modulus_bytes = int(payload['modulusBytes'])
+    except (ValueError, TypeError):
+        raise InvalidPayload(f"Invalid input: modulusBytes is not an integer")
+    signatures = [decode_base64(payload[name], name) for name in ('s1', 's2')]
+    if any(len(signature) > modulus_bytes for signature in signatures):
+        raise InvalidPayload(f"Invalid input: signatures must not be longer than modulusBytes={modulus_bytes}")
+    try:
+        em1, em2 = [pkcs1_encode(modulus_bytes, decode_base64(payload[name], name), hash_algorithm) for name in ('h1', 'h2')]
+    except InvalidPayload:
+        raise
+    except ValueError as e:
+        raise InvalidPayload(f"Invalid input: {e}")
+    s1, s2 = [mpz(int.from_bytes(signature, 'big')) for signature in signatures]
+    return s1, s2, mpz(em1), mpz(em2)
+
+
+def inputs_digest(s1, s2, em1, em2) -> str:
+    # the order of the two signatures does not change the result
+    pairs = sorted([(s1, em1), (s2, em2)])
+    return hashlib.sha256(','.join(f'{s:x}:{em:x}' for s, em in pairs).encode()).hexdigest()
+
+
+def cached_result(digest: str):
+    with result_cache_lock:
+        n = result_cache.get(digest)
+        if n is not None:
+            result_cache.move_to_end(digest)
+        return n
+
+
+def store_result(digest: str, n):
+    with result_cache_lock:
+        result_cache[digest] = n
+        result_cache.move_to_end(digest)
+        while len(result_cache) > RESULT_CACHE_SIZE:
+            result_cache.popitem(last=False)
+
+
+def calculate(s1, s2, em1, em2):
+    term1 = pow_int(s1, E) - em1
+    term2 = pow_int(s2, E) - em2
+    n = gcd(term1, term2)
+    # Clean up intermediate variables
+    del term1, term2
+    # Remove small prime factors for cleanup
+    return remove_smooth_part(n)
+
+
+def calculate_in_child(conn, s1, s2, em1, em2):
+    try:
+        conn.send((True, calculate(s1, s2, em1, em2)))
+    except Exception as e:
+        conn.send((False, str(e)))
+    finally:
+        conn.close()
+
+
+def compute_gcd(s1, s2, em1, em2, deadline: float):
+    """
+    n = gcd(s1^E - em1, s2^E - em2) without its small prime factors,
+    taken from the result cache if the same inputs were calculated before on this instance.
+    The calculation runs in a child process, which is killed if it is not done by the deadline (a time.monotonic() time),
+    raising SolveTimeout. The time waiting for a free calculation slot counts towards the deadline.
+    """
+    digest = inputs_digest(s1, s2, em1, em2)
+    n = cached_result(digest)
+    if n is not None:
+        print(f"Using cached result for inputs {digest}")
+        return n
+    start = time.monotonic()
+    if deadline <= start or not calculation_slots.acquire(timeout=deadline - start):
+        raise SolveTimeout(time.monotonic() - start)
+    try:
+        parent_conn, child_conn = calculation_context.Pipe(duplex=False)
+        process = calculation_context.Process(target=calculate_in_child, args=(child_conn, s1, s2, em1, em2), daemon=True)
+        process.start()
+        child_conn.close()
+        try:
+            # also returns when the process died without a result
+            if not parent_conn.poll(max(0, deadline - time.monotonic())):
+                raise SolveTimeout(time.monotonic() - start)
+            try:
+                success, value = parent_conn.recv()
+            except EOFError:
+                process.join()
+                raise RuntimeError(f"calculation process exited with code {process.exitcode}")
+        finally:
+            if process.is_alive():
+                process.kill()
+            process.join()
+            parent_conn.close()
+    finally:
+        calculation_slots.release()
+    if not success:
+        raise RuntimeError(value)
+    store_result(digest, value)
+    return value
+
+
+def timed_out_result(task_id, metadata, deadline_seconds: float, e: SolveTimeout) -> Dict[str, Any]:
+    """The callback result for a calculation killed at the deadline, so the caller can retry it on a larger instance"""
+    return {
+        'success': False,
+        'timedOut': True,
+        'error': str(e),
+        'elapsedSeconds': round(e.elapsed, 3),
+        'deadlineSeconds': deadline_seconds,
+        'taskId': task_id,
+        'metadata': metadata
+    }
+
+
+def solve_job(job: Dict[str, Any], deadline: float, deadline_seconds: float) -> Dict[str, Any]:
+    """
+    Calculate the GCD for one job of a batch request, a payload of any version with taskId and metadata.
+    Returns the callback result for the job, errors are reported in the result instead of raised,
+    so that one bad job does not fail the batch.
+    """
+    task_id = job.get('taskId')
+    metadata = job.get('metadata', {})
+    try:
+        s1, s2, em1, em2 = parse_inputs(job)
+    except InvalidPayload as e:
+        return {
+            'success': False,
+            'error': str(e),
+            'taskId': task_id,
+            'metadata': metadata
+        }
+    try:
+        print(f"Starting calculation for task {task_id}")
+        n = compute_gcd(s1, s2, em1, em2, deadline)
+        print(f"Calculation completed for task {task_id}")
+        return {
+            'success': True,
+            'result': str(n),
+            'taskId': task_id,
+            'metadata': metadata,
+        }
+    except SolveTimeout as e:
+        print(f"Calculation for task {task_id} timed out: {e}")
+        return timed_out_result(task_id, metadata, deadline_seconds, e)
+    except Exception as e:
+        print(f"Calculation error for task {task_id}: {e}")
+        return {
+            'success': False,
+            'error': f"Calculation failed: {str(e)}",
+            'taskId': task_id,
+            'metadata': metadata
+        }
+
+
+def calculate_gcd_batch(jobs: List[Dict[str, Any]], callback_url: str, deadline: float, deadline_seconds: float):
+    """
+    Solve the jobs of a batch request, in parallel when the instance has more than one CPU,
+    and post the results to the callback URL in chunks of CALLBACK_BATCH_SIZE as they complete.
+    Jobs not done by the deadline of the request get timed out results.
+    """
+    deliveries: List[Future] = []
+    succeeded = 0
+    workers = max(1, min(len(jobs), available_cpus()))
+    print(f"Solving {len(jobs)} jobs with {workers} processes")
+    # each job calculates in its own child process, the threads only wait for them
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(solve_job, job, deadline, deadline_seconds) for job in jobs]
+        for future in as_completed(futures):
+            result = future.result()
+            succeeded += 1 if result['success'] else 0
+            # sent in the background while the other jobs calculate
+            deliveries.append(callback_sender.send(callback_url, result))
+    failed_callbacks = callback_sender.flush(deliveries, callback_flush_timeout(deadline))
+
+    message = f"Batch of {len(jobs)} jobs completed, {succeeded} succeeded, {len(jobs) - succeeded} failed."
+    if failed_callbacks:
+        return (f"{message} Failed to send {failed_callbacks} results to the callback URL.", 500)
+    return (message, 200)
+
 
 @functions_framework.http
 def calculate_gcd(request):
@@ -84,7 +321,10 @@ def calculate_gcd(request):
     
     Args:
         request (flask.Request): The request object.
-        Expects JSON body with s1, s2, em1, em2, callbackUrl, taskId, and optional metadata.
+        Expects JSON body with s1, s2, em1, em2, callbackUrl, taskId, and optional metadata
+        (or the compact version 2 fields, see REQUIRED_PARAMETERS),
+        or a batch with callbackUrl and jobs, a list of such payloads without callbackUrl.
+        deadlineSeconds optionally overrides SOLVE_DEADLINE_SECONDS for the request.
     
     Returns:
         A success message (result is sent via callback).
@@ -94,20 +334,31 @@ def calculate_gcd(request):
     if not request_json:
         return ("Missing JSON payload.", 400)
 
-    # Extract parameters
-    s1_str = request_json.get('s1')
-    s2_str = request_json.get('s2')
-    em1_str = request_json.get('em1')
-    em2_str = request_json.get('em2')
+    if 'jobs' in request_json:
+        jobs = request_json.get('jobs')
+        if not isinstance(jobs, list) or not jobs or not all(isinstance(job, dict) for job in jobs):
+            return ("jobs must be a non-empty list of objects.", 400)
+        # a job with an unsupported version or missing parameters gets its error in its own result, see solve_job
+        if not request_json.get('callbackUrl'):
+            return ("Missing callbackUrl parameter.", 400)
+        try:
+            deadline_seconds = request_deadline_seconds(request_json)
+        except InvalidPayload as e:
+            return (str(e), 400)
+        return calculate_gcd_batch(jobs, request_json['callbackUrl'], time.monotonic() + deadline_seconds, deadline_seconds)
+
     callback_url = request_json.get('callbackUrl')
     task_id = request_json.get('taskId')
     metadata = request_json.get('metadata', {})
 
-    # Validate required parameters
-    if not all([s1_str, s2_str, em1_str, em2_str]):
+    try:
+        deadline_seconds = request_deadline_seconds(request_json)
+        deadline = time.monotonic() + deadline_seconds
+        s1, s2, em1, em2 = parse_inputs(request_json)
+    except InvalidPayload as e:
         error_data = {
             'success': False,
-            'error': 'Missing one or more required parameters: s1, s2, em1, em2',
+            'error': str(e),
             'taskId': task_id,
             'metadata': metadata
         }
@@ -118,36 +369,12 @@ def calculate_gcd(request):
     if not callback_url:
         return ("Missing callbackUrl parameter.", 400)
 
-    try:
-        # Convert string inputs to gmpy2.mpz integers
-        s1 = mpz(s1_str)
-        s2 = mpz(s2_str)
-        em1 = mpz(em1_str)
-        em2 = mpz(em2_str)
-        
-    except ValueError as e:
-        error_data = {
-            'success': False,
-            'error': f"Invalid input: one or more parameters are not valid integers. Error: {e}",
-            'taskId': task_id,
-            'metadata': metadata
-        }
-        send_callback(callback_url, error_data)
-        return (error_data['error'], 400)
-
     try:
         # Perform the calculation
         print(f"Starting calculation for task {task_id}")
         
-        term1 = pow_int(s1, E) - em1
-        term2 = pow_int(s2, E) - em2
-        n: Any = gcd(term1, term2)
-
-        # Remove small prime factors for cleanup
-        n = remove_small_prime_factors(n)
+        n = compute_gcd(s1, s2, em1, em2, deadline)
         print("Calculated GCD :", n);
-        # Clean up intermediate variables
-        del term1, term2
 
         print(f"Calculation completed for task {task_id}")
 
@@ -160,13 +387,20 @@ def calculate_gcd(request):
         }
 
         # Send result to callback URL
-        callback_success = send_callback(callback_url, result_data)
+        callback_success = send_callback(callback_url, result_data, deadline)
         
         if callback_success:
             return ("Calculation completed and result sent to callback URL.", 200)
         else:
             return ("Calculation completed but failed to send callback.", 500)
-            
+
+    except SolveTimeout as e:
+        print(f"Calculation for task {task_id} timed out: {e}")
+        # not an error status, so that Cloud Tasks does not retry the same long calculation on the same instance size
+        if send_callback(callback_url, timed_out_result(task_id, metadata, deadline_seconds, e), deadline):
+            return (f"{e}, result sent to callback URL.", 200)
+        return (f"{e}, failed to send callback.", 500)
+
     except Exception as e:
         print(f"Calculation error for task {task_id}: {e}")
         
@@ -177,5 +411,5 @@ def calculate_gcd(request):
             'metadata': metadata
         }
         
-        send_callback(callback_url, error_data)
+        send_callback(callback_url, error_data, deadline)
         return (f"Calculation failed: {str(e)}", 500)
\ No newline at end of file
@@ -0,0 +1,50 @@
+# PKCS#1 v1.5 encoding of message digests, as signed by rsa-sha1 and rsa-sha256 DKIM signatures.
+# Shared by gcd_solver.py and cloudFunctions/calculate_gcd (copied there, since the cloud function is deployed from its own directory; cloudFunctions/tests checks that the copies match).
+
+# DER encoded algorithm OIDs for the DigestInfo in PKCS#1 v1.5 signatures, and the digest sizes in bytes
+HASH_OIDS = {'sha1': '2b0e03021a', 'sha256': '608648016503040201', 'sha512': '608648016503040203'}
+HASH_SIZES = {'sha1': 20, 'sha256': 32, 'sha512': 64}
+
+
+def pkcs1_padding(size_bytes: int, hash_hex: str, hashfn: str):
+	oid = HASH_OIDS[hashfn]
+	result = '06' + ("%02X" % (len(oid) // 2)) + oid + '05' + '00'
+	result = '30' + ("%02X" % (len(result) // 2)) + result
+
+	result = result + '04' + ("%02X" % (len(hash_hex) // 2)) + hash_hex
+	result = '30' + ("%02X" % (len(result) // 2)) + result
+
+	result = '0001' + ('ff' * int(size_bytes - 3 - len(result) / 2)) + '00' + result
+	return result
+
+
+def padding_fits(size_bytes: int, hashfn: str) -> bool:
+	# DigestInfo is 19 bytes (15 for sha1) plus the digest, and PKCS#1 v1.5 needs at least 11 bytes of padding around it
+	digest_info_bytes = 4 + 2 + len(HASH_OIDS[hashfn]) // 2 + 2 + 2 + HASH_SIZES[hashfn]
+	return size_bytes >= digest_info_bytes + 11
+
+
+def digest_info_prefix(hashfn: str) -> bytes:
+	# DER encoded DigestInfo (the same bytes as in pkcs1_padding), up to the digest itself
+	oid = bytes.fromhex(HASH_OIDS[hashfn])
+	algorithm = b'\x06' + bytes([len(oid)]) + oid + b'\x05\x00'
+	algorithm = b'\x30' + bytes([len(algorithm)]) + algorithm
+	digest_header = b'\x04' + bytes([HASH_SIZES[hashfn]])
+	return b'\x30' + bytes([len(algorithm) + len(digest_header) + HASH_SIZES[hashfn]]) + algorithm + digest_header
+
+
+# precomputed once at import, so encoding a digest is a concatenation
+DIGEST_INFO_PREFIXES = {hashfn: digest_info_prefix(hashfn) for hashfn in HASH_OIDS}
+
+
+def pkcs1_encode(size_bytes: int, digest: bytes, hashfn: str) -> int:
+	"""The padded message for a raw digest as an integer, the value that the signature raised to e must equal.
+	Raises ValueError for an unknown hash function, a digest of the wrong size or a modulus too small for the padding."""
+	if hashfn not in HASH_OIDS:
+		raise ValueError(f'unsupported hash algorithm: {hashfn}')
+	if len(digest) != HASH_SIZES[hashfn]:
+		raise ValueError(f'{hashfn} digest must be {HASH_SIZES[hashfn]} bytes, got {len(digest)}')
+	if not padding_fits(size_bytes, hashfn):
+		raise ValueError(f'{hashfn} digest does not fit in a {size_bytes} byte modulus')
+	prefix = DIGEST_INFO_PREFIXES[hashfn]
+	return int.from_bytes(b'\x00\x01' + b'\xff' * (size_bytes - 3 - len(prefix) - len(digest)) + b'\x00' + prefix + digest, 'big')
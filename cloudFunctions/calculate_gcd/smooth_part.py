@@ -0,0 +1,81 @@
+import logging
+import math
+from functools import lru_cache
+from typing import Any
+import gmpy2  # type: ignore
+
+# Removes the smooth part (the factors below a small prime bound) from gcd results.
+# Shared by gcd_solver.py and cloudFunctions/calculate_gcd (copied there, since the cloud function is deployed from its own directory; cloudFunctions/tests checks that the copies match).
+
+gmpy2_mpz: Any = gmpy2.mpz  # type: ignore
+gmpy2_gcd: Any = gmpy2.gcd  # type: ignore
+
+DEFAULT_NUM_PRIMES = 1500
+
+
+def first_primes(num_primes: int) -> list[int]:
+	# the n-th prime is below n * (ln n + ln ln n) for n >= 6
+	limit = 15 if num_primes < 6 else int(num_primes * (math.log(num_primes) + math.log(math.log(num_primes)))) + 1
+	sieve = bytearray([1]) * (limit + 1)
+	sieve[0:2] = b'\x00\x00'
+	for i in range(2, math.isqrt(limit) + 1):
+		if sieve[i]:
+			sieve[i * i::i] = bytearray(len(sieve[i * i::i]))
+	return [i for i, is_prime in enumerate(sieve) if is_prime][:num_primes]
+
+
+def product_tree(values: list[Any]) -> list[list[Any]]:
+	"""Returns the levels of a product tree, from the leaves (values) up to the root (product of all values)"""
+	tree = [[gmpy2_mpz(v) for v in values]]
+	while len(tree[-1]) > 1:
+		level = tree[-1]
+		tree.append([level[i] * level[i + 1] if i + 1 < len(level) else level[i] for i in range(0, len(level), 2)])
+	return tree
+
+
+def remainder_tree(value: Any, tree: list[list[Any]]) -> list[Any]:
+	"""Returns value mod each leaf of the product tree, reducing the (large) value level by level instead of once per leaf"""
+	remainders = [value % tree[-1][0]]
+	for level in reversed(tree[:-1]):
+		remainders = [remainders[i // 2] % node for i, node in enumerate(level)]
+	return remainders
+
+
+@lru_cache(maxsize=None)
+def primorial(num_primes: int = DEFAULT_NUM_PRIMES) -> Any:
+	return product_tree(first_primes(num_primes))[-1][0]
+
+
+# precomputed once at import, so solves don't pay for the prime table
+primorial(DEFAULT_NUM_PRIMES)
+
+
+def strip_smooth_factors(n: Any, g: Any) -> Any:
+	# g = gcd(n, primorial) is the product of the distinct small primes dividing n,
+	# divide by it until no small prime is left, each round removes one power of every remaining prime
+	while g > 1:
+		logging.debug(f'removing small prime factors {g}')
+		n = n // g
+		g = gmpy2_gcd(n, g)
+	return n
+
+
+def remove_smooth_part(n: Any, num_primes: int = DEFAULT_NUM_PRIMES) -> Any:
+	"""Divides n by all of its prime factors among the first num_primes primes"""
+	if n == 0:
+		return n
+	return strip_smooth_factors(n, gmpy2_gcd(n, primorial(num_primes)))
+
+
+def remove_smooth_parts(ns: list[Any], num_primes: int = DEFAULT_NUM_PRIMES) -> list[Any]:
+	"""Like remove_smooth_part for a batch of candidates. The primorial is reduced modulo every candidate with one remainder tree,
+	so the per-candidate gcds work on numbers of the candidate's size"""
+	indices = [i for i, n in enumerate(ns) if n != 0]
+	results = list(ns)
+	if not indices:
+		return results
+	tree = product_tree([ns[i] for i in indices])
+	remainders = remainder_tree(primorial(num_primes), tree)
+	for i, r in zip(indices, remainders):
+		results[i] = strip_smooth_factors(gmpy2_mpz(ns[i]), gmpy2_gcd(ns[i], r))
+	return results
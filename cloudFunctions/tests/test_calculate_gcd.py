@@ -0,0 +1,41 @@
+"""
+Tests of the calculate_gcd cloud function, run in this process through the functions_framework test client.
+
+Usage: python -m pytest cloudFunctions/tests
+"""
+import os
+import sys
+
+TOOLS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tools')
+sys.path.insert(0, TOOLS_DIR)
+
+from benchmark_startup import FUNCTION_DIR, start_callback_sink, synthetic_request
+
+sys.path.insert(0, FUNCTION_DIR)
+from functions_framework import create_app
+
+client = create_app('calculate_gcd', os.path.join(FUNCTION_DIR, 'main.py')).test_client()
+
+
+def test_batch_reports_missing_parameters_per_job():
+    callback_url, received, arrived = start_callback_sink()
+    n, good_job = synthetic_request(256, task_id='good')
+    _, bad_job = synthetic_request(256, task_id='bad')
+    del bad_job['em2']
+
+    response = client.post('/', json={'jobs': [good_job, bad_job], 'callbackUrl': callback_url})
+
+    assert response.status_code == 200
+    # the results are posted as {"results": [...]}, see callback_sender.py
+    results = {result['taskId']: result for body in received for result in body['results']}
+    assert results['good']['success'] and int(results['good']['result']) == n
+    assert not results['bad']['success']
+    assert 'Missing one or more required parameters' in results['bad']['error']
+
+
+def test_batch_without_jobs_is_rejected():
+    callback_url, received, arrived = start_callback_sink()
+    for jobs in [[], 'jobs', [1]]:
+        response = client.post('/', json={'jobs': jobs, 'callbackUrl': callback_url})
+        assert response.status_code == 400
+    assert not received
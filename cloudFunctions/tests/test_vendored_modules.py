@@ -0,0 +1,24 @@
+"""
+The cloud function is deployed from cloudFunctions/calculate_gcd alone (the archive_file of terraform/main.tf),
+so the modules it shares with src/util/pubkey_finder are copied there, and must stay the same as the originals.
+
+Usage: python -m pytest cloudFunctions/tests
+"""
+import os
+
+import pytest
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+FUNCTION_DIR = os.path.join(REPO_DIR, 'cloudFunctions', 'calculate_gcd')
+PUBKEY_FINDER_DIR = os.path.join(REPO_DIR, 'src', 'util', 'pubkey_finder')
+
+VENDORED_MODULES = ['pkcs1.py', 'smooth_part.py']
+
+
+@pytest.mark.parametrize('name', VENDORED_MODULES)
+def test_vendored_module_matches_original(name):
+    copy = os.path.join(FUNCTION_DIR, name)
+    # a symlink is not followed by every packaging step, the function directory needs a real file
+    assert not os.path.islink(copy)
+    with open(copy, 'rb') as f, open(os.path.join(PUBKEY_FINDER_DIR, name), 'rb') as original:
+        assert f.read() == original.read(), f'cloudFunctions/calculate_gcd/{name} differs from src/util/pubkey_finder/{name}, copy it again'
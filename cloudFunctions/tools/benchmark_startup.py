@@ -0,0 +1,126 @@
+"""
+Startup benchmark for the calculate_gcd cloud function.
+
+Each run starts a fresh Python process, like a cold Cloud Run instance, and measures
+- the time to import main.py (module-level tables included),
+- the time to the first result of a request, until its callback is received,
+- the time to answer the same request again, which is served from the result cache.
+
+Usage: python cloudFunctions/tools/benchmark_startup.py [--bits 2048] [--runs 3]
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FUNCTION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'calculate_gcd')
+
+
+def synthetic_key(bits: int):
+    """A random RSA key with e = 65537, as (n, d)"""
+    import gmpy2
+    e = 65537
+    while True:
+        p = gmpy2.next_prime(gmpy2.mpz(random.getrandbits(bits // 2)) | (1 << (bits // 2 - 1)))
+        q = gmpy2.next_prime(gmpy2.mpz(random.getrandbits(bits // 2)) | (1 << (bits // 2 - 1)))
+        phi = (p - 1) * (q - 1)
+        if p != q and gmpy2.gcd(e, phi) == 1:
+            return p * q, gmpy2.invert(e, phi)
+
+
+def synthetic_request(bits: int, key=None, task_id: str = 'benchmark'):
+    """Two raw RSA signatures made with the key (a new random key by default), in the version 1 payload format"""
+    import gmpy2
+    n, d = key or synthetic_key(bits)
+    em1 = gmpy2.mpz(random.getrandbits(bits - 8))
+    em2 = gmpy2.mpz(random.getrandbits(bits - 8))
+    payload = {
+        's1': str(gmpy2.powmod(em1, d, n)),
+        's2': str(gmpy2.powmod(em2, d, n)),
+        'em1': str(em1),
+        'em2': str(em2),
+        'taskId': task_id,
+    }
+    return int(n), payload
+
+
+def start_callback_sink():
+    received = []
+    arrived = threading.Event()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            received.append(json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+            self.send_response(200)
+            self.end_headers()
+            arrived.set()
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}/callback', received, arrived
+
+
+def measure(bits: int):
+    """Runs in the fresh process, prints the timings as JSON"""
+    n, payload = synthetic_request(bits)
+    callback_url, received, arrived = start_callback_sink()
+    payload['callbackUrl'] = callback_url
+
+    sys.path.insert(0, FUNCTION_DIR)
+    start = time.perf_counter()
+    import main
+    import_seconds = time.perf_counter() - start
+
+    from functions_framework import create_app
+    client = create_app('calculate_gcd', os.path.join(FUNCTION_DIR, 'main.py')).test_client()
+
+    timings = {'import_seconds': import_seconds}
+    for name in ['first_result_seconds', 'cached_result_seconds']:
+        arrived.clear()
+        start = time.perf_counter()
+        response = client.post('/', json=payload)
+        arrived.wait(60)
+        timings[name] = time.perf_counter() - start
+        # the results are posted as {"results": [...]}, see callback_sender.py
+        if response.status_code != 200 or not received or int(received[-1]['results'][0].get('result', 0)) != n:
+            raise RuntimeError(f'unexpected response {response.status_code}: {received[-1:]}')
+    print(json.dumps(timings))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='measure the import time and time to first result of the calculate_gcd cloud function')
+    parser.add_argument('--bits', type=int, default=2048, help='RSA key size of the synthetic request (default: 2048)')
+    parser.add_argument('--runs', type=int, default=3, help='number of fresh processes to measure (default: 3)')
+    parser.add_argument('--measure', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(args.bits)
+        return
+
+    runs = []
+    for run in range(args.runs):
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--measure', '--bits', str(args.bits)],
+                                check=True, capture_output=True, text=True).stdout
+        # the function prints its progress, the timings are on the last line
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+        print(f"run {run + 1}: {runs[-1]}", file=sys.stderr)
+
+    summary = {'bits': args.bits, 'runs': len(runs)}
+    for name in runs[0]:
+        values = [r[name] for r in runs]
+        summary[name] = {'median': statistics.median(values), 'min': min(values), 'max': max(values)}
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,285 @@
+"""
+Offline load test for the calculate_gcd cloud function.
+
+Replays synthetic RSA signature pair jobs at a fixed rate and concurrency against the function,
+either in this process (through the functions_framework test client) or served by functions-framework on localhost,
+with a local callback receiver, and reports per instance size:
+- throughput (jobs with a received result per second),
+- request latency and callback latency (from sending the request to receiving the job's result) percentiles,
+- peak memory (RSS of the function process and its calculation processes).
+
+On localhost, each --tiers entry CPUS:MEMORY_MB emulates an instance size: the server is pinned to CPUS CPUs
+(calculate_gcd sizes its batch parallelism by the CPU affinity), serves up to --concurrency requests at once
+like the Cloud Run concurrency setting, and its peak memory is compared to MEMORY_MB
+(enforced as an address space limit with --enforce-memory).
+
+Usage:
+    python cloudFunctions/tools/load_test.py --in-process --jobs 20 --rate 2 --concurrency 4 --bits 1024
+    python cloudFunctions/tools/load_test.py --tiers 1:1024 2:2048 --jobs 40 --rate 4 --concurrency 80 --batch-size 4
+"""
+import argparse
+import json
+import os
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+import requests
+
+from benchmark_startup import FUNCTION_DIR, synthetic_key, synthetic_request
+
+
+class CallbackReceiver:
+    """Local callback URL, records the arrival time of each result by taskId"""
+
+    def __init__(self):
+        self.arrivals: Dict[str, float] = {}
+        self.results: Dict[str, Dict[str, Any]] = {}
+        self.lock = threading.Lock()
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                now = time.monotonic()
+                with receiver.lock:
+                    for result in body.get('results', [body]):
+                        receiver.arrivals.setdefault(result.get('taskId'), now)
+                        receiver.results.setdefault(result.get('taskId'), result)
+                self.send_response(200)
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'{}')
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}/callback'
+
+    def close(self):
+        self.server.shutdown()
+
+
+def process_tree_rss(pid: int) -> int:
+    """RSS in bytes of the process and all its descendants, from /proc"""
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f'/proc/{current}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+            for task in os.listdir(f'/proc/{current}/task'):
+                with open(f'/proc/{current}/task/{task}/children') as f:
+                    pending.extend(int(child) for child in f.read().split())
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+    return total
+
+
+class MemorySampler:
+
+    def __init__(self, pid: int, interval: float = 0.05):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, process_tree_rss(self.pid))
+            self.stopped.wait(self.interval)
+
+    def stop(self) -> int:
+        self.stopped.set()
+        self.thread.join()
+        return self.peak
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(cpus: int, memory_mb: Optional[int], concurrency: int, enforce_memory: bool):
+    port = free_port()
+    available = sorted(os.sched_getaffinity(0))
+    if cpus > len(available):
+        print(f"only {len(available)} CPUs available, emulating {cpus} CPUs with {len(available)}", file=sys.stderr)
+
+    def limit():
+        os.sched_setaffinity(0, available[:cpus])
+        if enforce_memory and memory_mb:
+            resource.setrlimit(resource.RLIMIT_AS, (memory_mb * 1024 * 1024, memory_mb * 1024 * 1024))
+
+    env = dict(os.environ, THREADS=str(concurrency), PYTHONUNBUFFERED='1')
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'functions_framework', '--target', 'calculate_gcd', '--source', 'main.py', '--host', '127.0.0.1', '--port', str(port)],
+        cwd=FUNCTION_DIR,
+        env=env,
+        preexec_fn=limit,
+        stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'functions-framework exited with code {process.returncode}')
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process, f'http://127.0.0.1:{port}/'
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('functions-framework did not start listening within 30 seconds')
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    if not values:
+        return {'p50': None, 'p90': None, 'p99': None, 'max': None}
+    values = sorted(values)
+
+    def rank(p):
+        return round(values[min(len(values) - 1, max(0, int(len(values) * p / 100 + 0.5) - 1))], 4)
+
+    return {'p50': rank(50), 'p90': rank(90), 'p99': rank(99), 'max': round(values[-1], 4)}
+
+
+def make_requests(args, callback_url: str) -> List[Dict[str, Any]]:
+    """The request payloads, jobs with fresh digests so that the result cache of the function does not answer them"""
+    keys = [synthetic_key(args.bits) for _ in range(args.keys)]
+    jobs = [synthetic_request(args.bits, keys[i % len(keys)], f'job-{i}')[1] for i in range(args.jobs)]
+    if args.batch_size <= 1:
+        return [dict(job, callbackUrl=callback_url, deadlineSeconds=args.deadline) for job in jobs]
+    return [{
+        'jobs': jobs[i:i + args.batch_size],
+        'callbackUrl': callback_url,
+        'deadlineSeconds': args.deadline
+    } for i in range(0, len(jobs), args.batch_size)]
+
+
+def run_load(args, post, pid: int, tier: str, memory_mb: Optional[int]) -> Dict[str, Any]:
+    receiver = CallbackReceiver()
+    payloads = make_requests(args, receiver.url)
+    sent: Dict[str, float] = {}
+    request_latencies: List[float] = []
+    errors = 0
+    lock = threading.Lock()
+
+    def send(payload):
+        nonlocal errors
+        start = time.monotonic()
+        with lock:
+            for job in payload.get('jobs', [payload]):
+                sent[job['taskId']] = start
+        try:
+            status = post(payload)
+        except Exception as e:
+            print(f"request failed: {e}", file=sys.stderr)
+            status = None
+        with lock:
+            request_latencies.append(time.monotonic() - start)
+            errors += 0 if status == 200 else 1
+
+    sampler = MemorySampler(pid)
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for i, payload in enumerate(payloads):
+            # open loop at the requested rate, late requests are sent at once
+            delay = start + i / args.rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(send, payload)
+    wait_until = time.monotonic() + args.callback_timeout
+    while len(receiver.arrivals) < args.jobs and time.monotonic() < wait_until:
+        time.sleep(0.05)
+    peak_rss = sampler.stop()
+    receiver.close()
+
+    callback_latencies = [arrival - sent[task_id] for task_id, arrival in receiver.arrivals.items() if task_id in sent]
+    succeeded = sum(1 for result in receiver.results.values() if result.get('success'))
+    duration = (max(receiver.arrivals.values()) if receiver.arrivals else time.monotonic()) - start
+    return {
+        'tier': tier,
+        'jobs': args.jobs,
+        'requests': len(payloads),
+        'failed_requests': errors,
+        'results_received': len(receiver.arrivals),
+        'results_succeeded': succeeded,
+        'results_timed_out': sum(1 for result in receiver.results.values() if result.get('timedOut')),
+        'duration_seconds': round(duration, 3),
+        'throughput_jobs_per_second': round(len(receiver.arrivals) / duration, 3) if duration > 0 else None,
+        'request_latency_seconds': percentiles(request_latencies),
+        'callback_latency_seconds': percentiles(callback_latencies),
+        'peak_rss_mb': round(peak_rss / 1024 / 1024, 1),
+        'memory_exceeded': memory_mb is not None and peak_rss > memory_mb * 1024 * 1024,
+    }
+
+
+def run_in_process(args) -> Dict[str, Any]:
+    sys.path.insert(0, FUNCTION_DIR)
+    from functions_framework import create_app
+    app = create_app('calculate_gcd', os.path.join(FUNCTION_DIR, 'main.py'))
+
+    def post(payload):
+        return app.test_client().post('/', json=payload).status_code
+
+    return run_load(args, post, os.getpid(), 'in-process', None)
+
+
+def run_tier(args, tier: str) -> Dict[str, Any]:
+    cpus, _, memory = tier.partition(':')
+    memory_mb = int(memory) if memory else None
+    process, url = start_server(int(cpus), memory_mb, args.concurrency, args.enforce_memory)
+    session = requests.Session()
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency))
+
+    def post(payload):
+        return session.post(url, json=payload, timeout=args.deadline + 60).status_code
+
+    try:
+        return run_load(args, post, process.pid, tier, memory_mb)
+    finally:
+        # quick shutdown of gunicorn
+        process.send_signal(signal.SIGINT)
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='replay synthetic jobs against the calculate_gcd cloud function and report throughput, latency and memory')
+    parser.add_argument('--in-process', action='store_true', help='call the handler in this process instead of serving it with functions-framework on localhost')
+    parser.add_argument('--tiers', nargs='+', default=['1:1024'], help='instance sizes to emulate on localhost as CPUS:MEMORY_MB (default: 1:1024, the deployed size)')
+    parser.add_argument('--enforce-memory', action='store_true', help='limit the address space of the server to the memory of the tier')
+    parser.add_argument('--jobs', type=int, default=20, help='number of jobs (default: 20)')
+    parser.add_argument('--batch-size', type=int, default=1, help='jobs per request, 1 sends single requests (default: 1)')
+    parser.add_argument('--rate', type=float, default=1, help='requests per second (default: 1)')
+    parser.add_argument('--concurrency', type=int, default=80, help='maximum requests in flight (default: 80, like the deployed function)')
+    parser.add_argument('--bits', type=int, default=2048, help='RSA key size of the jobs (default: 2048)')
+    parser.add_argument('--keys', type=int, default=4, help='number of distinct keys the jobs are signed with (default: 4)')
+    parser.add_argument('--deadline', type=float, default=270, help='deadlineSeconds of the requests (default: 270)')
+    parser.add_argument('--callback-timeout', type=float, default=30, help='seconds to wait for missing results after the last request (default: 30)')
+    args = parser.parse_args()
+
+    if args.in_process:
+        reports = [run_in_process(args)]
+    else:
+        reports = [run_tier(args, tier) for tier in args.tiers]
+    print(json.dumps(reports, indent=2))
+
+
+if __name__ == '__main__':
+    main()
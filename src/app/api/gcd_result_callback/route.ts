@@ -48,64 +48,84 @@ function verifyRsaPublicKey(
   }
 }
 
-export async function POST(request: Request) {
-  try {
-    const body = await request.json();
+type CallbackResult = {
+  success: boolean;
+  result?: string;
+  error?: string;
+  // set when the calculation was killed at its deadline, a candidate for a larger instance
+  timedOut?: boolean;
+  elapsedSeconds?: number;
+  taskId?: string;
+  metadata?: any;
+};
 
-    const { success, result, error, taskId, metadata } = body;
+// Processes the result of one task, returns the HTTP status and body for it
+async function processResult(body: CallbackResult): Promise<{ status: number, body: Record<string, any> }> {
+  const { success, result, error, taskId, metadata } = body;
 
-    if (!taskId) {
-      console.error('Missing taskId in callback');
-      return Response.json(
-        { error: 'Missing taskId' },
-        { status: 400 }
-      );
-    }
+  if (!taskId) {
+    console.error('Missing taskId in callback');
+    return { status: 400, body: { error: 'Missing taskId' } };
+  }
 
-    if (success) {
-      console.log(chalk.magenta(`Task ${taskId} completed successfully.`));
+  if (success) {
+    console.log(chalk.magenta(`Task ${taskId} completed successfully.`));
 
-      let publicKeyBigInt = BigInt(result);
-      const publicKeyHex = publicKeyBigInt.toString(16);
-      const publicKeyBigIntjsbn = new forge.jsbn.BigInteger(publicKeyHex, 16);
-      const e = new forge.jsbn.BigInteger('010001', 16);
-      const publicKeyRaw = forge.pki.setRsaPublicKey(publicKeyBigIntjsbn, e);
+    let publicKeyBigInt = BigInt(result!);
+    const publicKeyHex = publicKeyBigInt.toString(16);
+    const publicKeyBigIntjsbn = new forge.jsbn.BigInteger(publicKeyHex, 16);
+    const e = new forge.jsbn.BigInteger('010001', 16);
+    const publicKeyRaw = forge.pki.setRsaPublicKey(publicKeyBigIntjsbn, e);
 
-      const publicKeyDer = forge.asn1.toDer(forge.pki.publicKeyToAsn1(publicKeyRaw)).getBytes();
-      const publicKey = forge.util.encode64(publicKeyDer);
+    const publicKeyDer = forge.asn1.toDer(forge.pki.publicKeyToAsn1(publicKeyRaw)).getBytes();
+    const publicKey = forge.util.encode64(publicKeyDer);
 
-      console.log(`${chalk.blue('🔹 Selector :')}  ${chalk.yellow(metadata.selector)}`);
-      console.log(`${chalk.blue('🔹 Domain   :')}  ${chalk.yellow(metadata.domain)}`);
-      console.log(`${chalk.blue('🔹 Public Key:')} ${chalk.green(publicKey)}`);
+    console.log(`${chalk.blue('🔹 Selector :')}  ${chalk.yellow(metadata.selector)}`);
+    console.log(`${chalk.blue('🔹 Domain   :')}  ${chalk.yellow(metadata.domain)}`);
+    console.log(`${chalk.blue('🔹 Public Key:')} ${chalk.green(publicKey)}`);
 
-      const isHeaderHash1SignatureValid = verifyRsaPublicKey(publicKeyHex, metadata.dkimSignature1, metadata.headerHash1, metadata.signingAlgorithm);
-      const isHeaderHash2SignatureValid = verifyRsaPublicKey(publicKeyHex, metadata.dkimSignature2, metadata.headerHash2, metadata.signingAlgorithm);
+    const isHeaderHash1SignatureValid = verifyRsaPublicKey(publicKeyHex, metadata.dkimSignature1, metadata.headerHash1, metadata.signingAlgorithm);
+    const isHeaderHash2SignatureValid = verifyRsaPublicKey(publicKeyHex, metadata.dkimSignature2, metadata.headerHash2, metadata.signingAlgorithm);
 
-      if (!isHeaderHash1SignatureValid || !isHeaderHash2SignatureValid) {
-        return Response.json(
-          {
-            error: 'Public Key is Not valid'
-          }, {
-          status: 400
-        })
-      }
+    if (!isHeaderHash1SignatureValid || !isHeaderHash2SignatureValid) {
+      return { status: 400, body: { error: 'Public Key is Not valid', taskId } };
+    }
 
-      await storeCalculationResult({
-        taskId,
-        result,
-        completedAt: new Date(),
-        metadata,
-        publicKey
-      });
+    await storeCalculationResult({
+      taskId,
+      result,
+      completedAt: new Date(),
+      metadata,
+      publicKey
+    });
 
-    } else {
-      console.log(chalk.red(`Task ${taskId} failed: ${error} Failed to store calculation result for task`));
+  } else if (body.timedOut) {
+    console.log(chalk.yellow(`Task ${taskId} timed out after ${body.elapsedSeconds} seconds, domain: ${metadata?.domain}, selector: ${metadata?.selector}`));
+  } else {
+    console.log(chalk.red(`Task ${taskId} failed: ${error} Failed to store calculation result for task`));
+  }
+
+  return { status: 200, body: { message: 'Callback processed successfully', taskId } };
+}
+
+export async function POST(request: Request) {
+  try {
+    const body = await request.json();
+
+    // Batched results from the cloud function, {results: [...]}, the status of each result is reported in the response
+    if (Array.isArray(body.results)) {
+      const results = [];
+      for (const result of body.results as CallbackResult[]) {
+        results.push(await processResult(result));
+      }
+      return Response.json({
+        message: 'Callback processed successfully',
+        results: results.map(r => ({ status: r.status, ...r.body }))
+      }, { status: 200 });
     }
 
-    return Response.json({
-      message: 'Callback processed successfully',
-      taskId
-    }, { status: 200 });
+    const { status, body: responseBody } = await processResult(body);
+    return Response.json(responseBody, { status });
 
   } catch (error) {
     console.error('Error processing callback:', error);
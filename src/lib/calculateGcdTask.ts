@@ -1,6 +1,7 @@
 import chalk from 'chalk';
 import { headers } from 'next/headers';
 
+// Version 1 payload, decimal strings, em1 and em2 are the PKCS#1 encoded digests
 export interface GcdCalculationPayload {
   s1: string | number;
   s2: string | number;
@@ -10,7 +11,22 @@ export interface GcdCalculationPayload {
   metadata?: Record<string, any>;
 }
 
-export async function createGcdCalculationTask(payload: GcdCalculationPayload) {
+// Version 2 (compact) payload, base64 signatures and base64 raw digests, the cloud function rebuilds the PKCS#1 padding
+export interface GcdCompactCalculationPayload {
+  version: 2;
+  hashAlgorithm: string;
+  modulusBytes: number;
+  s1: string;
+  s2: string;
+  h1: string;
+  h2: string;
+  taskId?: string;
+  metadata?: Record<string, any>;
+}
+
+export type AnyGcdCalculationPayload = GcdCalculationPayload | GcdCompactCalculationPayload;
+
+async function createCloudTask(body: Record<string, any>, taskId?: string) {
 
   const { CloudTasksClient } = await import('@google-cloud/tasks');
   let client: InstanceType<typeof CloudTasksClient>;
@@ -26,64 +42,92 @@ export async function createGcdCalculationTask(payload: GcdCalculationPayload) {
     client = new CloudTasksClient();
   }
 
-  const headersList = headers();
-  const host = headersList.get('host');
-  const baseUrl = process.env.NODE_ENV === 'development'
-    ? process.env.CALLBACK_URL
-    : `https://${host}`;
-
-
   const PROJECT_ID = process.env.GOOGLE_CLOUD_PROJECT_ID || '';
   const LOCATION = process.env.GOOGLE_CLOUD_REGION || 'us-central1';
   const QUEUE_NAME = process.env.CLOUD_TASKS_QUEUE_NAME || '';
   const FUNCTION_URL = process.env.CLOUD_FUNCTION_URL || '';
   const SERVICE_ACCOUNT_EMAIL = process.env.TASKS_SERVICE_ACCOUNT_EMAIL;
-  const CALLBACK_URL = baseUrl;
 
-  try {
-    const { s1, s2, em1, em2, taskId, metadata } = payload;
+  if (!SERVICE_ACCOUNT_EMAIL) {
+    throw new Error('TASKS_SERVICE_ACCOUNT_EMAIL environment variable not set');
+  }
 
-    if (!s1 || !s2 || !em1 || !em2) {
-      throw new Error('Missing required parameters: s1, s2, em1, em2');
-    }
+  const parent = client.queuePath(PROJECT_ID, LOCATION, QUEUE_NAME);
 
-    if (!CALLBACK_URL) {
-      throw new Error('CALLBACK_URL environment variable not set');
-    }
+  const task = {
+    httpRequest: {
+      httpMethod: 'POST' as const,
+      url: FUNCTION_URL,
+      headers: {
+        'Content-Type': 'application/json',
+      },
+      body: Buffer.from(JSON.stringify(body)),
+      oidcToken: {
+        serviceAccountEmail: SERVICE_ACCOUNT_EMAIL,
+      },
+    },
+    name: taskId ? `${parent}/tasks/${taskId}` : undefined,
+  };
 
-    if (!SERVICE_ACCOUNT_EMAIL) {
-      throw new Error('TASKS_SERVICE_ACCOUNT_EMAIL environment variable not set');
-    }
+  const [response] = await client.createTask({ parent, task });
+  console.log(chalk.black.bgWhite(`Created task ${response.name}`));
+}
 
-    const taskPayload = {
-      s1: s1.toString(),
-      s2: s2.toString(),
-      em1: em1.toString(),
-      em2: em2.toString(),
-      callbackUrl: `${CALLBACK_URL}/api/gcd_result_callback`,
+function getCallbackUrl() {
+  const headersList = headers();
+  const host = headersList.get('host');
+  const baseUrl = process.env.NODE_ENV === 'development'
+    ? process.env.CALLBACK_URL
+    : `https://${host}`;
+  if (!baseUrl) {
+    throw new Error('CALLBACK_URL environment variable not set');
+  }
+  return `${baseUrl}/api/gcd_result_callback`;
+}
+
+function toJob(payload: AnyGcdCalculationPayload) {
+  if ('version' in payload && payload.version === 2) {
+    const { hashAlgorithm, modulusBytes, s1, s2, h1, h2, taskId, metadata } = payload;
+    if (!hashAlgorithm || !modulusBytes || !s1 || !s2 || !h1 || !h2) {
+      throw new Error('Missing required parameters: hashAlgorithm, modulusBytes, s1, s2, h1, h2');
+    }
+    return {
+      version: 2,
+      hashAlgorithm,
+      modulusBytes,
+      s1,
+      s2,
+      h1,
+      h2,
       taskId: taskId || `task_${Date.now()}`,
       metadata: metadata || {}
     };
+  }
 
-    const parent = client.queuePath(PROJECT_ID, LOCATION, QUEUE_NAME);
-
-    const task = {
-      httpRequest: {
-        httpMethod: 'POST' as const,
-        url: FUNCTION_URL,
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: Buffer.from(JSON.stringify(taskPayload)),
-        oidcToken: {
-          serviceAccountEmail: SERVICE_ACCOUNT_EMAIL,
-        },
-      },
-      name: taskId ? `${parent}/tasks/${taskId}` : undefined,
+  const { s1, s2, em1, em2, taskId, metadata } = payload as GcdCalculationPayload;
+
+  if (!s1 || !s2 || !em1 || !em2) {
+    throw new Error('Missing required parameters: s1, s2, em1, em2');
+  }
+
+  return {
+    s1: s1.toString(),
+    s2: s2.toString(),
+    em1: em1.toString(),
+    em2: em2.toString(),
+    taskId: taskId || `task_${Date.now()}`,
+    metadata: metadata || {}
+  };
+}
+
+export async function createGcdCalculationTask(payload: AnyGcdCalculationPayload) {
+  try {
+    const taskPayload = {
+      ...toJob(payload),
+      callbackUrl: getCallbackUrl(),
     };
 
-    const [response] = await client.createTask({ parent, task });
-    console.log(chalk.black.bgWhite(`Created task ${response.name}`));
+    await createCloudTask(taskPayload, payload.taskId);
 
     return {
       success: true,
@@ -96,3 +140,26 @@ export async function createGcdCalculationTask(payload: GcdCalculationPayload) {
     throw new Error(`Failed to create task: ${errorMessage}`);
   }
 }
+
+// Creates one task that solves all the payloads in a single cloud function invocation,
+// the results are sent back to the callback in batches, as {results: [...]}
+export async function createGcdBatchCalculationTask(payloads: AnyGcdCalculationPayload[]) {
+  try {
+    const taskPayload = {
+      jobs: payloads.map(toJob),
+      callbackUrl: getCallbackUrl(),
+    };
+
+    await createCloudTask(taskPayload);
+
+    return {
+      success: true,
+      message: `Batch task with ${payloads.length} jobs created successfully. Results will be sent to available shortly`,
+    };
+
+  } catch (error) {
+    const errorMessage = error instanceof Error ? error.message : 'Unknown error occurred';
+    console.error('Batch task creation error:', errorMessage);
+    throw new Error(`Failed to create batch task: ${errorMessage}`);
+  }
+}
@@ -1,11 +1,11 @@
 import { prisma } from '@/lib/db';
 import crypto from 'crypto';
 import chalk from 'chalk';
-import { canonicalizeHeaders, computeCanonicalizedHeaderHash, encodeRsaPkcs1Digest, parseDkimSignature, selectSignedHeadersnew } from "./utils";
+import { canonicalizeHeaders, computeCanonicalizedHeaderHash, parseDkimSignature, selectSignedHeadersnew } from "./utils";
 import { Prisma } from "@prisma/client";
 import { AddResult, pubKeyLength } from "./utils_server";
-import { createGcdCalculationTask } from "./calculateGcdTask";
-import type { GcdCalculationPayload } from "./calculateGcdTask";
+import { createGcdBatchCalculationTask, createGcdCalculationTask } from "./calculateGcdTask";
+import type { GcdCompactCalculationPayload } from "./calculateGcdTask";
 
 
 export async function processAndStoreEmailSignature(
@@ -145,14 +145,15 @@ export async function processAndStoreEmailSignature(
 			return { processResultError: "No existing DSPs found for domain,Can't check for GCD" };
 		}
 
-		// Calculating the signature and encoded message digest for the current email.
-		const signature1 = BigInt(`0x${Buffer.from(dkimSignatureRaw, 'base64').toString('hex')}`).toString();
+		// The signatures and raw digests are sent in the compact payload format, the cloud function rebuilds the PKCS#1 padding.
+		const signature1 = Buffer.from(dkimSignatureRaw, 'base64').toString('base64');
 		const keySizeBytes = pubKeyLength(dkimSignatureRaw);
-		const headerHashBuffer1 = Buffer.from(headerHash, "hex");
-		const encodedMessageDigest1 = encodeRsaPkcs1Digest(headerHashBuffer1, signingAlgorithm, keySizeBytes).toString();
+		const headerHash1 = Buffer.from(headerHash, "hex").toString('base64');
+		const hashAlgorithm = signingAlgorithm.replace(/^rsa-/, '');
 
 		// Loop through each found DSP to create a GCD calculation task against the current email.
 		const result = [];
+		const payloads: GcdCompactCalculationPayload[] = [];
 		for (const dsp of dsps) {
 			// Ensure the database record has the required fields.
 			if (!dsp.dkimSignature || !dsp.headerHashV2) {
@@ -166,10 +167,8 @@ export async function processAndStoreEmailSignature(
 				continue;
 			}
 
-			// Calculating the signature and encoded message digest for the DSP.
-			const signature2 = BigInt(`0x${Buffer.from(dsp.dkimSignature, 'base64').toString('hex')}`).toString();
-			const headerHashBuffer2 = Buffer.from(dsp.headerHashV2, "hex");
-			const encodedMessageDigest2 = encodeRsaPkcs1Digest(headerHashBuffer2, signingAlgorithm, keySizeBytes).toString();
+			const signature2 = Buffer.from(dsp.dkimSignature, 'base64').toString('base64');
+			const headerHash2 = Buffer.from(dsp.headerHashV2, "hex").toString('base64');
 			const taskId = crypto.randomBytes(16).toString('hex').toString();
 
 			const timestamp1 = (!dsp.timestamp || (timestamp && timestamp < dsp.timestamp)) ? timestamp : dsp.timestamp;
@@ -186,12 +185,23 @@ export async function processAndStoreEmailSignature(
 				signingAlgorithm
 			};
 
-			const payload: GcdCalculationPayload = { s1: signature1, s2: signature2, em1: encodedMessageDigest1, em2: encodedMessageDigest2, taskId, metadata };
+			const payload: GcdCompactCalculationPayload = {
+				version: 2, hashAlgorithm, modulusBytes: keySizeBytes, s1: signature1, s2: signature2, h1: headerHash1, h2: headerHash2, taskId, metadata
+			};
+			payloads.push(payload);
+		}
 
-			let createGCDResult = await createGcdCalculationTask(payload);
-			let createGCDResultwithDSP = { ...createGCDResult, domain, selector, taskId };
-			result.push(createGCDResultwithDSP);
-			console.log(chalk.green(`Created GCD calculation task for DSP id ${dsp.id}.`));
+		// Several pairs are solved in one cloud function invocation, which saves the cold starts and callback round trips
+		if (payloads.length > 1) {
+			let createGCDResult = await createGcdBatchCalculationTask(payloads);
+			for (const payload of payloads) {
+				result.push({ ...createGCDResult, domain, selector, taskId: payload.taskId });
+			}
+			console.log(chalk.green(`Created GCD calculation batch task for ${payloads.length} DSPs.`));
+		} else if (payloads.length === 1) {
+			let createGCDResult = await createGcdCalculationTask(payloads[0]);
+			result.push({ ...createGCDResult, domain, selector, taskId: payloads[0].taskId });
+			console.log(chalk.green(`Created GCD calculation task for DSP.`));
 		}
 		console.timeEnd('processAndStoreEmailSignature')
 		return result;
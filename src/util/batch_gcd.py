@@ -0,0 +1,166 @@
+import logging
+import os
+import pickle
+from dataclasses import dataclass, field
+from multiprocessing.pool import Pool
+from typing import Any, Callable, Iterable
+import gmpy2  # type: ignore
+
+# Bernstein's batch gcd (https://cr.yp.to/factorization/smoothparts-20040510.pdf, as used in https://factorable.net):
+# for moduli N_1..N_k, with P = N_1 * ... * N_k from a product tree, a remainder tree gives z_i = P mod N_i^2,
+# and gcd(N_i, z_i / N_i) = gcd(N_i, P / N_i) is the product of the factors that N_i shares with any other modulus.
+# Cost is quasi-linear in the total size of the moduli, instead of k^2 pairwise gcds.
+
+gmpy2_mpz: Any = gmpy2.mpz  # type: ignore
+gmpy2_gcd: Any = gmpy2.gcd  # type: ignore
+
+# levels with fewer nodes than this are computed in this process, shipping a few huge numbers to the workers costs more than it saves
+MIN_PARALLEL_LEVEL_SIZE = 64
+
+
+def _multiply(pair: tuple[Any, Any]) -> Any:
+	return pair[0] * pair[1]
+
+
+def _mod(pair: tuple[Any, Any]) -> Any:
+	return pair[0] % pair[1]
+
+
+def _mod_square(pair: tuple[Any, Any]) -> Any:
+	return pair[0] % (pair[1] * pair[1])
+
+
+def _quotient_gcd(pair: tuple[Any, Any]) -> Any:
+	z, n = pair
+	return gmpy2_gcd(n, z // n)
+
+
+def _gcd(pair: tuple[Any, Any]) -> Any:
+	return gmpy2_gcd(pair[0], pair[1])
+
+
+def _map(fn: Callable[[tuple[Any, Any]], Any], items: list[tuple[Any, Any]], pool: Pool | None) -> list[Any]:
+	if pool is None or len(items) < MIN_PARALLEL_LEVEL_SIZE:
+		return [fn(item) for item in items]
+	chunksize = max(1, len(items) // (4 * (os.cpu_count() or 1)))
+	return pool.map(fn, items, chunksize=chunksize)
+
+
+def product_tree(moduli: list[Any], pool: Pool | None = None) -> list[list[Any]]:
+	"""Returns the levels of the product tree, from the leaves (moduli) up to the root (product of all moduli)"""
+	tree = [[gmpy2_mpz(n) for n in moduli]]
+	while len(tree[-1]) > 1:
+		level = tree[-1]
+		products = _map(_multiply, [(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)], pool)
+		if len(level) % 2 == 1:
+			products.append(level[-1])
+		tree.append(products)
+		logging.debug(f'product tree level with {len(products)} nodes')
+	return tree
+
+
+def remainder_tree(value: Any, tree: list[list[Any]], pool: Pool | None = None, squares: bool = False) -> list[Any]:
+	"""Returns value mod each leaf of the tree (value mod leaf^2 if squares is set), reducing level by level from the root"""
+	mod = _mod_square if squares else _mod
+	remainders = [mod((value, tree[-1][0]))]
+	for level in reversed(tree[:-1]):
+		remainders = _map(mod, [(remainders[i // 2], node) for i, node in enumerate(level)], pool)
+	return remainders
+
+
+def batch_gcd(moduli: list[Any], pool: Pool | None = None) -> list[Any]:
+	"""Returns gcd(N_i, product of all other moduli) for every modulus, 1 for moduli that share no factor"""
+	if len(moduli) < 2:
+		return [gmpy2_mpz(1) for _ in moduli]
+	logging.info(f'building product tree for {len(moduli)} moduli')
+	tree = product_tree(moduli, pool)
+	logging.info(f'computing remainder tree')
+	remainders = remainder_tree(tree[-1][0], tree, pool, squares=True)
+	return _map(_quotient_gcd, list(zip(remainders, tree[0])), pool)
+
+
+def gcd_with_product(product: Any, moduli: list[Any], pool: Pool | None = None) -> list[Any]:
+	"""Returns gcd(N_i, product) for every modulus, reducing the (large) product with a remainder tree over the moduli"""
+	if not moduli:
+		return []
+	tree = product_tree(moduli, pool)
+	remainders = remainder_tree(product, tree, pool)
+	return _map(_gcd, list(zip(tree[0], remainders)), pool)
+
+
+def shared_factor_rows(ids: Iterable[int], moduli: Iterable[Any], gcds: Iterable[Any]) -> list[tuple[int, int, int]]:
+	"""Returns (id, factor_p, factor_q) for the moduli that could be split with their gcd, as read by modulus_extractor.py --post-process"""
+	rows: list[tuple[int, int, int]] = []
+	for db_id, n, g in zip(ids, moduli, gcds):
+		if g == 1:
+			continue
+		if g == n:
+			# both factors are shared (with different moduli), the batch gcd alone does not split it
+			logging.warning(f'modulus {db_id} shares all of its factors with other moduli, skipping')
+			continue
+		rows.append((db_id, int(g), int(n // g)))
+	return rows
+
+
+@dataclass
+class PersistedProductTree:
+	"""Moduli that have already been checked against each other, together with their product.
+	New moduli are checked against the product and against each other, and then added, so the existing moduli are not processed again."""
+	ids: list[int] = field(default_factory=list)
+	moduli: list[Any] = field(default_factory=list)
+	product: Any = field(default_factory=lambda: gmpy2_mpz(1))
+
+	@staticmethod
+	def load(path: str) -> 'PersistedProductTree':
+		if not os.path.exists(path):
+			logging.info(f'{path} does not exist, starting a new product tree')
+			return PersistedProductTree()
+		with open(path, 'rb') as f:
+			tree: PersistedProductTree = pickle.load(f)
+		logging.info(f'loaded product tree with {len(tree.moduli)} moduli from {path}')
+		return tree
+
+	def save(self, path: str):
+		tmp_path = f'{path}.tmp'
+		with open(tmp_path, 'wb') as f:
+			pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+		os.replace(tmp_path, path)
+		logging.info(f'saved product tree with {len(self.moduli)} moduli to {path}')
+
+	def add(self, ids: list[int], moduli: list[Any], pool: Pool | None = None) -> list[tuple[int, int, int]]:
+		"""Adds new moduli and returns the shared factor rows for every modulus, new or existing, that shares a factor with a new one"""
+		known = set(self.moduli)
+		new_ids: list[int] = []
+		new_moduli: list[Any] = []
+		for db_id, n in zip(ids, moduli):
+			n = gmpy2_mpz(n)
+			if n not in known:
+				known.add(n)
+				new_ids.append(db_id)
+				new_moduli.append(n)
+		logging.info(f'adding {len(new_moduli)} new moduli to a product tree with {len(self.moduli)} moduli')
+		if not new_moduli:
+			return []
+
+		new_gcds = batch_gcd(new_moduli, pool)
+		if self.moduli:
+			logging.info(f'checking new moduli against the existing product')
+			old_gcds = gcd_with_product(self.product, new_moduli, pool)
+			new_gcds = [g * o // gmpy2_gcd(g, o) for g, o in zip(new_gcds, old_gcds)]
+			# shared factors between new and existing moduli are rare, so find the existing moduli with one cheap gcd per modulus
+			shared = gmpy2_mpz(1)
+			for o in old_gcds:
+				if o > 1:
+					shared *= o
+			existing_rows: list[tuple[int, int, int]] = []
+			if shared > 1:
+				existing_gcds = _map(_gcd, [(n, shared) for n in self.moduli], pool)
+				existing_rows = shared_factor_rows(self.ids, self.moduli, existing_gcds)
+		else:
+			existing_rows = []
+
+		new_tree = product_tree(new_moduli, pool)
+		self.product = self.product * new_tree[-1][0]
+		self.ids.extend(new_ids)
+		self.moduli.extend(new_moduli)
+		return existing_rows + shared_factor_rows(new_ids, new_moduli, new_gcds)
@@ -13,6 +13,7 @@ from prisma import Prisma
 from tqdm import tqdm
 from dkim_util import decode_dkim_tag_value_list
 from db_util import load_dkim_records_with_dsps
+from batch_gcd import PersistedProductTree, batch_gcd, shared_factor_rows
 
 
 class CommandException(Exception):
@@ -154,6 +155,29 @@ async def extract_moduli(prisma: Prisma):
 	stop_event.set()
 
 
+def run_batch_gcd(csvFile: TextIO, product_tree_file: str | None, processes: int):
+	ids: list[int] = []
+	moduli: list[int] = []
+	for line in csvFile:
+		if not line.strip():
+			continue
+		parts = line.strip().split(',')
+		ids.append(int(parts[0]))
+		moduli.append(int(parts[1], 16))
+	logging.info(f'loaded {len(moduli)} moduli, using {processes} processes')
+
+	with multiprocessing.Pool(processes) as pool:
+		if product_tree_file:
+			tree = PersistedProductTree.load(product_tree_file)
+			rows = tree.add(ids, moduli, pool)
+			tree.save(product_tree_file)
+		else:
+			rows = shared_factor_rows(ids, moduli, batch_gcd(moduli, pool))
+	logging.info(f'found {len(rows)} moduli with shared factors')
+	for db_id, factor_p, factor_q in rows:
+		print(f'{db_id},{factor_p},{factor_q}')
+
+
 async def main():
 	logging.basicConfig(level=logging.INFO)
 	argparser = argparse.ArgumentParser(
@@ -162,8 +186,17 @@ async def main():
 	)
 	argparser.add_argument('--extract-moduli', action='store_true', help='extract RSA moduli from DKIM records and output them to standard output as CSV with columns: id, modulus')
 	argparser.add_argument('--post-process', type=argparse.FileType('r'), help='post process a CSV file with columns: id, factor_p, factor_q')
+	argparser.add_argument('--batch-gcd',
+	                       type=argparse.FileType('r'),
+	                       help='find moduli with shared factors in a CSV file with columns: id, modulus (as output by --extract-moduli), and output them as CSV with columns: id, factor_p, factor_q')
+	argparser.add_argument('--product-tree', type=str, help='use together with --batch-gcd to only check the moduli that are not yet in this persisted product tree file, and add them to it')
+	argparser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(), help='number of processes to use for --batch-gcd')
 	args = argparser.parse_args()
 
+	if args.batch_gcd:
+		run_batch_gcd(args.batch_gcd, args.product_tree, args.processes)
+		return
+
 	prisma = Prisma()
 	await prisma.connect()
 
@@ -172,7 +205,7 @@ async def main():
 	elif args.extract_moduli:
 		await extract_moduli(prisma)
 	else:
-		raise ValueError('either --extract-moduli or --post-process must be specified')
+		raise ValueError('either --extract-moduli, --post-process or --batch-gcd must be specified')
 
 
 if __name__ == '__main__':
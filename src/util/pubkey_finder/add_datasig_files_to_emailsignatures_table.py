@@ -2,7 +2,7 @@ import asyncio
 import base64
 import hashlib
 import argparse
-from common import Dsp, MsgInfo, load_signed_data
+from common import Dsp, MsgInfo, load_signed_data, hashfn_from_signing_algorithm
 from prisma import Prisma
 from tqdm import tqdm
 
@@ -12,7 +12,7 @@ async def add_messages_to_db(signed_messages: dict[Dsp, list[MsgInfo]], prisma:
 	max_msgs_per_dsp = 10
 	for dsp, msg_infos in tqdm(msg_list):
 		for msg_info in msg_infos[:max_msgs_per_dsp]:
-			msg_hash = hashlib.sha256(msg_info.signedData).hexdigest()
+			msg_hash = hashlib.new(hashfn_from_signing_algorithm(msg_info.signingAlgorithm), msg_info.signedData).hexdigest()
 			msg_sig = base64.b64encode(msg_info.signature).decode('utf-8')
 			emailsig = await prisma.emailsignature.find_first(where={'headerHash': msg_hash, 'dkimSignature': msg_sig})
 			if not emailsig:
@@ -22,7 +22,7 @@ async def add_messages_to_db(signed_messages: dict[Dsp, list[MsgInfo]], prisma:
 				        'selector': dsp.selector,
 				        'headerHash': msg_hash,
 				        'dkimSignature': msg_sig,
-				        'signingAlgorithm': 'rsa-sha256',
+				        'signingAlgorithm': msg_info.signingAlgorithm,
 				        'canonInfo': msg_info.canonInfo,
 				    })
 
@@ -0,0 +1,180 @@
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable
+from Crypto.PublicKey import RSA
+import gmpy2  # type: ignore
+from gcd_solver import DEFAULT_EXPONENTS, SOLVE_MODES, find_n, message_sig_pair, pkcs1_padding, remove_small_prime_factors
+
+# Benchmarks the gcd key recovery path with synthetic signatures, so solver changes can be compared against a stored baseline
+# without real archive data. Every case runs in its own process, so the peak RSS is that of the case.
+
+
+def make_signed_pairs(bits: int, e: int, hashfn: str, pairs: int) -> tuple[int, list[tuple[list[str], list[bytes]]]]:
+	key = RSA.generate(bits, e=e)
+	size_bytes = bits // 8
+	result: list[tuple[list[str], list[bytes]]] = []
+	for i in range(pairs):
+		hashes: list[str] = []
+		signatures: list[bytes] = []
+		for j in range(2):
+			hash_hex = hashlib.new(hashfn, f'synthetic header {bits} {e} {i} {j}'.encode()).hexdigest()
+			message = int(pkcs1_padding(size_bytes, hash_hex, hashfn), 16)
+			hashes.append(hash_hex)
+			signatures.append(pow(message, key.d, key.n).to_bytes(size_bytes, 'big'))
+		result.append((hashes, signatures))
+	return key.n, result
+
+
+def time_stage(fn: Callable[[], Any], repeat: int = 1) -> tuple[Any, dict[str, float]]:
+	start_cpu = time.process_time()
+	start_wall = time.perf_counter()
+	result = None
+	for _ in range(repeat):
+		result = fn()
+	cpu = time.process_time() - start_cpu
+	wall = time.perf_counter() - start_wall
+	return result, {'cpu_seconds': cpu, 'wall_seconds': wall, 'per_second': repeat / wall if wall > 0 else 0.0}
+
+
+def run_case(bits: int, e: int, hashfn: str, mode: str, pairs: int, all_exponents: bool) -> dict[str, Any]:
+	n, signed_pairs = make_signed_pairs(bits, e, hashfn, pairs)
+	size_bytes = bits // 8
+	hashes, signatures = signed_pairs[0]
+	stages: dict[str, dict[str, float]] = {}
+
+	_, stages['pkcs1_padding'] = time_stage(lambda: pkcs1_padding(size_bytes, hashes[0], hashfn), repeat=1000)
+	_, stages['message_sig_pair'] = time_stage(lambda: message_sig_pair(size_bytes, hashes[0], signatures[0], hashfn), repeat=1000)
+	# a typical raw gcd result: the modulus times a few small primes
+	raw_gcd = gmpy2.mpz(n) * 2 * 3**2 * 65537 * 12553
+	_, stages['remove_small_prime_factors'] = time_stage(lambda: remove_small_prime_factors(raw_gcd), repeat=100)
+
+	exponents = DEFAULT_EXPONENTS if all_exponents else [e]
+	recovered = 0
+	solve_cpu = 0.0
+	solve_wall = 0.0
+	for hashes, signatures in signed_pairs:
+		(found_n, found_e), timing = time_stage(lambda: find_n(hashes, signatures, hashfn, mode, exponents=exponents))
+		solve_cpu += timing['cpu_seconds']
+		solve_wall += timing['wall_seconds']
+		if found_n == n and found_e == e:
+			recovered += 1
+	stages['find_n'] = {'cpu_seconds': solve_cpu / pairs, 'wall_seconds': solve_wall / pairs, 'per_second': pairs / solve_wall if solve_wall > 0 else 0.0}
+
+	return {
+	    'bits': bits,
+	    'e': e,
+	    'hashfn': hashfn,
+	    'mode': mode,
+	    'exponents': exponents,
+	    'pairs': pairs,
+	    'recovered': recovered,
+	    'pairs_per_second': stages['find_n']['per_second'],
+	    'stages': stages,
+	    # ru_maxrss is in kilobytes on Linux
+	    'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+	}
+
+
+def case_key(result: dict[str, Any]) -> tuple[int, int, str, str]:
+	return (result['bits'], result['e'], result['hashfn'], result['mode'])
+
+
+def compare_with_baseline(results: list[dict[str, Any]], baseline: dict[str, Any], tolerance: float) -> bool:
+	"""Prints the change in cpu time per stage against the baseline, returns False if any stage got slower than the tolerance"""
+	baseline_results = {case_key(r): r for r in baseline['results']}
+	ok = True
+	for result in results:
+		base = baseline_results.get(case_key(result))
+		if base is None:
+			print(f'{case_key(result)}: not in baseline')
+			continue
+		for stage, timing in result['stages'].items():
+			base_cpu = base['stages'].get(stage, {}).get('cpu_seconds')
+			if not base_cpu:
+				continue
+			ratio = timing['cpu_seconds'] / base_cpu
+			regression = ratio > 1 + tolerance
+			ok = ok and not regression
+			print(f'{case_key(result)} {stage}: {ratio:.2f}x baseline cpu time{" (regression)" if regression else ""}')
+		print(f'{case_key(result)} peak rss: {result["peak_rss_kb"]} kB, baseline {base["peak_rss_kb"]} kB')
+	return ok
+
+
+class ProgramArgs(argparse.Namespace):
+	sizes: list[int]
+	exponents: list[int]
+	modes: list[str]
+	hashfn: str
+	pairs: int
+	all_exponents: bool
+	output: str | None
+	baseline: str | None
+	tolerance: float
+	loglevel: int
+
+
+def main():
+	parser = argparse.ArgumentParser(description='benchmark the gcd key recovery path (gcd_solver.py) with synthetic RSA signatures and output the results as JSON',
+	                                 allow_abbrev=False)
+	int_list: Callable[[str], list[int]] = lambda s: [int(x, 0) for x in s.split(',')]
+	parser.add_argument('--sizes', type=int_list, default=[1024, 2048, 4096], help='comma separated RSA key sizes in bits (default: 1024,2048,4096)')
+	parser.add_argument('--exponents', type=int_list, default=[3, 17, 65537], help='comma separated public exponents (default: 3,17,65537)')
+	parser.add_argument('--modes', type=lambda s: s.split(','), default=['reduced'], help=f'comma separated find_n modes, from {SOLVE_MODES} (default: reduced)')
+	parser.add_argument('--hashfn', choices=['sha1', 'sha256', 'sha512'], default='sha256')
+	parser.add_argument('--pairs', type=int, default=1, help='number of signature pairs to solve per case')
+	parser.add_argument('--all-exponents', action='store_true', help='let find_n try all of its default exponents in order, instead of only the exponent of the key')
+	parser.add_argument('--output', type=str, help='write the results to this JSON file, in addition to standard output')
+	parser.add_argument('--baseline', type=str, help='compare the results with a JSON file from an earlier run, exit with status 1 on regressions')
+	parser.add_argument('--tolerance', type=float, default=0.1, help='allowed relative cpu time increase per stage when comparing with --baseline (default: 0.1)')
+	parser.add_argument('--debug', action="store_const", dest="loglevel", const=logging.DEBUG, default=logging.WARNING, help='enable debug logging')
+	args = parser.parse_args(namespace=ProgramArgs)
+
+	logging.root.name = os.path.basename(__file__)
+	logging.basicConfig(level=args.loglevel, format='%(name)s: %(levelname)s: %(message)s')
+
+	results: list[dict[str, Any]] = []
+	for bits in args.sizes:
+		for e in args.exponents:
+			for mode in args.modes:
+				print(f'benchmarking {bits} bits, e={e}, mode={mode}', file=sys.stderr)
+				# a fresh process per case, so peak RSS is not inherited from earlier (larger) cases
+				with multiprocessing.get_context('spawn').Pool(1) as pool:
+					result = pool.apply(run_case, (bits, e, args.hashfn, mode, args.pairs, args.all_exponents))
+				print(f'{result["pairs_per_second"]:.4f} pairs/s, find_n cpu time {result["stages"]["find_n"]["cpu_seconds"]:.2f} s, peak rss {result["peak_rss_kb"]} kB',
+				      file=sys.stderr)
+				results.append(result)
+
+	report = {
+	    'meta': {
+	        'timestamp': datetime.now(timezone.utc).isoformat(),
+	        'python': platform.python_version(),
+	        'gmpy2': gmpy2.version(),
+	        'machine': platform.machine(),
+	        'cpu_count': os.cpu_count(),
+	    },
+	    'results': results,
+	}
+	output = json.dumps(report, indent=2)
+	print(output)
+	if args.output:
+		with open(args.output, 'w') as f:
+			f.write(output + '\n')
+
+	if args.baseline:
+		with open(args.baseline) as f:
+			baseline = json.load(f)
+		if not compare_with_baseline(results, baseline, args.tolerance):
+			sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
@@ -20,31 +20,17 @@ class MsgInfo:
 	source: str
 	date: str
 	canonInfo: str
+	# the a= tag of the DKIM-Signature, .datasig files from before this field was added only contain rsa-sha256 signatures
+	signingAlgorithm: str = 'rsa-sha256'
 
 
-# https://stackoverflow.com/a/2212923/961254
-def gen_primes():
-	D: dict[int, list[int]] = {}
-	q = 2
-	while True:
-		if q not in D:
-			yield q
-			D[q * q] = [q]
-		else:
-			for p in D[q]:
-				D.setdefault(p + q, []).append(p)
-			del D[q]
-		q += 1
-
-
-def first_n_primes(n: int) -> list[int]:
-	x: set[int] = set()
-	y = 0
-	a = gen_primes()
-	while y < n:
-		x |= set([next(a)])
-		y += 1
-	return list(sorted(x))
+def hashfn_from_signing_algorithm(signing_algorithm: str) -> str:
+	# map the a= tag of a DKIM signature, such as "rsa-sha256", to the hash function name used by gcd_solver, such as "sha256"
+	hashfns = {'rsa-sha256': 'sha256', 'rsa-sha1': 'sha1', 'rsa-sha512': 'sha512'}
+	try:
+		return hashfns[signing_algorithm.strip().lower()]
+	except KeyError:
+		raise ValueError(f'unsupported signing algorithm: {signing_algorithm}')
 
 
 def load_signed_data(datasig_files: list[str]):
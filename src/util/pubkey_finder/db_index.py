@@ -0,0 +1,124 @@
+import binascii
+import logging
+from dataclasses import dataclass, field
+from typing import Iterable, TypeVar
+from prisma import Prisma
+from prisma.models import DkimRecord, DomainSelectorPair, EmailPairGcdResult
+from prisma.enums import KeyType
+from Cryptodome.PublicKey import RSA
+from common import Dsp
+from key_periods import KeyPeriod, KeyPeriodIndex
+
+# In-memory indexes for email_sigs_gcd.py, bulk loaded once for the domains in scope,
+# so that the main loop only goes to the database for writes instead of several queries per signature pair.
+# The records written by email_sigs_gcd.py are added back to the indexes (see db_writer.py), which keeps them current for the rest of the run.
+
+# ids per query, well below the bind parameter limit of PostgreSQL
+PRELOAD_CHUNK_SIZE = 5000
+
+T = TypeVar('T')
+
+
+def chunks(items: list[T], size: int = PRELOAD_CHUNK_SIZE) -> Iterable[list[T]]:
+	for i in range(0, len(items), size):
+		yield items[i:i + size]
+
+
+def pair_key(sig_id_a: int, sig_id_b: int) -> tuple[int, int]:
+	# results are stored for either order of the two signatures
+	return (min(sig_id_a, sig_id_b), max(sig_id_a, sig_id_b))
+
+
+@dataclass
+class DbIndex:
+	# DomainSelectorPair of every domain/selector of the domains in scope
+	dsp_records: dict[Dsp, DomainSelectorPair] = field(default_factory=dict)
+	# DkimRecords of each domain/selector pair, ordered by firstSeenAt
+	dkim_records: dict[Dsp, list[DkimRecord]] = field(default_factory=dict)
+	# stored EmailPairGcdResult of the signature pairs in scope
+	pair_results: dict[tuple[int, int], EmailPairGcdResult] = field(default_factory=dict)
+	# validity periods of the DkimRecords, kept in step with dkim_records
+	key_periods: KeyPeriodIndex = field(default_factory=KeyPeriodIndex)
+
+	def dsp_record(self, dsp: Dsp) -> DomainSelectorPair | None:
+		return self.dsp_records.get(dsp)
+
+	def records_for(self, dsp: Dsp) -> list[DkimRecord]:
+		return self.dkim_records.get(dsp, [])
+
+	def find_record(self, dsp: Dsp, key_data: str) -> DkimRecord | None:
+		for record in self.records_for(dsp):
+			if record.keyData == key_data:
+				return record
+		return None
+
+	def pair_result(self, sig_id_a: int, sig_id_b: int) -> EmailPairGcdResult | None:
+		return self.pair_results.get(pair_key(sig_id_a, sig_id_b))
+
+	def known_key_params(self, domain: str) -> list[tuple[int, int]]:
+		"""(modulus bits, e) of the RSA keys known for any selector of the domain"""
+		known_keys: list[tuple[int, int]] = []
+		for dsp, records in self.dkim_records.items():
+			if dsp.domain != domain:
+				continue
+			for record in records:
+				if record.keyType != KeyType.RSA or not record.keyData:
+					continue
+				try:
+					rsa_key = RSA.import_key(binascii.a2b_base64(record.keyData))
+				except (ValueError, IndexError, TypeError, binascii.Error):
+					continue
+				known_keys.append((rsa_key.n.bit_length(), rsa_key.e))
+		return known_keys
+
+	def add_dsp_record(self, dsp: Dsp, dsp_record: DomainSelectorPair):
+		self.dsp_records.setdefault(dsp, dsp_record)
+
+	def add_dkim_record(self, dsp: Dsp, record: DkimRecord):
+		records = self.dkim_records.setdefault(dsp, [])
+		records.append(record)
+		records.sort(key=lambda r: r.firstSeenAt)
+		self.update_key_periods(dsp)
+
+	def update_key_periods(self, dsp: Dsp):
+		self.key_periods.set_periods(dsp, [KeyPeriod(r.firstSeenAt, r.lastSeenAt or r.firstSeenAt, r.keyData) for r in self.records_for(dsp)])
+
+	def replace_dkim_record(self, dsp: Dsp, record: DkimRecord):
+		"""Puts an updated record in place of the one with the same id"""
+		records = [r for r in self.records_for(dsp) if r.id != record.id]
+		self.dkim_records[dsp] = records
+		self.add_dkim_record(dsp, record)
+
+	def add_pair_result(self, result: EmailPairGcdResult):
+		self.pair_results[pair_key(result.emailSignatureA_id, result.emailSignatureB_id)] = result
+
+
+async def load_db_index(prisma: Prisma, domains: Iterable[str], signature_ids: Iterable[int]) -> DbIndex:
+	"""Bulk loads the DomainSelectorPairs and DkimRecords of the domains, and the EmailPairGcdResults of the signatures"""
+	index = DbIndex()
+	domains = sorted(set(domains))
+	ids_to_dsp: dict[int, Dsp] = {}
+	for chunk in chunks(domains):
+		for dsp_record in await prisma.domainselectorpair.find_many(where={'domain': {'in': chunk}}, order={'id': 'asc'}):
+			dsp = Dsp(dsp_record.domain, dsp_record.selector)
+			index.add_dsp_record(dsp, dsp_record)
+			ids_to_dsp[dsp_record.id] = dsp
+	logging.info(f'preloaded {len(index.dsp_records)} domain/selector pairs of {len(domains)} domains')
+
+	dsp_ids = list(ids_to_dsp.keys())
+	records = 0
+	for chunk in chunks(dsp_ids):
+		for record in await prisma.dkimrecord.find_many(where={'domainSelectorPairId': {'in': chunk}}, order={'firstSeenAt': 'asc'}):
+			index.dkim_records.setdefault(ids_to_dsp[record.domainSelectorPairId], []).append(record)
+			records += 1
+	for dsp in index.dkim_records:
+		index.update_key_periods(dsp)
+	logging.info(f'preloaded {records} dkim records')
+
+	# both signatures of a pair are in scope, so the pairs with signature A in scope are all of them
+	signature_ids = sorted(set(signature_ids))
+	for chunk in chunks(signature_ids):
+		for result in await prisma.emailpairgcdresult.find_many(where={'emailSignatureA_id': {'in': chunk}}):
+			index.add_pair_result(result)
+	logging.info(f'preloaded {len(index.pair_results)} email pair gcd results of {len(signature_ids)} signatures')
+	return index
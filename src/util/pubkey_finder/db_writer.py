@@ -0,0 +1,170 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Any, Awaitable, Callable
+from prisma import Prisma
+from prisma.models import DkimRecord, DomainSelectorPair
+from common import Dsp
+from db_index import DbIndex
+
+# Single writer task for email_sigs_gcd.py: the domain/selector pairs that are searched concurrently submit their writes here,
+# and they are run one at a time in the order they were submitted.
+# The writer adds each written record to the index of db_index.py, so the index stays current for the searches still running.
+#
+# The pair results and the extensions of the key periods are written behind: they are buffered and written together,
+# with one create_many and the grouped updates in one batch, when the buffer is full, after flush_interval seconds, and on close.
+# Extensions of the same DkimRecord are merged, so only the earliest firstSeenAt and the latest lastSeenAt are written.
+# The buffered pair results are not added to the index, as each pair is searched once per run.
+# A failed flush is retried WRITE_FLUSH_RETRIES times, a second apart and then doubling, whether it was triggered by the timer, a full buffer or close;
+# when the retries fail too, the writes stay buffered and the error is logged (timer) or raised to the caller (full buffer, close).
+
+Write = Callable[[], Awaitable[Any]]
+
+FLUSH = object()
+# wakes the writer task up to wait for the flush_interval of the writes buffered since it last waited
+WAKE = object()
+
+
+class DbWriter:
+
+	def __init__(self, prisma: Prisma, index: DbIndex, batch_size: int | None = None, flush_interval: float | None = None, flush_retries: int | None = None):
+		self.prisma = prisma
+		self.index = index
+		# WRITE_BATCH_SIZE buffered writes, or WRITE_FLUSH_SECONDS after the first of them, trigger a flush
+		self.batch_size = batch_size or int(os.environ.get('WRITE_BATCH_SIZE', '500'))
+		self.flush_interval = flush_interval or float(os.environ.get('WRITE_FLUSH_SECONDS', '10'))
+		self.flush_retries = flush_retries if flush_retries is not None else int(os.environ.get('WRITE_FLUSH_RETRIES', '3'))
+		self.pending_results: list[dict[str, Any]] = []
+		# merged firstSeenAt and lastSeenAt by DkimRecord id
+		self.pending_updates: dict[int, dict[str, datetime]] = {}
+		self.pending_since: float | None = None
+		self.queue: asyncio.Queue[Any] = asyncio.Queue()
+		self.task = asyncio.create_task(self.run())
+
+	def pending(self) -> int:
+		return len(self.pending_results) + len(self.pending_updates)
+
+	async def run(self):
+		while True:
+			try:
+				if self.pending_since is None:
+					item = await self.queue.get()
+				else:
+					item = await asyncio.wait_for(self.queue.get(), max(0, self.pending_since + self.flush_interval - time.monotonic()))
+			except asyncio.TimeoutError:
+				item = FLUSH
+			if item is None:
+				return
+			if item is WAKE:
+				continue
+			if item is FLUSH:
+				try:
+					await self.flush_with_retries()
+				except Exception as e:
+					# the writes stay buffered for the next flush
+					logging.error(f'failed to write {self.pending()} buffered results, retrying with the next flush: {e}')
+				continue
+			write, future = item
+			try:
+				result = await write()
+			except Exception as e:
+				if not future.cancelled():
+					future.set_exception(e)
+			else:
+				if not future.cancelled():
+					future.set_result(result)
+
+	async def submit(self, write: Write) -> Any:
+		"""Runs the write in the writer task, returns its result"""
+		future: asyncio.Future[Any] = asyncio.get_running_loop().create_future()
+		self.queue.put_nowait((write, future))
+		return await future
+
+	async def create_dsp_record(self, dsp: Dsp, source: str) -> DomainSelectorPair:
+		async def write():
+			dsp_record = await self.prisma.domainselectorpair.create(data={'domain': dsp.domain, 'selector': dsp.selector, 'sourceIdentifier': source})
+			self.index.add_dsp_record(dsp, dsp_record)
+			return dsp_record
+		return await self.submit(write)
+
+	async def create_dkim_record(self, dsp: Dsp, data: dict[str, Any]) -> DkimRecord:
+		async def write():
+			record = await self.prisma.dkimrecord.create(data=data)
+			self.index.add_dkim_record(dsp, record)
+			return record
+		return await self.submit(write)
+
+	async def extend_dkim_record(self, dsp: Dsp, record: DkimRecord, firstSeenAt: datetime | None = None, lastSeenAt: datetime | None = None):
+		"""Moves the firstSeenAt or lastSeenAt of the record out to the dates, in the index now and in the database with the next flush"""
+		update = self.pending_updates.setdefault(record.id, {})
+		if firstSeenAt and firstSeenAt < record.firstSeenAt:
+			record.firstSeenAt = firstSeenAt
+			update['firstSeenAt'] = firstSeenAt
+		if lastSeenAt and (not record.lastSeenAt or lastSeenAt > record.lastSeenAt):
+			record.lastSeenAt = lastSeenAt
+			update['lastSeenAt'] = lastSeenAt
+		if not update:
+			del self.pending_updates[record.id]
+			return
+		self.index.replace_dkim_record(dsp, record)
+		await self.buffered()
+
+	async def create_pair_result(self, data: dict[str, Any]):
+		"""Stores the result with the next flush"""
+		self.pending_results.append(data)
+		await self.buffered()
+
+	async def buffered(self):
+		if self.pending_since is None:
+			self.pending_since = time.monotonic()
+			self.queue.put_nowait(WAKE)
+		if self.pending() >= self.batch_size:
+			# waits for the flush, so the searches do not run ahead of the database
+			await self.submit(self.flush_with_retries)
+
+	async def flush(self):
+		results, self.pending_results = self.pending_results, []
+		updates, self.pending_updates = self.pending_updates, {}
+		self.pending_since = None
+		if not results and not updates:
+			return
+		try:
+			async with self.prisma.batch_() as batcher:
+				if results:
+					# pairs stored by an interrupted earlier run are skipped
+					batcher.emailpairgcdresult.create_many(data=results, skip_duplicates=True)
+				for record_id, data in updates.items():
+					batcher.dkimrecord.update(where={'id': record_id}, data=data)
+		except Exception:
+			# back in the buffer, in front of the writes buffered while the batch was sent, which extend the records further
+			self.pending_results = results + self.pending_results
+			for record_id, data in self.pending_updates.items():
+				updates.setdefault(record_id, {}).update(data)
+			self.pending_updates = updates
+			self.pending_since = time.monotonic()
+			raise
+		logging.info(f'wrote {len(results)} email pair gcd results and {len(updates)} dkim record updates')
+
+	async def flush_with_retries(self):
+		"""Flushes, retrying a failed flush flush_retries times before raising its error"""
+		delay = 1.0
+		for attempt in range(self.flush_retries + 1):
+			try:
+				return await self.flush()
+			except Exception as e:
+				if attempt == self.flush_retries:
+					raise
+				logging.warning(f'failed to write {self.pending()} buffered results, retrying in {delay:.0f} s: {e}')
+			await asyncio.sleep(delay)
+			delay *= 2
+
+	async def close(self):
+		"""Waits for the submitted writes, writes the buffered ones and stops the writer task"""
+		self.queue.put_nowait(None)
+		try:
+			await self.task
+		finally:
+			# also when the writer task was cancelled, e.g. when the event loop is shut down after an error
+			await self.flush_with_retries()
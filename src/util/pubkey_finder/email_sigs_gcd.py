@@ -2,42 +2,85 @@ import asyncio
 import binascii
 import json
 import logging
+import multiprocessing
 import os
 import subprocess
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from prisma import Prisma
 from prisma.models import EmailSignature, DomainSelectorPair
 from prisma.enums import KeyType
 from Cryptodome.PublicKey import RSA
-from Cryptodome.Signature import PKCS1_v1_5 
-from Cryptodome.Hash import SHA256
-from gcd_solver import message_sig_pair, find_n
-from common import Dsp, get_date_interval
+from gcd_solver import MAX_REFINE_SIGNATURES
+from solver_pool import SolveJob, SolverPool, SolveTimeout, SolverWorkerDied
+from solver_service import SolverServiceClient, connect_solver_service
+from signature_verifier import SignatureCheck, verify_pairs
+from common import Dsp, get_date_interval, hashfn_from_signing_algorithm
 import sys
-import httpx
 from tqdm import tqdm
 from typing import Any
 import gmpy2  # type: ignore
 from pathlib import Path
 sys.path.append(str(Path(__file__).absolute().parent.parent.parent.parent))  
-from src.util.dkim_util import decode_dkim_tag_value_list
+# db_index and key_periods import from src.util
+from db_index import DbIndex, load_db_index
+from key_periods import ArchiveKeyApi, KeyPeriodIndex
+from db_writer import DbWriter
 
 gmpy2_mpz: Any = gmpy2.mpz  # type: ignore
 gmpy2_gcd: Any = gmpy2.gcd  # type: ignore
 
 DspToSigs = dict[Dsp, list[EmailSignature]]
 
+# Solves run in this pool when it is set (see main), otherwise find_n runs in this process
+solver_pool: SolverPool | None = None
+
+# The resident solver of solver_service.py, used instead of solver_pool when it is running
+solver_service: SolverServiceClient | None = None
+
+# Signature checks run in this process pool when it is set (see main), and so does find_n when there is no solver pool or service
+cpu_executor: ProcessPoolExecutor | None = None
+
 # Find the public key for a pair of signatures
 # Note that loglevel is currently ignored, but used to be called when directly calling the gcd_solver.py script
-def find_key(dsp: Dsp, sig0: EmailSignature, sig1: EmailSignature, loglevel: int) -> str | None:
-	hashfn = 'sha256'
-	
-	# Call find_n directly
-	n, e = find_n(
-		[sig0.headerHash, sig1.headerHash],
-		[binascii.a2b_base64(sig0.dkimSignature), binascii.a2b_base64(sig1.dkimSignature)],
-		hashfn
-	)
+# refine_sigs are other signatures for the same domain/selector pair, used by find_n to shrink a gcd that is larger than the modulus
+# known_keys are (modulus bits, e) of the keys already known for the domain, used by find_n to order the exponents
+# Raises SolveTimeout or SolverWorkerDied when the solver pool gave up on the pair
+async def find_key(dsp: Dsp,
+                   sig0: EmailSignature,
+                   sig1: EmailSignature,
+                   loglevel: int,
+                   refine_sigs: list[EmailSignature] = [],
+                   known_keys: list[tuple[int, int]] = []) -> str | None:
+	if sig0.signingAlgorithm.lower() != sig1.signingAlgorithm.lower():
+		logging.info(f'signing algorithm mismatch for signatures {sig0.id} ({sig0.signingAlgorithm}) and {sig1.id} ({sig1.signingAlgorithm})')
+		return None
+	try:
+		hashfn = hashfn_from_signing_algorithm(sig0.signingAlgorithm)
+		refine_sigs = [s for s in refine_sigs if s.signingAlgorithm.lower() == sig0.signingAlgorithm.lower()][:MAX_REFINE_SIGNATURES]
+
+		job = SolveJob(
+		    [sig0.headerHash, sig1.headerHash],
+		    [binascii.a2b_base64(sig0.dkimSignature), binascii.a2b_base64(sig1.dkimSignature)],
+		    hashfn,
+		    refine_hashes_hex=[s.headerHash for s in refine_sigs],
+		    refine_signatures=[binascii.a2b_base64(s.dkimSignature) for s in refine_sigs],
+		    known_keys=known_keys,
+		    domain=dsp.domain,
+		    selector=dsp.selector,
+		)
+		if solver_service is not None:
+			n, e = await asyncio.to_thread(solver_service.solve, job)
+		elif solver_pool is not None:
+			n, e = await asyncio.wrap_future(solver_pool.submit(job))
+		elif cpu_executor is not None:
+			n, e = await asyncio.get_running_loop().run_in_executor(cpu_executor, job.solve)
+		else:
+			n, e = job.solve()
+	except ValueError as e:
+		# e.g. a signing algorithm that store_email_signature.ts stored with a warning, or a malformed header hash or signature
+		logging.warning(f'skipping signatures {sig0.id} and {sig1.id}: {e}')
+		return None
 	
 	if (n < 2):
 		logging.info(f'No GCD found, n < 2...')
@@ -49,72 +92,54 @@ def find_key(dsp: Dsp, sig0: EmailSignature, sig1: EmailSignature, loglevel: int
 	return keyDER_base64
 
 
-async def has_known_keys(prisma: Prisma, dsp: Dsp, dspsWithKnownKeys: set[Dsp]) -> bool:
-	if dsp in dspsWithKnownKeys:
-		return True
-	dnsRecord = await prisma.domainselectorpair.find_first(where={'domain': dsp.domain, 'selector': dsp.selector})
-	if dnsRecord:
-		dspsWithKnownKeys.add(dsp)
-		return True
-	return False
+# The signature of sig as a check for signature_verifier.py, None if it cannot be checked
+def signature_check(sig: EmailSignature) -> SignatureCheck | None:
+    try:
+        return SignatureCheck(binascii.a2b_base64(sig.dkimSignature), sig.headerHash, hashfn_from_signing_algorithm(sig.signingAlgorithm))
+    except (ValueError, binascii.Error):
+        return None
+
 
-# Validate a signature with a key
+# Validate signatures with keys, in one batch that runs in cpu_executor when it is set
 # This is used to sanity check messages we scraped
-async def validate_signature(keyData: str, sig: EmailSignature) -> bool:
-    try:
-        # Try a few different approaches to verify the signature
-        rsa_key = RSA.import_key(binascii.a2b_base64(keyData))
-        verifier = PKCS1_v1_5.new(rsa_key)
-        sig_bytes = binascii.a2b_base64(sig.dkimSignature)
-        # logging.info(f'validating signature {sig.id} with message {sig.headerHash} and signature {sig.dkimSignature} with sig bytes {sig_bytes} with key {keyData}')
-        # logging.info(f'Signature bytes length: {len(sig_bytes)}')
- 
-        # Approach 1: Using raw hash bytes
-        h = SHA256.new()
-        h.digest = lambda: bytes.fromhex(sig.headerHash)
-        if verifier.verify(h, sig_bytes):
-            logging.info(f'signature {sig.id} validated with raw hash bytes')
-            return True
-            
-        # Approach 2: Using pkcs1 padding like in gcd_solver
-        size_bytes = len(sig_bytes)
-        message, signature = message_sig_pair(size_bytes, sig.headerHash, sig_bytes, 'sha256')
-        decrypted = pow(signature, rsa_key.e, rsa_key.n)
-        if decrypted == message:
-            logging.info(f'signature {sig.id} validated with pkcs1 padding')
-            return True
-        logging.info(f'signature {sig.id} did not validate with pkcs1 padding')
-        return False
-    except:
-        logging.info(f'signature {sig.id} errored with pkcs1 padding')
-        return False
+# Returns a bitmap of the (key, signature) pairs, bit i is set when the signature of pair i validates with its key
+async def validate_signatures(pairs: list[tuple[str | None, EmailSignature]]) -> int:
+    positions: list[int] = []
+    checks: list[tuple[str, SignatureCheck]] = []
+    for i, (keyData, sig) in enumerate(pairs):
+        check = signature_check(sig)
+        if keyData and check:
+            positions.append(i)
+            checks.append((keyData, check))
+    if cpu_executor is not None and checks:
+        valid = await asyncio.get_running_loop().run_in_executor(cpu_executor, verify_pairs, checks)
+    else:
+        valid = verify_pairs(checks)
+    return sum(1 << i for j, i in enumerate(positions) if valid >> j & 1)
 
 
 # Check if the signature can be validated by either of the key records in the database, either the one before or the one after, and check if that key validates the signature, and if so then update the either starting or ending date in the database
 # Returns true if the signature was validated by either key and false otherwise
-async def check_adjacent_sigs(dsp: Dsp, sig: EmailSignature, prisma: Prisma) -> bool:
-    # Find a domain/selector pair record to avoid a more expensive DB query
+async def check_adjacent_sigs(dsp: Dsp, sig: EmailSignature, index: DbIndex, writer: DbWriter) -> bool:
+    # The domain/selector pair and its DKIM records come from the preloaded index, updates go through the writer
     logging.info(f'checking adjacent sigs for {dsp.domain}:{dsp.selector} at timestamp {sig.timestamp}')
-    dsp_record = await prisma.domainselectorpair.find_first(
-        where={'domain': dsp.domain, 'selector': dsp.selector}
-    )
-    if not dsp_record:
+    if not index.dsp_record(dsp):
         logging.info(f'no domain/selector pair record found for {dsp.domain}:{dsp.selector}')
         return False
 
-    # Get all DKIM records for this domain/selector pair
-    dkim_records = await prisma.dkimrecord.find_many(
-        where={'domainSelectorPairId': dsp_record.id},
-        order={'firstSeenAt': 'asc'}
-    )
+    # All DKIM records for this domain/selector pair, ordered by firstSeenAt
+    dkim_records = list(index.records_for(dsp))
 
     sig_time = sig.timestamp
     if not sig_time:
         logging.info(f'no timestamp for signature {sig.id}')
         return False
 
+    # Validate the signature with the keys of all records at once
+    valid = await validate_signatures([(record.keyData, sig) for record in dkim_records])
+
     # Check each record to see if the signature falls just before or after its time period
-    for record in dkim_records:
+    for i, record in enumerate(dkim_records):
         if not record.firstSeenAt or not record.lastSeenAt:
             continue
 
@@ -122,61 +147,66 @@ async def check_adjacent_sigs(dsp: Dsp, sig: EmailSignature, prisma: Prisma) ->
         if sig_time < record.firstSeenAt:
             logging.info(f'signature {sig.id} is just before the first seen date {record.firstSeenAt}')
             # If this signature validates with this key, then we can just update the firstSeenAt
-            if record.keyData and await validate_signature(record.keyData, sig):
+            if valid >> i & 1:
                 # If valid, update firstSeenAt
                 logging.info(f'signature {sig.id} before time period validates with key {record.keyData} found from {record.source}')
-                await prisma.dkimrecord.update(
-                    where={'id': record.id},
-                    data={'firstSeenAt': sig_time}
-                )
+                await writer.extend_dkim_record(dsp, record, firstSeenAt=sig_time)
                 return True
 
         # If signature is just after the last seen date  
         elif sig_time > record.lastSeenAt:
             logging.info(f'signature {sig.id} is just after the last seen date {record.lastSeenAt}')
             # If this signature validates with this key, then we can just update the lastSeenAt
-            if record.keyData and await validate_signature(record.keyData, sig):
+            if valid >> i & 1:
                 # If valid, update lastSeenAt
                 logging.info(f'signature {sig.id} after time period validates with key {record.keyData} found from {record.source}')
-                await prisma.dkimrecord.update(
-                    where={'id': record.id}, 
-                    data={'lastSeenAt': sig_time}
-                )
+                await writer.extend_dkim_record(dsp, record, lastSeenAt=sig_time)
                 return True
 
         # If signature is within the key period
         else:
             logging.info(f'signature {sig.id} is within the key period {record.firstSeenAt} to {record.lastSeenAt}')
             # Sanity check that the signature validates with the key
-            if record.keyData and await validate_signature(record.keyData, sig):
+            if valid >> i & 1:
                 logging.info(f'signature {sig.id} within time period validates with key {record.keyData} found from {record.source}')
             else:
                 logging.info(f'signature {sig.id} does not validate with key {record.keyData} found from {record.source}, something is wrong')
                 sys.exit(0)
     return False
 
-async def find_key_for_signature_pair(dsp: Dsp, sig1: EmailSignature, sig2: EmailSignature, prisma: Prisma):
+async def find_key_for_signature_pair(dsp: Dsp,
+                                      sig1: EmailSignature,
+                                      sig2: EmailSignature,
+                                      index: DbIndex,
+                                      writer: DbWriter,
+                                      refine_sigs: list[EmailSignature] = [],
+                                      known_keys: list[tuple[int, int]] = []):
 	info = f'dsp {dsp} and signatures {sig1.id} and {sig2.id}'
 	logging.info(f'running gcd solver for {info}')
-	checked_adjacent_sigs1 = await check_adjacent_sigs(dsp, sig1, prisma)
-	checked_adjacent_sigs2 = await check_adjacent_sigs(dsp, sig2, prisma)
+	checked_adjacent_sigs1 = await check_adjacent_sigs(dsp, sig1, index, writer)
+	checked_adjacent_sigs2 = await check_adjacent_sigs(dsp, sig2, index, writer)
 	if checked_adjacent_sigs1 or checked_adjacent_sigs2:
     # We break here with or instead of and because if we found only one, the other can't be the same so GCD will fail anyways
 		logging.info(f'found public key for sig1 or sig2 by checking adjacent sigs')
 		return
-	p = find_key(dsp, sig1, sig2, logging.INFO)
+	try:
+		p = await find_key(dsp, sig1, sig2, logging.INFO, refine_sigs, known_keys)
+	except (SolveTimeout, SolverWorkerDied) as e:
+		# not recorded as a failed pair, so it is retried on the next run (e.g. with a larger time limit)
+		logging.warning(f'gcd solver gave up on {info}: {e}')
+		return
 	if p:
-		dsp_record: DomainSelectorPair | None = await prisma.domainselectorpair.find_first(where={'domain': dsp.domain, 'selector': dsp.selector})
+		dsp_record: DomainSelectorPair | None = index.dsp_record(dsp)
 		if dsp_record is None:
-			dsp_record = await prisma.domainselectorpair.create(data={'domain': dsp.domain, 'selector': dsp.selector, 'sourceIdentifier': 'public_key_gcd_batch'})
+			dsp_record = await writer.create_dsp_record(dsp, 'public_key_gcd_batch')
 			logging.info(f'created domain/selector pair: {dsp.domain} / {dsp.selector}')
-		dkimrecord = await prisma.dkimrecord.find_first(where={'domainSelectorPairId': dsp_record.id, 'keyData': p})
+		dkimrecord = index.find_record(dsp, p)
 		if dkimrecord is None:
 			date1 = sig1.timestamp
 			date2 = sig2.timestamp
 			oldest_date, newest_date = get_date_interval(date1, date2)
-			dkimrecord = await prisma.dkimrecord.create(
-			    data={
+			dkimrecord = await writer.create_dkim_record(
+			    dsp, {
 			        'domainSelectorPairId': dsp_record.id,
 			        'firstSeenAt': oldest_date or datetime.now(),
 			        'lastSeenAt': newest_date or datetime.now(),
@@ -186,7 +216,7 @@ async def find_key_for_signature_pair(dsp: Dsp, sig1: EmailSignature, sig2: Emai
 			        'source': 'public_key_gcd_batch',
 			    })
 			logging.info(f'created dkim record: {dkimrecord}')
-		await prisma.emailpairgcdresult.create(data={
+		await writer.create_pair_result({
 		    'emailSignatureA_id': sig1.id,
 		    'emailSignatureB_id': sig2.id,
 		    'dkimRecordId': dkimrecord.id,
@@ -194,7 +224,7 @@ async def find_key_for_signature_pair(dsp: Dsp, sig1: EmailSignature, sig2: Emai
 		    'timestamp': datetime.now(),
 		})
 	else:
-		await prisma.emailpairgcdresult.create(data={
+		await writer.create_pair_result({
 		    'emailSignatureA_id': sig1.id,
 		    'emailSignatureB_id': sig2.id,
 		    'dkimRecordId': None,
@@ -202,73 +232,82 @@ async def find_key_for_signature_pair(dsp: Dsp, sig1: EmailSignature, sig2: Emai
 		    'timestamp': datetime.now(),
 		})
 
-async def check_for_matching_key_period(dsp: Dsp, sig1: EmailSignature, sig2: EmailSignature):
+async def check_for_matching_key_period(dsp: Dsp, sig1: EmailSignature, sig2: EmailSignature, key_periods: KeyPeriodIndex):
 	"""
-	Check if two email signatures' timestamps fall within known key periods from archive.prove.email.
+	Check if two email signatures' timestamps fall within known key periods.
 	
 	Args:
 			dsp (Dsp): Domain/selector pair object containing domain and selector
 			sig1 (EmailSignature): First email signature to check
 			sig2 (EmailSignature): Second email signature to check
+			key_periods (KeyPeriodIndex): Known key periods, from the DkimRecord table or archive.prove.email
 			
 	Returns:
 			bool: True if GCD calculation should proceed (no matching key period found),
 						False if matching key period was found and GCD can be skipped
 	"""
-	# Check if timestamps fall within known key periods from archive.prove.email
-	async with httpx.AsyncClient() as client:
-		response = await client.get(f"https://archive.prove.email/api/key?domain={dsp.domain}")
-		timestamp_1_covered, timestamp_2_covered = False, False
-		if response.status_code == 200:
-			keys = response.json()
-			matching_keys = [k for k in keys if k["selector"] == dsp.selector]
-					
-			for key in matching_keys:
-				logging.info(f"Checking key {key['value']}")
-				keyBase64 = decode_dkim_tag_value_list(key['value']).get('p') 
-				first_seen = datetime.fromisoformat(key["firstSeenAt"].replace("Z", "+00:00"))
-				last_seen = datetime.fromisoformat(key["lastSeenAt"].replace("Z", "+00:00"))
-				
-				# If the signature timestamp falls within the key period, validate the signature with the key and double check it matches
-				if sig1.timestamp and first_seen <= sig1.timestamp <= last_seen:
-					timestamp_1_covered = True
-					try:
-						logging.info(f"Doublechecking correct signature {sig1.id} validates with key {keyBase64}")
-						await validate_signature(key["value"], sig1)
-					except Exception as e:
-						logging.error(f"Signature validation failed: {e}")
-				if sig2.timestamp and first_seen <= sig2.timestamp <= last_seen:
-					timestamp_2_covered = True
-					try:
-						logging.info(f"Doublechecking correct signature {sig2.id} validates with key {keyBase64}")
-						await validate_signature(key["value"], sig2)
-					except Exception as e:
-						logging.error(f"Signature validation failed: {e}")
-				if timestamp_1_covered and timestamp_2_covered:
-					logging.info(f"Found matching key period for both timestamps of {dsp.domain}:{dsp.selector} " 
-											f"({first_seen} to {last_seen})")
-					# Validate signatures and exit for testing
-					try:
-						logging.info(f"Doublechecking correct signature {sig1.id} validates with key {keyBase64}")	
-						await validate_signature(key["value"], sig1)
-						logging.info(f"Doublechecking correct signature {sig2.id} validates with key {keyBase64}")
-						await validate_signature(key["value"], sig2)
-						logging.info("Signature validation successful")
-					except Exception as e:
-						logging.error(f"Signature validation failed: {e}")
-					finally:
-						logging.info("Exiting after signature validation test")
-						sys.exit(0)
-					# Skip GCD calculation since we found a valid key period
-					return False
-         
-		if not timestamp_1_covered and timestamp_2_covered:
-			logging.info(f"No matching key period found for timestamp 1 of {dsp.domain}:{dsp.selector}")
-		elif timestamp_1_covered and not timestamp_2_covered:
-			logging.info(f"No matching key period found for timestamp 2 of {dsp.domain}:{dsp.selector}")
-		elif not timestamp_1_covered and not timestamp_2_covered:
-			logging.info(f"No matching key period for either key in {dsp.domain}:{dsp.selector} from timestamps {sig1.timestamp} and {sig2.timestamp}")
-		return True
+	# Binary search for the key periods that cover each timestamp
+	periods1 = key_periods.covering(dsp, sig1.timestamp) if sig1.timestamp else []
+	periods2 = key_periods.covering(dsp, sig2.timestamp) if sig2.timestamp else []
+
+	# If the signature timestamp falls within the key period, validate the signature with the key and double check it matches
+	pairs = [(period.key_data, sig1) for period in periods1] + [(period.key_data, sig2) for period in periods2]
+	valid = await validate_signatures(pairs)
+	for i, (key_data, sig) in enumerate(pairs):
+		logging.info(f"Doublechecking correct signature {sig.id} validates with key {key_data}: {'valid' if valid >> i & 1 else 'invalid'}")
+
+	if periods1 and periods2:
+		period = periods2[0]
+		logging.info(f"Found matching key period for both timestamps of {dsp.domain}:{dsp.selector} " 
+								f"({period.first_seen} to {period.last_seen})")
+		# Check the validation of the signatures with the latest covering keys and exit for testing
+		if valid & 1 and valid >> len(periods1) & 1:
+			logging.info("Signature validation successful")
+		else:
+			logging.error(f"Signature validation failed for signature {sig1.id} or {sig2.id}")
+		logging.info("Exiting after signature validation test")
+		sys.exit(0)
+		# Skip GCD calculation since we found a valid key period
+		return False
+
+	if not periods1 and periods2:
+		logging.info(f"No matching key period found for timestamp 1 of {dsp.domain}:{dsp.selector}")
+	elif periods1 and not periods2:
+		logging.info(f"No matching key period found for timestamp 2 of {dsp.domain}:{dsp.selector}")
+	else:
+		logging.info(f"No matching key period for either key in {dsp.domain}:{dsp.selector} from timestamps {sig1.timestamp} and {sig2.timestamp}")
+	return True
+
+# Searches the consecutive signature pairs of a domain/selector pair for its keys
+async def search_dsp(dsp: Dsp,
+                     sigs: list[EmailSignature],
+                     index: DbIndex,
+                     writer: DbWriter,
+                     archive_key_api: ArchiveKeyApi | None,
+                     knownKeysByDomain: dict[str, list[tuple[int, int]]]):
+	if len(sigs) >= 2:
+		logging.info(f"running gcd solver for {dsp} and {len(sigs)} signatures")
+		if dsp.domain not in knownKeysByDomain:
+			knownKeysByDomain[dsp.domain] = index.known_key_params(dsp.domain)
+		# Sort signatures by timestamp
+		sorted_sigs = sorted(sigs, key=lambda s: s.timestamp if s.timestamp else datetime.max)
+		# Go through consecutive pairs
+		for i in range(len(sorted_sigs)-1):
+			sig1, sig2 = sorted_sigs[i], sorted_sigs[i+1]
+			# Check if the pair has already been processed
+			pairGcdResult = index.pair_result(sig1.id, sig2.id)
+			if pairGcdResult:
+				logging.info(f"EmailPairGcdResult already exists for signatures {sig1.id} and {sig2.id} at timestamp {pairGcdResult.timestamp} and success status {pairGcdResult.foundGcd}")
+				continue
+			# logging.info(f"might theoretically run gcd solver for {dsp} and timestamps {sig1.timestamp} and {sig2.timestamp}")
+			key_periods = await archive_key_api.key_periods(dsp.domain) if archive_key_api else index.key_periods
+			shouldFindMatch = await check_for_matching_key_period(dsp, sig1, sig2, key_periods)
+			if shouldFindMatch:
+				# the following signatures, then the preceding ones, are the most likely to share the key of this pair
+				refine_sigs = sorted_sigs[i + 2:i + 2 + MAX_REFINE_SIGNATURES] + sorted_sigs[max(0, i - MAX_REFINE_SIGNATURES):i][::-1]
+				await find_key_for_signature_pair(dsp, sig1, sig2, index, writer, refine_sigs, knownKeysByDomain[dsp.domain])
+	else:
+		logging.info(f"less than 2 signatures found for {dsp}")
 
 async def main():
 	logging.root.name = os.path.basename(__file__)
@@ -291,6 +330,28 @@ async def main():
 	root_logger.addHandler(console_handler)
 	root_logger.addHandler(file_handler)
 	
+	# DSP_CONCURRENCY domain/selector pairs are searched at the same time (default: 1),
+	# then the signature checks run in a process pool and the solver pool has a worker per CPU unless SOLVER_WORKERS is set
+	concurrency = int(os.environ.get('DSP_CONCURRENCY', '1'))
+
+	# the solver service is used when it is running at SOLVER_SERVICE_URL (see solver_service.py), unless USE_SOLVER_SERVICE=0
+	global solver_pool, solver_service, cpu_executor
+	if os.environ.get('USE_SOLVER_SERVICE', '1') != '0':
+		solver_service = connect_solver_service()
+	if solver_service is None:
+		# SOLVER_WORKERS processes run the solves, admitted while their estimated memory fits in SOLVER_MEMORY_BUDGET_MB (default: 75% of the RAM),
+		# a solve running longer than SOLVER_TIME_LIMIT seconds is killed
+		solver_pool = SolverPool(
+		    workers=int(os.environ['SOLVER_WORKERS']) if os.environ.get('SOLVER_WORKERS') else (1 if concurrency == 1 else None),
+		    memory_budget=int(os.environ['SOLVER_MEMORY_BUDGET_MB']) * 1024 * 1024 if os.environ.get('SOLVER_MEMORY_BUDGET_MB') else None,
+		    time_limit=float(os.environ['SOLVER_TIME_LIMIT']) if os.environ.get('SOLVER_TIME_LIMIT') else None,
+		)
+
+	if concurrency > 1:
+		# forked by a forkserver, as the dispatcher thread of the solver pool and the asyncio.to_thread calls to the solver service are already running,
+		# and a plain fork could copy a lock held by one of them
+		cpu_executor = ProcessPoolExecutor(os.cpu_count(), mp_context=multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'))
+
 	prisma = Prisma()
 	await prisma.connect()
 	domain_filter = os.environ.get('DOMAIN_FILTER') if os.environ.get('DOMAIN_FILTER') else "binance.com"
@@ -301,7 +362,7 @@ async def main():
 		email_signatures = await prisma.emailsignature.find_many()
   
 	dspToSigs: DspToSigs = {}
-	dspsWithKnownKeys: set[Dsp] = set()
+	knownKeysByDomain: dict[str, list[tuple[int, int]]] = {}
 	logging.info(f"filtering out email signatures for which we already have keys")
 	for s in email_signatures:
 		dsp = Dsp(domain=s.domain, selector=s.selector)
@@ -309,41 +370,38 @@ async def main():
 			dspToSigs[dsp] = []
 		dspToSigs[dsp].append(s)
 
+	# domain/selector pairs, DKIM records and pair results in scope, the loop below only writes to the database
+	index = await load_db_index(prisma, (dsp.domain for dsp in dspToSigs), (s.id for s in email_signatures))
+	# the key periods come from the preloaded DkimRecords, or from archive.prove.email with KEY_PERIODS_FROM_API=1
+	archive_key_api = ArchiveKeyApi() if os.environ.get('KEY_PERIODS_FROM_API') == '1' else None
+
+	# the writes of the searches go through a single writer task
+	writer = DbWriter(prisma, index)
+	remaining = iter(dspToSigs.items())
+
 	with tqdm(total=len(dspToSigs), desc="Searching for public keys within unique domain/selector pairs") as pbar:
-		for dsp, sigs in dspToSigs.items():
-			if await has_known_keys(prisma, dsp, dspsWithKnownKeys):
-				pbar.set_postfix_str(f"Keys known for {dsp.domain} {dsp.selector}")
-			else:
-				pbar.set_postfix_str(f"Searching {dsp.domain} {dsp.selector}")
-			pbar.update(1)
-			if len(sigs) >= 2:
-				logging.info(f"running gcd solver for {dsp} and {len(sigs)} signatures")
-				# Sort signatures by timestamp
-				sorted_sigs = sorted(sigs, key=lambda s: s.timestamp if s.timestamp else datetime.max)
-				# Go through consecutive pairs
-				for i in range(len(sorted_sigs)-1):
-					sig1, sig2 = sorted_sigs[i], sorted_sigs[i+1]
-					# Check if the pair has already been processed
-					pairGcdResult = await prisma.emailpairgcdresult.find_first(
-							where={'OR': [
-									{
-										'emailSignatureA_id': sig1.id,
-										'emailSignatureB_id': sig2.id
-								},
-								{
-										'emailSignatureA_id': sig2.id,
-										'emailSignatureB_id': sig1.id
-								},
-						]})
-					if pairGcdResult:
-						logging.info(f"EmailPairGcdResult already exists for signatures {sig1.id} and {sig2.id} at timestamp {pairGcdResult.timestamp} and success status {pairGcdResult.foundGcd}")
-						continue
-					# logging.info(f"might theoretically run gcd solver for {dsp} and timestamps {sig1.timestamp} and {sig2.timestamp}")
-					shouldFindMatch = await check_for_matching_key_period(dsp, sig1, sig2)
-					if shouldFindMatch:
-						await find_key_for_signature_pair(dsp, sig1, sig2, prisma)
-			else:
-				logging.info(f"less than 2 signatures found for {dsp}")
+		async def search_remaining():
+			# each of the concurrent searches takes the next domain/selector pair that is not taken yet
+			for dsp, sigs in remaining:
+				if index.dsp_record(dsp):
+					pbar.set_postfix_str(f"Keys known for {dsp.domain} {dsp.selector}")
+				else:
+					pbar.set_postfix_str(f"Searching {dsp.domain} {dsp.selector}")
+				pbar.update(1)
+				await search_dsp(dsp, sigs, index, writer, archive_key_api, knownKeysByDomain)
+		searches = [asyncio.create_task(search_remaining()) for _ in range(concurrency)]
+		try:
+			await asyncio.gather(*searches)
+		finally:
+			for search in searches:
+				search.cancel()
+			await writer.close()
+	if archive_key_api:
+		await archive_key_api.close()
+	if solver_pool:
+		solver_pool.shutdown()
+	if cpu_executor:
+		cpu_executor.shutdown()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,224 @@
+import argparse
+import logging
+import os
+import pickle
+import queue
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+import find_public_keys
+from common import Dsp, MsgInfo
+from extract_signed_data import Statistics, iter_mbox_signatures
+from find_public_keys import key_result_for, print_row, solve_pair, validates_with_key
+from pair_scheduler import parse_msg_date, scheduled_pairs
+from solve_cache import SolveCache
+from solver_pool import SolverPool
+from solver_service import connect_solver_service
+from telemetry import configure_telemetry
+
+# Extracts the signatures from mbox files and solves message pairs while the messages are still being parsed,
+# instead of waiting for a complete .datasig file. A pair is submitted as soon as a domain/selector pair has two usable messages,
+# the rows are printed in the format of find_public_keys.py as the keys are found,
+# and later messages that validate with a found key are not solved again.
+# Memory stays bounded by the per-DSP buffer of unexplained messages (unless --datasig is used).
+
+
+@dataclass
+class KeyPeriod:
+	n: int
+	e: int
+	key_result: str
+	oldest: MsgInfo
+	newest: MsgInfo
+	validated: int = 2
+
+	def add(self, msg: MsgInfo):
+		self.validated += 1
+		date = parse_msg_date(msg.date)
+		if date is None:
+			return
+		oldest_date = parse_msg_date(self.oldest.date)
+		newest_date = parse_msg_date(self.newest.date)
+		if oldest_date is None or date < oldest_date:
+			self.oldest = msg
+		if newest_date is None or date > newest_date:
+			self.newest = msg
+
+
+@dataclass
+class DspState:
+	index: int
+	# messages that do not validate with any key found so far
+	buffer: list[MsgInfo] = field(default_factory=list)
+	keys: list[KeyPeriod] = field(default_factory=list)
+	tried: set[frozenset[bytes]] = field(default_factory=set)
+	solves: int = 0
+	in_flight: bool = False
+
+
+class StreamingSolver:
+
+	def __init__(self, threads: int, loglevel: int, max_pairs: int, max_buffered: int):
+		self.executor = ThreadPoolExecutor(threads)
+		self.loglevel = loglevel
+		self.max_pairs = max_pairs
+		self.max_buffered = max_buffered
+		# the parser waits for results when this many pairs are queued or running
+		self.max_in_flight = 4 * threads
+		self.states: dict[Dsp, DspState] = {}
+		self.results: queue.Queue[tuple[Dsp, MsgInfo, MsgInfo, Future[tuple[int, int]]]] = queue.Queue()
+		self.in_flight = 0
+
+	def add_message(self, dsp: Dsp, msg: MsgInfo):
+		self.handle_results(block=False)
+		state = self.states.get(dsp)
+		if state is None:
+			state = self.states[dsp] = DspState(len(self.states))
+		for key in state.keys:
+			if validates_with_key(msg, key.n, key.e):
+				key.add(msg)
+				return
+		if any(m.signature == msg.signature for m in state.buffer):
+			return
+		state.buffer.append(msg)
+		if len(state.buffer) > self.max_buffered:
+			dropped = state.buffer.pop(0)
+			logging.debug(f'buffer for {dsp} is full, dropping message {dropped.source}')
+		self.schedule(dsp, state)
+		while self.in_flight >= self.max_in_flight:
+			self.handle_results(block=True)
+
+	def schedule(self, dsp: Dsp, state: DspState):
+		if state.in_flight or state.solves >= self.max_pairs:
+			return
+		for msg1, msg2 in scheduled_pairs(state.buffer, lambda m: False, len(state.buffer)):
+			pair = frozenset((msg1.signature, msg2.signature))
+			if pair in state.tried:
+				continue
+			state.tried.add(pair)
+			state.solves += 1
+			state.in_flight = True
+			self.in_flight += 1
+			refine_msgs = [m for m in state.buffer if m is not msg1 and m is not msg2]
+			future = self.executor.submit(solve_pair, dsp, msg1, msg2, self.loglevel, refine_msgs)
+			future.add_done_callback(lambda f, dsp=dsp, msg1=msg1, msg2=msg2: self.results.put((dsp, msg1, msg2, f)))
+			return
+
+	def handle_results(self, block: bool):
+		while self.in_flight > 0:
+			try:
+				dsp, msg1, msg2, future = self.results.get(block=block)
+			except queue.Empty:
+				return
+			block = False
+			self.in_flight -= 1
+			state = self.states[dsp]
+			state.in_flight = False
+			try:
+				n, e = future.result()
+			except Exception as ex:
+				logging.error(f'solving {dsp} failed: {ex}')
+				n, e = 0, 0
+			key_result = key_result_for(dsp, n, e)
+			print_row(state.index, dsp, key_result, msg1, msg2)
+			if n > 1 and key_result.startswith('k=rsa'):
+				key = KeyPeriod(n, e, key_result, msg1, msg2)
+				state.keys.append(key)
+				remaining: list[MsgInfo] = []
+				for msg in state.buffer:
+					if msg is msg1 or msg is msg2:
+						continue
+					if validates_with_key(msg, n, e):
+						key.add(msg)
+					else:
+						remaining.append(msg)
+				state.buffer = remaining
+			self.schedule(dsp, state)
+
+	def finish(self):
+		while self.in_flight > 0:
+			self.handle_results(block=True)
+		self.executor.shutdown()
+		# one more row per key with the oldest and newest message that validate with it, which widens the seen period of the key
+		for dsp, state in self.states.items():
+			for key in state.keys:
+				if key.validated > 2:
+					print_row(state.index, dsp, key.key_result, key.oldest, key.newest)
+
+
+class ProgramArgs(argparse.Namespace):
+	mbox_files: list[str]
+	datasig: bool
+	threads: int
+	in_process: bool
+	pair_timeout: float | None
+	memory_budget_mb: int | None
+	max_pairs_per_dsp: int
+	max_buffered_per_dsp: int
+	cache_file: str | None
+	telemetry: str | None
+	no_solver_service: bool
+	loglevel: int
+
+
+def main():
+	parser = argparse.ArgumentParser(description='extract signed data and signatures from mbox files and search for public RSA keys while the messages are parsed,\
+            the output rows are in the format of find_public_keys.py',
+	                                 allow_abbrev=False)
+	parser.add_argument('--mbox-files', help='mbox files to load', type=str, nargs='+', required=True)
+	parser.add_argument('--datasig', action='store_true', help='also save the extracted data to .mbox.datasig files, like extract_signed_data.py (keeps all messages in memory)')
+	parser.add_argument('--threads', type=int, default=1, help='number of pairs to solve at the same time')
+	parser.add_argument('--in-process', action='store_true', help='solve in warm worker processes (see solver_pool.py) instead of starting gcd_solver.py for every pair')
+	parser.add_argument('--pair-timeout', type=float, help='use together with --in-process to give up on a pair after this many seconds')
+	parser.add_argument('--memory-budget-mb', type=int, help='use together with --in-process to limit the estimated memory of the running solves (default: 75%% of the RAM)')
+	parser.add_argument('--max-pairs-per-dsp', type=int, default=2, help='maximum number of message pairs to solve per domain/selector (default: 2)')
+	parser.add_argument('--max-buffered-per-dsp',
+	                    type=int,
+	                    default=16,
+	                    help='maximum number of messages without a key to keep per domain/selector, the oldest are dropped (default: 16)')
+	parser.add_argument('--cache-file', type=str, help='SQLite file with the solver results of earlier runs, see find_public_keys.py')
+	parser.add_argument('--telemetry', type=str, help='append the stage timings of each solve attempt as JSON lines to this file, see telemetry.py')
+	parser.add_argument('--no-solver-service', action='store_true', help='do not send the pairs to the solver service of solver_service.py even if it is running')
+	parser.add_argument('--debug', action="store_const", dest="loglevel", const=logging.DEBUG, default=logging.INFO, help='enable debug logging')
+	args = parser.parse_args(namespace=ProgramArgs)
+	if args.telemetry:
+		configure_telemetry(args.telemetry)
+
+	logging.root.name = os.path.basename(__file__)
+	logging.basicConfig(level=args.loglevel, format='%(name)s: %(levelname)s: %(message)s')
+
+	if args.cache_file:
+		find_public_keys.solve_cache = SolveCache(args.cache_file)
+	if args.in_process:
+		find_public_keys.solver_pool = SolverPool(args.threads, args.memory_budget_mb * 1024 * 1024 if args.memory_budget_mb else None, args.pair_timeout)
+	elif not args.no_solver_service:
+		find_public_keys.solver_service = connect_solver_service()
+
+	solver = StreamingSolver(args.threads, args.loglevel, args.max_pairs_per_dsp, args.max_buffered_per_dsp)
+	try:
+		for mbox_file in args.mbox_files:
+			statistics = Statistics()
+			datasig_results: dict[Dsp, list[MsgInfo]] = {}
+			for dsp, msg_info in iter_mbox_signatures(mbox_file, statistics):
+				if args.datasig:
+					datasig_results.setdefault(dsp, []).append(msg_info)
+				solver.add_message(dsp, msg_info)
+			logging.info(f'statistics for {mbox_file}: {statistics}')
+			if args.datasig:
+				pickle.dump(datasig_results, open(f'{mbox_file}.datasig', 'wb'))
+				logging.info(f'results saved to {mbox_file}.datasig')
+		solver.finish()
+	except KeyboardInterrupt:
+		if find_public_keys.solver_pool:
+			logging.info('cancelling the running solves')
+			find_public_keys.solver_pool.shutdown(cancel=True)
+			find_public_keys.solver_pool = None
+		raise
+	finally:
+		if find_public_keys.solve_cache:
+			find_public_keys.solve_cache.close()
+	if find_public_keys.solver_pool:
+		find_public_keys.solver_pool.shutdown()
+
+
+if __name__ == '__main__':
+	main()
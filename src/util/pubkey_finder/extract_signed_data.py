@@ -8,6 +8,7 @@ import base64
 from common import Dsp, MsgInfo
 from lib.util import ProgressReporter
 from dataclasses import dataclass
+from typing import Iterator
 
 sys.path.insert(0, "dkimpy")
 import dkimpy.dkim as dkim
@@ -42,14 +43,13 @@ class Statistics:
 	validation_error: int = 0
 
 
-def parse_mbox_file(filepath: str) -> dict[Dsp, list[MsgInfo]]:
-	results: dict[Dsp, list[MsgInfo]] = {}
+def iter_mbox_signatures(filepath: str, statistics: Statistics) -> Iterator[tuple[Dsp, MsgInfo]]:
+	"""Yields the signed data and signature of every usable RSA DKIM-Signature in the mbox file, one message at a time"""
 	filename = os.path.basename(filepath)
 	logging.info(f'loading {filepath}')
 	mb = mailbox.mbox(filepath, create=False)
 	number_of_messages = len(mb)
 	progressReporter = ProgressReporter(number_of_messages, 0)
-	statistics = Statistics()
 	logging.info(f'processing {len(mb)} messages')
 	for message_index, message in enumerate(mb):
 		progressReporter.increment()
@@ -102,12 +102,18 @@ def parse_mbox_file(filepath: str) -> dict[Dsp, list[MsgInfo]]:
 
 			dsp = Dsp(domain, selector)
 			msg_date = message.get('Date', 'unknown')
-			msg_info = MsgInfo(signed_data, signature, f'{filename}:{message_index}', msg_date, 'dkimpy_fork')
-			if not dsp in results:
-				results[dsp] = []
-			results[dsp].append(msg_info)
 			statistics.total += 1
+			yield dsp, MsgInfo(signed_data, signature, f'{filename}:{message_index}', msg_date, 'dkimpy_fork', signAlgo)
 	logging.info(f'processed {len(mb)} messages')
+
+
+def parse_mbox_file(filepath: str) -> dict[Dsp, list[MsgInfo]]:
+	results: dict[Dsp, list[MsgInfo]] = {}
+	statistics = Statistics()
+	for dsp, msg_info in iter_mbox_signatures(filepath, statistics):
+		if not dsp in results:
+			results[dsp] = []
+		results[dsp].append(msg_info)
 	logging.info(f'statistics: {statistics}')
 	return results
 
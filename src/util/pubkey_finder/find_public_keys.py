@@ -10,12 +10,32 @@ import subprocess
 import sys
 import threading
 from Crypto.PublicKey import RSA
-from common import Dsp, MsgInfo, load_signed_data
+from common import Dsp, MsgInfo, hashfn_from_signing_algorithm, load_signed_data
+from gcd_solver import DEFAULT_EXPONENTS, MAX_REFINE_SIGNATURES, candidate_exponents, verify_signature
+from pair_scheduler import parse_msg_date, scheduled_pairs
+from solve_cache import SolveCache
+from solver_pool import SolveJob, SolverPool, SolveTimeout, SolverWorkerDied
+from solver_service import SolverServiceClient, connect_solver_service
+from telemetry import configure_telemetry
 
-dsp_queue: "queue.Queue[tuple[int, Dsp, list[tuple[MsgInfo, MsgInfo]]]]" = queue.Queue()
+dsp_queue: "queue.Queue[tuple[int, Dsp, list[MsgInfo]]]" = queue.Queue()
+
+# (modulus bits, e) of the keys found so far in this run, per domain, used to order the exponents for other selectors of the domain
+known_keys_by_domain: dict[str, list[tuple[int, int]]] = {}
+
+# results of earlier runs, set with --cache-file
+solve_cache: SolveCache | None = None
+
+# warm solver processes, set with --in-process, otherwise each pair is solved by a new gcd_solver.py process
+solver_pool: SolverPool | None = None
+
+# the resident solver of solver_service.py, used when it is running and --in-process is not given
+solver_service: SolverServiceClient | None = None
 
 
 def hexdigest(data: bytes, hashfn: str):
+	if hashfn == 'sha1':
+		return hashlib.sha1(data).hexdigest()
 	if hashfn == 'sha256':
 		return hashlib.sha256(data).hexdigest()
 	if hashfn == 'sha512':
@@ -23,33 +43,87 @@ def hexdigest(data: bytes, hashfn: str):
 	raise ValueError(f'unsupported hashfn={hashfn}')
 
 
-def call_solver_and_process_result(dsp: Dsp, msg1: MsgInfo, msg2: MsgInfo, loglevel: int) -> str:
-	logging.info(f'searching for public key for {dsp}')
+def run_solver(dsp: Dsp, hash1: str, msg1: MsgInfo, hash2: str, msg2: MsgInfo, hashfn: str, exponents: list[int], loglevel: int, refine_msgs: list[MsgInfo]) -> tuple[int, int]:
 	cmd = [
 	    "python3",
 	    "gcd_solver.py",
 	    "--loglevel",
 	    str(loglevel),
+	    "--exponents",
+	    ",".join(str(e) for e in exponents),
+	    "--domain",
+	    dsp.domain,
+	    "--selector",
+	    dsp.selector,
 	]
-	hashfn = 'sha256'
 	data_parameters = [
-	    hexdigest(msg1.signedData, hashfn),
+	    hash1,
 	    base64.b64encode(msg1.signature).decode('utf-8'),
-	    hexdigest(msg2.signedData, hashfn),
+	    hash2,
 	    base64.b64encode(msg2.signature).decode('utf-8'),
 	    hashfn,
 	]
+	refine_msgs = [m for m in refine_msgs if m.signingAlgorithm == msg1.signingAlgorithm]
+	for msg in refine_msgs[:MAX_REFINE_SIGNATURES]:
+		data_parameters += ['--refine', hexdigest(msg.signedData, hashfn), base64.b64encode(msg.signature).decode('utf-8')]
 	logging.debug(" ".join(cmd) + ' [... data parameters ...]')
 
 	output = subprocess.check_output(cmd + data_parameters)
 	data = json.loads(output)
-	n = int(data['n_hex'], 16)
-	e = int(data['e_hex'], 16)
+	return int(data['n_hex'], 16), int(data['e_hex'], 16)
+
+
+def make_solve_job(dsp: Dsp, hash1: str, msg1: MsgInfo, hash2: str, msg2: MsgInfo, hashfn: str, exponents: list[int], refine_msgs: list[MsgInfo]) -> SolveJob:
+	refine_msgs = [m for m in refine_msgs if m.signingAlgorithm == msg1.signingAlgorithm][:MAX_REFINE_SIGNATURES]
+	return SolveJob([hash1, hash2], [msg1.signature, msg2.signature],
+	                hashfn,
+	                refine_hashes_hex=[hexdigest(m.signedData, hashfn) for m in refine_msgs],
+	                refine_signatures=[m.signature for m in refine_msgs],
+	                exponents=exponents,
+	                domain=dsp.domain,
+	                selector=dsp.selector)
+
+
+def solve_pair(dsp: Dsp, msg1: MsgInfo, msg2: MsgInfo, loglevel: int, refine_msgs: list[MsgInfo] = []) -> tuple[int, int]:
+	"""Returns (n, e) of the key of the pair, n < 2 if no key was found"""
+	logging.info(f'searching for public key for {dsp}')
+	if msg1.signingAlgorithm != msg2.signingAlgorithm:
+		logging.info(f'signing algorithm mismatch for {dsp}: {msg1.signingAlgorithm} vs {msg2.signingAlgorithm}')
+		return 0, 0
+	hashfn = hashfn_from_signing_algorithm(msg1.signingAlgorithm)
+	exponents = candidate_exponents(len(msg1.signature), hashfn, DEFAULT_EXPONENTS, known_keys_by_domain.get(dsp.domain, []))
+	if not exponents:
+		logging.info(f'no candidate exponents for {dsp} with {hashfn} and {len(msg1.signature)} byte signatures')
+		return 0, 0
+	hash1 = hexdigest(msg1.signedData, hashfn)
+	hash2 = hexdigest(msg2.signedData, hashfn)
+	job = make_solve_job(dsp, hash1, msg1, hash2, msg2, hashfn, exponents, refine_msgs)
+	digest = job.cache_digest()
+	cached = solve_cache.get(digest) if solve_cache else None
+	if cached is not None:
+		logging.info(f'using cached solver result for {dsp}')
+		return cached
+	if solver_pool or solver_service:
+		try:
+			n, e = solver_pool.submit(job).result() if solver_pool else solver_service.solve(job)  # type: ignore
+		except (SolveTimeout, SolverWorkerDied) as e:
+			# not cached, so the pair is tried again on the next run
+			logging.warning(f'solver gave up on {dsp}: {e}')
+			return 0, 0
+	else:
+		n, e = run_solver(dsp, hash1, msg1, hash2, msg2, hashfn, exponents, loglevel, refine_msgs)
+	if solve_cache:
+		solve_cache.put(digest, n, e)
+	return n, e
+
+
+def key_result_for(dsp: Dsp, n: int, e: int) -> str:
 	if (n < 2):
 		logging.info(f'no public key found for {dsp}')
 		return '-'
 	try:
 		logging.info(f'found public key for {dsp}')
+		known_keys_by_domain.setdefault(dsp.domain, []).append((n.bit_length(), e))
 		rsa_key = RSA.construct((n, e))
 		keyDER = rsa_key.exportKey(format='DER')
 		keyDER_base64 = binascii.b2a_base64(keyDER, newline=False).decode('utf-8')
@@ -59,15 +133,47 @@ def call_solver_and_process_result(dsp: Dsp, msg1: MsgInfo, msg2: MsgInfo, logle
 		return f'ValueError: {e}'
 
 
-def read_and_resolve_worker(loglevel: int):
+def validates_with_key(msg: MsgInfo, n: int, e: int) -> bool:
+	try:
+		hashfn = hashfn_from_signing_algorithm(msg.signingAlgorithm)
+	except ValueError:
+		return False
+	return verify_signature(n, e, hexdigest(msg.signedData, hashfn), msg.signature, hashfn)
+
+
+def print_row(dsp_index: int, dsp: Dsp, key_result: str, msg1: MsgInfo, msg2: MsgInfo):
+	row_values = [str(dsp_index).zfill(4), dsp.domain, dsp.selector, key_result, msg1.source, msg2.source, msg1.date, msg2.date]
+	print("\t".join(row_values))
+	sys.stdout.flush()
+
+
+def solve_dsp(dsp_index: int, dsp: Dsp, msg_infos: list[MsgInfo], loglevel: int, max_pairs: int):
+	# signatures that validate with a key recovered for this dsp, their messages are not paired again
+	explained: set[bytes] = set()
+	for msg1, msg2 in scheduled_pairs(msg_infos, lambda m: m.signature in explained, max_pairs):
+		refine_msgs = [m for m in msg_infos if m is not msg1 and m is not msg2 and m.signature not in explained]
+		n, e = solve_pair(dsp, msg1, msg2, loglevel, refine_msgs)
+		key_result = key_result_for(dsp, n, e)
+		print_row(dsp_index, dsp, key_result, msg1, msg2)
+		if n < 2 or not key_result.startswith('k=rsa'):
+			continue
+		validated = [m for m in msg_infos if m.signature not in explained and validates_with_key(m, n, e)]
+		explained.update(m.signature for m in validated)
+		logging.info(f'key for {dsp} validates {len(validated)} of {len(msg_infos)} signatures')
+		if len(validated) > 2:
+			# one more row with the oldest and newest message that validate with the key, which widens the seen period of the key
+			dated = [(date, m) for m in validated if (date := parse_msg_date(m.date))]
+			if dated:
+				oldest = min(dated, key=lambda d: d[0])[1]
+				newest = max(dated, key=lambda d: d[0])[1]
+				print_row(dsp_index, dsp, key_result, oldest, newest)
+
+
+def read_and_resolve_worker(loglevel: int, max_pairs: int):
 	while True:
 		logging.info(f'DSPs left: {dsp_queue.qsize()}')
-		dsp_index, dsp, msg_pairs = dsp_queue.get()
-		for msg1, msg2 in msg_pairs:
-			key_result = call_solver_and_process_result(dsp, msg1, msg2, loglevel)
-			row_values = [str(dsp_index).zfill(4), dsp.domain, dsp.selector, key_result, msg1.source, msg2.source, msg1.date, msg2.date]
-			print("\t".join(row_values))
-			sys.stdout.flush()
+		dsp_index, dsp, msg_infos = dsp_queue.get()
+		solve_dsp(dsp_index, dsp, msg_infos, loglevel, max_pairs)
 		dsp_queue.task_done()
 
 
@@ -79,21 +185,16 @@ def include_dsp(dsp: Dsp) -> bool:
 	return True
 
 
-def solve_msg_pairs(signed_messages: dict[Dsp, list[MsgInfo]], threads: int, loglevel: int, sparse_nth: int):
+def solve_msg_pairs(signed_messages: dict[Dsp, list[MsgInfo]], threads: int, loglevel: int, sparse_nth: int, max_pairs: int = 2):
 	msg_list = list(signed_messages.items())
 	if sparse_nth > 1:
 		msg_list = msg_list[::sparse_nth]
-	logging.info(f'searching for public key for {len(msg_list)} message pairs')
+	logging.info(f'searching for public key for {len(msg_list)} domain/selector pairs')
 	for i, (dsp, msg_infos) in enumerate(msg_list):
-		if len(msg_infos) == 2:
-			dsp_queue.put((i, dsp, [(msg_infos[0], msg_infos[1])]))
-		elif len(msg_infos) == 3:
-			dsp_queue.put((i, dsp, [(msg_infos[0], msg_infos[1]), (msg_infos[1], msg_infos[2])]))
-		elif len(msg_infos) >= 4:
-			dsp_queue.put((i, dsp, [(msg_infos[0], msg_infos[1]), (msg_infos[2], msg_infos[3])]))
+		dsp_queue.put((i, dsp, msg_infos))
 	logging.info(f'starting {threads} threads')
 	for _i in range(threads):
-		t_in = threading.Thread(target=read_and_resolve_worker, daemon=True, args=(loglevel, ))
+		t_in = threading.Thread(target=read_and_resolve_worker, daemon=True, args=(loglevel, max_pairs))
 		t_in.start()
 	dsp_queue.join()
 
@@ -106,6 +207,15 @@ class ProgramArgs(argparse.Namespace):
 	threads: int
 	sparse_nth: int
 	display_signed_text: bool
+	telemetry: str | None
+	cache_file: str | None
+	cache_max_age_days: float | None
+	cache_max_entries: int | None
+	in_process: bool
+	pair_timeout: float | None
+	memory_budget_mb: int | None
+	max_pairs_per_dsp: int
+	no_solver_service: bool
 
 
 def main():
@@ -120,7 +230,23 @@ def main():
 	parser.add_argument('--filter-domain', help='only process messages with this domain', type=str)
 	parser.add_argument('--debug', action="store_const", dest="loglevel", const=logging.DEBUG, default=logging.INFO, help='enable debug logging')
 	parser.add_argument('--threads', type=int, default=1, help='number of threads to use for solving')
+	parser.add_argument('--max-pairs-per-dsp',
+	                    type=int,
+	                    default=2,
+	                    help='maximum number of message pairs to solve per domain/selector, pairs with messages that validate with an already recovered key are skipped (default: 2)')
+	parser.add_argument('--telemetry', type=str, help='append the stage timings of each solve attempt as JSON lines to this file, see telemetry.py')
+	parser.add_argument('--cache-file', type=str, help='SQLite file with the solver results of earlier runs, pairs found there are not solved again')
+	parser.add_argument('--cache-max-age-days', type=float, help='use together with --cache-file to drop and ignore cached results older than this')
+	parser.add_argument('--cache-max-entries', type=int, help='use together with --cache-file to keep at most this many results, dropping the least recently used')
+	parser.add_argument('--in-process',
+	                    action='store_true',
+	                    help='solve in --threads warm worker processes (see solver_pool.py) instead of starting gcd_solver.py for every pair')
+	parser.add_argument('--pair-timeout', type=float, help='use together with --in-process to give up on a pair after this many seconds')
+	parser.add_argument('--memory-budget-mb', type=int, help='use together with --in-process to limit the estimated memory of the running solves (default: 75%% of the RAM)')
+	parser.add_argument('--no-solver-service', action='store_true', help='do not send the pairs to the solver service of solver_service.py even if it is running')
 	args = parser.parse_args(namespace=ProgramArgs)
+	if args.telemetry:
+		configure_telemetry(args.telemetry)
 
 	logging.root.name = os.path.basename(__file__)
 	logging.basicConfig(level=args.loglevel, format='%(name)s: %(levelname)s: %(message)s')
@@ -141,7 +267,27 @@ def main():
 				print(msg_info.signedData.decode('utf-8'))
 				print()
 		return
-	solve_msg_pairs(signed_data, args.threads, args.loglevel, args.sparse_nth)
+	global solve_cache
+	if args.cache_file:
+		solve_cache = SolveCache(args.cache_file, args.cache_max_age_days, args.cache_max_entries)
+	global solver_pool, solver_service
+	if args.in_process:
+		solver_pool = SolverPool(args.threads, args.memory_budget_mb * 1024 * 1024 if args.memory_budget_mb else None, args.pair_timeout)
+	elif not args.no_solver_service:
+		solver_service = connect_solver_service()
+	try:
+		solve_msg_pairs(signed_data, args.threads, args.loglevel, args.sparse_nth, args.max_pairs_per_dsp)
+	except KeyboardInterrupt:
+		if solver_pool:
+			logging.info('cancelling the running solves')
+			solver_pool.shutdown(cancel=True)
+			solver_pool = None
+		raise
+	finally:
+		if solve_cache:
+			solve_cache.close()
+	if solver_pool:
+		solver_pool.shutdown()
 
 
 if __name__ == '__main__':
@@ -4,25 +4,41 @@ import logging
 import os
 import time
 from typing import Any
-from common import first_n_primes
+from pkcs1 import HASH_OIDS, padding_fits, pkcs1_padding
+from smooth_part import DEFAULT_NUM_PRIMES, remove_smooth_part
+from telemetry import OUTCOME_FOUND, OUTCOME_NO_GCD, OUTCOME_OVERSIZED, SolveRecord, configure_telemetry, record_solve
 import gmpy2  # type: ignore
 
 gmpy2_mpz: Any = gmpy2.mpz  # type: ignore
 gmpy2_gcd: Any = gmpy2.gcd  # type: ignore
+gmpy2_powmod: Any = gmpy2.powmod  # type: ignore
 
-# https://blog.ploetzli.ch/2018/calculating-an-rsa-public-key-from-two-signatures/
+# 'full' builds s**e - m for every signature and takes one gcd over all of them.
+# 'reduced' only builds full terms until the running gcd is small, and reduces the remaining
+# signatures modulo that gcd with powmod, so at most two full terms are alive at the same time.
+# With two signatures both modes build both full terms, 'reduced' only saves memory and time from the third signature on.
+SOLVE_MODES = ['reduced', 'full']
+
+# public exponents tried by find_n, in order
+DEFAULT_EXPONENTS = [0x10001, 3, 17]
 
+# how many extra signatures from the same domain/selector pair callers pass to find_n for refining oversized candidates
+MAX_REFINE_SIGNATURES = 4
 
-def pkcs1_padding(size_bytes: int, hash_hex: str, hashfn: str):
-	oid = {'sha256': '608648016503040201', 'sha512': '608648016503040203'}[hashfn]
-	result = '06' + ("%02X" % (len(oid) // 2)) + oid + '05' + '00'
-	result = '30' + ("%02X" % (len(result) // 2)) + result
+# https://blog.ploetzli.ch/2018/calculating-an-rsa-public-key-from-two-signatures/
 
-	result = result + '04' + ("%02X" % (len(hash_hex) // 2)) + hash_hex
-	result = '30' + ("%02X" % (len(result) // 2)) + result
 
-	result = '0001' + ('ff' * int(size_bytes - 3 - len(result) / 2)) + '00' + result
-	return result
+def candidate_exponents(size_bytes: int, hashfn: str, exponents: list[int], known_keys: list[tuple[int, int]] = []) -> list[int]:
+	"""Drops the hash/exponent combinations that cannot produce a key, and orders the remaining exponents so that the ones
+	already used by known keys of the domain (given as (modulus bits, e)) are tried first, preferring keys of the same size"""
+	if not padding_fits(size_bytes, hashfn):
+		logging.info(f'{hashfn} digest does not fit in a {size_bytes} byte signature')
+		return []
+	# RSA public exponents are odd and > 1, since gcd(e, (p-1)(q-1)) must be 1
+	feasible = [e for e in exponents if e > 1 and e % 2 == 1]
+	same_size_exponents = {e for (bits, e) in known_keys if (bits + 7) // 8 == size_bytes}
+	known_exponents = {e for (_bits, e) in known_keys}
+	return sorted(feasible, key=lambda e: (e not in same_size_exponents, e not in known_exponents, exponents.index(e)))
 
 
 def message_sig_pair(size_bytes: int, hash_hex: str, signature: bytes, hashfn: str) -> tuple[Any, Any]:
@@ -31,15 +47,152 @@ def message_sig_pair(size_bytes: int, hash_hex: str, signature: bytes, hashfn: s
 	return (message, signature)
 
 
-def remove_small_prime_factors(n: Any):
-	for p in first_n_primes(1500):
-		while n % p == 0:
-			logging.debug(f'removing small prime factor {p}')
-			n = n // p
+def verify_signature(n: int, e: int, hash_hex: str, signature: bytes, hashfn: str) -> bool:
+	# checks the signature against a recovered key, without building a key object
+	if len(signature) != (n.bit_length() + 7) // 8:
+		return False
+	message, sig = message_sig_pair(len(signature), hash_hex, signature, hashfn)
+	return gmpy2_powmod(sig, e, n) == message
+
+
+def remove_small_prime_factors(n: Any, num_primes: int = DEFAULT_NUM_PRIMES):
+	return remove_smooth_part(n, num_primes)
+
+
+class PowerLadder:
+	"""Computes base**e for all candidate exponents with one shared squaring chain.
+	For example s**3 and s**17 are products of squares that s**65537 needs anyway (s**2, s**16),
+	so the fallback exponents cost a multiplication or two instead of a new exponentiation.
+	The chain is only extended as far as the requested exponent needs."""
+
+	def __init__(self, base: Any, exponents: list[int]):
+		self.base = base
+		self.pending = set(exponents)
+		self.needed_bits = {k for e in exponents for k in range(e.bit_length()) if (e >> k) & 1}
+		self.squares: dict[int, Any] = {}
+		self.square: Any = base
+		self.top_bit = 0
+		# cumulative cpu time spent on the chain up to each bit
+		self.chain_times: list[float] = [0.0]
+		self.saved_time = 0.0
+		if 0 in self.needed_bits:
+			self.squares[0] = base
+
+	def extend_chain(self, top_bit: int):
+		while self.top_bit < top_bit:
+			start_time = time.process_time()
+			self.square = self.square * self.square
+			self.top_bit += 1
+			self.chain_times.append(self.chain_times[-1] + time.process_time() - start_time)
+			if self.top_bit in self.needed_bits:
+				self.squares[self.top_bit] = self.square
+
+	def power(self, e: int) -> Any:
+		if e not in self.pending:
+			return self.base**e
+		if e.bit_length() - 1 > self.top_bit:
+			self.extend_chain(e.bit_length() - 1)
+			# the chain was extended for this exponent, so it paid the same as a plain exponentiation
+			reused = False
+		else:
+			reused = True
+		start_time = time.process_time()
+		result = gmpy2_mpz(1)
+		for k in range(e.bit_length()):
+			if (e >> k) & 1:
+				result = result * self.squares[k]
+		combine_time = time.process_time() - start_time
+		if reused:
+			self.saved_time += max(0.0, self.chain_times[e.bit_length() - 1] - combine_time)
+		self.release(e)
+		return result
+
+	def release(self, e: int):
+		"""Drops the squares that no pending exponent needs, the large ones are as big as a full gcd term"""
+		self.pending.discard(e)
+		self.needed_bits = {k for p in self.pending for k in range(p.bit_length()) if (p >> k) & 1}
+		for k in [k for k in self.squares if k not in self.needed_bits]:
+			del self.squares[k]
+		if not any(p.bit_length() - 1 > self.top_bit for p in self.pending):
+			self.square = None
+
+
+def gcd_of_terms(pairs: list[tuple[Any, Any]], ladders: list[PowerLadder], e: int, mode: str) -> tuple[Any, float, float, list[int]]:
+	"""Returns the gcd of s**e - m over all (m, s) pairs, the exponentiation and gcd cpu times and the bit lengths of the full terms"""
+	if mode == 'full':
+		start_time = time.process_time()
+		gcd_input = [(ladder.power(e) - m) for (m, _s), ladder in zip(pairs, ladders)]
+		exp_time = time.process_time() - start_time
+		start_time = time.process_time()
+		n: Any = gmpy2_gcd(*gcd_input)
+		return n, exp_time, time.process_time() - start_time, [t.bit_length() for t in gcd_input]
+
+	if mode != 'reduced':
+		raise ValueError(f'unsupported mode={mode}')
+	start_time = time.process_time()
+	m0, _s0 = pairs[0]
+	n = ladders[0].power(e) - m0
+	exp_time = time.process_time() - start_time
+	full_term_bits = n.bit_length()
+	term_bits = [full_term_bits]
+	gcd_time = 0.0
+	for (m, s), ladder in zip(pairs[1:], ladders[1:]):
+		start_time = time.process_time()
+		if n.bit_length() < full_term_bits:
+			# n is already a (small) divisor of the first term, reducing modulo n is almost free
+			term = gmpy2_powmod(s, e, n) - m
+		else:
+			# powmod modulo a full term is much slower than plain exponentiation, since every step is done at full size
+			term = ladder.power(e) - m
+		exp_time += time.process_time() - start_time
+		term_bits.append(term.bit_length())
+		start_time = time.process_time()
+		n = gmpy2_gcd(n, term)
+		gcd_time += time.process_time() - start_time
+		del term
+	return n, exp_time, gcd_time, term_bits
+
+
+def refine_n(n: Any, e: int, refine_pairs: list[tuple[Any, Any]], size_bytes: int) -> Any:
+	"""Shrinks a candidate that is larger than the modulus with gcd(n, powmod(s, e, n) - m) for extra signatures of the same key.
+	Signatures that would reduce the candidate below the modulus size are assumed to be made with another key and are skipped."""
+	modulus_bits = 8 * size_bytes
+	for (m, s) in refine_pairs:
+		if n.bit_length() <= modulus_bits:
+			break
+		candidate = remove_small_prime_factors(gmpy2_gcd(n, gmpy2_powmod(s, e, n) - m))
+		if candidate.bit_length() <= modulus_bits - 8:
+			logging.debug(f'refinement signature does not match candidate ({candidate.bit_length()} bits), skipping it')
+			continue
+		logging.info(f'refined candidate from {n.bit_length()} to {candidate.bit_length()} bits')
+		n = candidate
 	return n
 
 
-def find_n(message_hashes_hex: list[str], signatures: list[bytes], hashfn: str) -> tuple[int, int]:
+def log_ladder_savings(ladders: list[PowerLadder]):
+	saved_time = sum(ladder.saved_time for ladder in ladders)
+	if saved_time > 0:
+		logging.info(f'shared exponent ladder saved cpu time={saved_time} for this pair')
+
+
+def find_n(message_hashes_hex: list[str],
+           signatures: list[bytes],
+           hashfn: str,
+           mode: str = 'reduced',
+           refine_hashes_hex: list[str] | None = None,
+           refine_signatures: list[bytes] | None = None,
+           exponents: list[int] | None = None,
+           known_keys: list[tuple[int, int]] | None = None,
+           domain: str | None = None,
+           selector: str | None = None) -> tuple[int, int]:
+	"""Finds the RSA modulus n and public exponent e from signatures made with the same key, trying the candidate exponents in order.
+	hashfn must match the a= tag of the signatures. known_keys are (modulus bits, e) of keys already known for the domain,
+	used to order the exponents, see candidate_exponents.
+	If the gcd is still larger than the modulus, the optional refine_* signatures (from the same domain/selector pair)
+	are used to reduce it cheaply instead of giving up.
+	domain and selector are only used to label the telemetry records, see telemetry.py.
+	mode 'reduced' holds fewer full-size terms than 'full' only with 3 or more signatures: the second term is built at full size in both modes,
+	since powmod modulo the first full term gives a term of the same size and is much slower than the exponentiation."""
 	size_bytes = len(signatures[0])
 	if any(len(s) != size_bytes for s in signatures):
 		logging.error(f"all signature sizes must be identical")
@@ -49,26 +202,56 @@ def find_n(message_hashes_hex: list[str], signatures: list[bytes], hashfn: str)
 		logging.error(f"duplicate signatures found")
 		return 0, 0
 
+	exponents = candidate_exponents(size_bytes, hashfn, exponents or DEFAULT_EXPONENTS, known_keys or [])
+	if not exponents:
+		logging.info(f'no candidate exponents for hashfn={hashfn} and {size_bytes} byte signatures')
+		return 0, 0
+	refine_inputs = list(zip(refine_hashes_hex or [], refine_signatures or []))
+	refine_inputs = [(m, s) for (m, s) in refine_inputs if len(s) == size_bytes and s not in signatures]
+
 	if True:
 		pairs = [message_sig_pair(size_bytes, m, s, hashfn) for (m, s) in zip(message_hashes_hex, signatures)]
-		for e in [0x10001, 3, 17]:
-			logging.debug(f'solving for hashfn={hashfn}, e={e}')
-			gcd_input = [(s**e - m) for (m, s) in pairs]
+		refine_pairs = [message_sig_pair(size_bytes, m, s, hashfn) for (m, s) in refine_inputs]
+		ladders = [PowerLadder(s, exponents) for (_m, s) in pairs]
+		for e in exponents:
+			logging.debug(f'solving for hashfn={hashfn}, e={e}, mode={mode}')
+			n, exp_time, gcd_time, term_bits = gcd_of_terms(pairs, ladders, e, mode)
+			logging.info(f'gcd cpu time={gcd_time} and n bits={n.bit_length()} and size of inputs in gcd_input={tuple(term_bits)}')
+			record = SolveRecord(domain, selector, size_bytes, len(signatures), hashfn, mode, e, exp_time, gcd_time, 0.0, 0.0, max(term_bits), 0, OUTCOME_NO_GCD)
 
-			start_time = time.process_time()
-			n: Any = gmpy2_gcd(*gcd_input)
-			logging.info(f'gcd cpu time={time.process_time() - start_time} and n bits={n.bit_length()} and size of inputs in gcd_input={gcd_input[0].bit_length(), gcd_input[1].bit_length()}')
+			if n.bit_length() > 10000 and refine_pairs:
+				start_time = time.process_time()
+				n = refine_n(n, e, refine_pairs, size_bytes)
+				record.refine_cpu += time.process_time() - start_time
 
 			if n.bit_length() > 10000:
 				logging.error(f'skip n with > 10000 bits')
+				record.result_bits = n.bit_length()
+				record.outcome = OUTCOME_OVERSIZED
+				record_solve(record)
 				continue
 
+			start_time = time.process_time()
 			n = remove_small_prime_factors(n)
+			record.smooth_part_cpu = time.process_time() - start_time
 			logging.debug(f'result n=({n.bit_length()} bit number)')
 
+			if n.bit_length() > 8 * size_bytes and refine_pairs:
+				start_time = time.process_time()
+				n = refine_n(n, e, refine_pairs, size_bytes)
+				record.refine_cpu += time.process_time() - start_time
+			if n.bit_length() > 8 * size_bytes:
+				logging.warning(f'result n has {n.bit_length()} bits, which is more than the signature size of {8 * size_bytes} bits')
+
+			record.result_bits = n.bit_length()
 			if n > 1:
 				logging.info(f'found gcd for hashfn={hashfn}, e={e}, n={n}')
+				record.outcome = OUTCOME_FOUND if n.bit_length() <= 8 * size_bytes else OUTCOME_OVERSIZED
+				record_solve(record)
+				log_ladder_savings(ladders)
 				return (int(n), int(e))
+			record_solve(record)
+	log_ladder_savings(ladders)
 	return 0, 0
 
 
@@ -79,9 +262,25 @@ if __name__ == '__main__':
 	parser.add_argument('signature1_base64')
 	parser.add_argument('msg2_hash_hex')
 	parser.add_argument('signature2_base64')
-	parser.add_argument('hashfn', choices=['sha256', 'sha512'])
+	parser.add_argument('hashfn', choices=list(HASH_OIDS.keys()))
+	parser.add_argument('--mode', choices=SOLVE_MODES, default='reduced')
+	parser.add_argument('--exponents',
+	                    type=lambda s: [int(e, 0) for e in s.split(',')],
+	                    default=DEFAULT_EXPONENTS,
+	                    help='comma separated list of public exponents to try, in order (default: 0x10001,3,17)')
+	parser.add_argument('--refine',
+	                    nargs=2,
+	                    action='append',
+	                    default=[],
+	                    metavar=('MSG_HASH_HEX', 'SIGNATURE_BASE64'),
+	                    help='extra message hash and signature from the same domain/selector, used to refine a candidate that is larger than the modulus')
+	parser.add_argument('--domain', help='domain of the signatures, for the telemetry records')
+	parser.add_argument('--selector', help='selector of the signatures, for the telemetry records')
+	parser.add_argument('--telemetry', help='append a JSON line with the stage timings of each solve attempt to this file (default: $GCD_SOLVER_TELEMETRY)')
 	parser.add_argument('--loglevel', type=int, default=logging.INFO)
 	args = parser.parse_args()
+	if args.telemetry:
+		configure_telemetry(args.telemetry)
 	msg1_hash_hex = args.msg1_hash_hex
 	msg2_hash_hex = args.msg2_hash_hex
 	signature1 = binascii.a2b_base64(args.signature1_base64)
@@ -89,5 +288,7 @@ if __name__ == '__main__':
 	hashfn = args.hashfn
 	logging.root.name = os.path.basename(__file__)
 	logging.basicConfig(level=args.loglevel, format='%(name)s: %(levelname)s: %(message)s')
-	n, e = find_n([msg1_hash_hex, msg2_hash_hex], [signature1, signature2], hashfn)
+	refine_hashes_hex = [m for (m, _s) in args.refine]
+	refine_signatures = [binascii.a2b_base64(s) for (_m, s) in args.refine]
+	n, e = find_n([msg1_hash_hex, msg2_hash_hex], [signature1, signature2], hashfn, args.mode, refine_hashes_hex, refine_signatures, args.exponents, domain=args.domain, selector=args.selector)
 	print(json.dumps({'n_hex': hex(n), 'e_hex': hex(e)}))
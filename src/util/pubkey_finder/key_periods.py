@@ -0,0 +1,109 @@
+import asyncio
+import bisect
+import logging
+import os
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Iterable
+import httpx
+from common import Dsp
+from src.util.dkim_util import decode_dkim_tag_value_list
+
+# Validity periods [firstSeenAt, lastSeenAt] of the known keys per domain/selector pair, sorted by start,
+# so that finding the keys whose period covers a timestamp is a binary search instead of a scan over all keys of the domain.
+# Built from the preloaded DkimRecords (see db_index.py), or fetched per domain from the archive API with one pooled client.
+
+ARCHIVE_KEY_API_URL = 'https://archive.prove.email/api/key'
+
+
+@dataclass
+class KeyPeriod:
+	first_seen: datetime
+	last_seen: datetime
+	# the base64 key, the p= tag of the DKIM record
+	key_data: str | None
+
+
+class KeyPeriodIndex:
+
+	def __init__(self):
+		self.periods: dict[Dsp, list[KeyPeriod]] = {}
+		self.starts: dict[Dsp, list[datetime]] = {}
+		# the latest last_seen among the periods up to each position, to stop the backwards scan early
+		self.max_ends: dict[Dsp, list[datetime]] = {}
+
+	def set_periods(self, dsp: Dsp, periods: Iterable[KeyPeriod]):
+		periods = sorted(periods, key=lambda p: p.first_seen)
+		self.periods[dsp] = periods
+		self.starts[dsp] = [p.first_seen for p in periods]
+		max_ends: list[datetime] = []
+		for p in periods:
+			max_ends.append(p.last_seen if not max_ends or p.last_seen > max_ends[-1] else max_ends[-1])
+		self.max_ends[dsp] = max_ends
+
+	def covering(self, dsp: Dsp, timestamp: datetime) -> list[KeyPeriod]:
+		"""The periods of the pair that contain the timestamp, latest start first"""
+		periods = self.periods.get(dsp)
+		if not periods:
+			return []
+		max_ends = self.max_ends[dsp]
+		result: list[KeyPeriod] = []
+		# periods starting at or before the timestamp, scanned back while one of them can still end after it
+		i = bisect.bisect_right(self.starts[dsp], timestamp) - 1
+		while i >= 0 and max_ends[i] >= timestamp:
+			if periods[i].last_seen >= timestamp:
+				result.append(periods[i])
+			i -= 1
+		return result
+
+	def remove_domain(self, domain: str):
+		for dsp in [dsp for dsp in self.periods if dsp.domain == domain]:
+			del self.periods[dsp]
+			del self.starts[dsp]
+			del self.max_ends[dsp]
+
+
+def parse_api_date(value: str) -> datetime:
+	return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+class ArchiveKeyApi:
+	"""Key periods from the archive API, fetched once per domain and kept for ttl seconds, over one pooled client"""
+
+	def __init__(self, ttl: float | None = None, url: str = ARCHIVE_KEY_API_URL):
+		self.ttl = ttl if ttl is not None else float(os.environ.get('ARCHIVE_KEY_API_TTL', '3600'))
+		self.url = url
+		self.client = httpx.AsyncClient(timeout=30, limits=httpx.Limits(max_keepalive_connections=10))
+		self.index = KeyPeriodIndex()
+		self.fetched_at: dict[str, float] = {}
+		# one fetch per domain at a time, when domain/selector pairs of the same domain are searched concurrently
+		self.locks: dict[str, asyncio.Lock] = {}
+
+	async def key_periods(self, domain: str) -> KeyPeriodIndex:
+		"""The index, with the keys of the domain fetched if they are not cached or older than the ttl"""
+		async with self.locks.setdefault(domain, asyncio.Lock()):
+			return await self.fetch(domain)
+
+	async def fetch(self, domain: str) -> KeyPeriodIndex:
+		fetched_at = self.fetched_at.get(domain)
+		if fetched_at is not None and time.monotonic() - fetched_at < self.ttl:
+			return self.index
+		response = await self.client.get(self.url, params={'domain': domain})
+		if response.status_code != 200:
+			logging.warning(f'archive key API returned status {response.status_code} for {domain}')
+			return self.index
+		by_dsp: dict[Dsp, list[KeyPeriod]] = {}
+		for key in response.json():
+			first_seen = parse_api_date(key['firstSeenAt'])
+			last_seen = parse_api_date(key['lastSeenAt']) if key.get('lastSeenAt') else first_seen
+			key_data = decode_dkim_tag_value_list(key['value']).get('p')
+			by_dsp.setdefault(Dsp(domain, key['selector']), []).append(KeyPeriod(first_seen, last_seen, key_data))
+		self.index.remove_domain(domain)
+		for dsp, periods in by_dsp.items():
+			self.index.set_periods(dsp, periods)
+		self.fetched_at[domain] = time.monotonic()
+		return self.index
+
+	async def close(self):
+		await self.client.aclose()
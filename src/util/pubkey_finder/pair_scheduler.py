@@ -0,0 +1,64 @@
+import logging
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Callable, Iterator
+from common import MsgInfo
+
+# Chooses which message pairs of a domain/selector pair to solve, so that fewer gcds are spent per recovered key:
+# only messages with signatures of the same length and algorithm are paired, duplicate signatures are dropped,
+# and messages close in date (likely signed with the same key) are paired first.
+# Messages already explained by a recovered key are not paired again.
+
+
+def parse_msg_date(date: str) -> datetime | None:
+	try:
+		parsed = parsedate_to_datetime(date)
+	except (TypeError, ValueError, IndexError):
+		return None
+	if parsed.tzinfo is None:
+		parsed = parsed.replace(tzinfo=timezone.utc)
+	return parsed
+
+
+def group_messages(msg_infos: list[MsgInfo]) -> list[list[MsgInfo]]:
+	"""Drops duplicate signatures and groups the messages by signature length and signing algorithm.
+	Each group is sorted by date (undated messages last), the largest groups come first."""
+	seen: set[bytes] = set()
+	groups: dict[tuple[int, str], list[MsgInfo]] = {}
+	for msg in msg_infos:
+		if msg.signature in seen:
+			continue
+		seen.add(msg.signature)
+		groups.setdefault((len(msg.signature), msg.signingAlgorithm.lower()), []).append(msg)
+	if len(seen) < len(msg_infos):
+		logging.debug(f'dropped {len(msg_infos) - len(seen)} duplicate signatures')
+	max_date = datetime.max.replace(tzinfo=timezone.utc)
+	result = [sorted(group, key=lambda m: parse_msg_date(m.date) or max_date) for group in groups.values()]
+	return sorted(result, key=len, reverse=True)
+
+
+def date_gap(msg1: MsgInfo, msg2: MsgInfo) -> float:
+	date1 = parse_msg_date(msg1.date)
+	date2 = parse_msg_date(msg2.date)
+	if date1 is None or date2 is None:
+		return float('inf')
+	return abs((date2 - date1).total_seconds())
+
+
+def scheduled_pairs(msg_infos: list[MsgInfo], is_explained: Callable[[MsgInfo], bool], max_pairs: int) -> Iterator[tuple[MsgInfo, MsgInfo]]:
+	"""Yields up to max_pairs pairs to solve, neighbours in date with the smallest gap first.
+	is_explained is checked right before each pair is yielded, so pairs with a message that validates with a key
+	recovered from an earlier pair are skipped, and a selector with a single key stops after its first key."""
+	candidates: list[tuple[int, float, MsgInfo, MsgInfo]] = []
+	for group_index, group in enumerate(group_messages(msg_infos)):
+		for msg1, msg2 in zip(group, group[1:]):
+			candidates.append((group_index, date_gap(msg1, msg2), msg1, msg2))
+	candidates.sort(key=lambda c: (c[1], c[0]))
+	yielded = 0
+	for _group_index, _gap, msg1, msg2 in candidates:
+		if yielded >= max_pairs:
+			return
+		if is_explained(msg1) or is_explained(msg2):
+			continue
+		yielded += 1
+		yield msg1, msg2
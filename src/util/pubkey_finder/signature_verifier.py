@@ -0,0 +1,76 @@
+import base64
+import binascii
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Sequence
+from Crypto.PublicKey import RSA
+from pkcs1 import pkcs1_encode
+import gmpy2  # type: ignore
+
+# Checks of signatures against known keys, batched per key: each key is parsed once into (n, e),
+# the PKCS#1 v1.5 encoding of each header hash is computed once per modulus size,
+# and a check is a single powmod of the signature compared to the encoding.
+# The results of a batch are a bitmap, bit i is set when check i is valid.
+
+gmpy2_mpz: Any = gmpy2.mpz  # type: ignore
+gmpy2_powmod: Any = gmpy2.powmod  # type: ignore
+
+
+@dataclass(frozen=True)
+class SignatureCheck:
+	signature: bytes
+	hash_hex: str
+	# 'sha1', 'sha256' or 'sha512', see common.hashfn_from_signing_algorithm
+	hashfn: str
+
+
+@lru_cache(maxsize=4096)
+def parse_key(key_base64: str) -> tuple[int, int]:
+	rsa_key = RSA.import_key(base64.b64decode(key_base64))
+	return rsa_key.n, rsa_key.e
+
+
+@lru_cache(maxsize=65536)
+def encoded_digest(size_bytes: int, hash_hex: str, hashfn: str) -> Any:
+	return gmpy2_mpz(pkcs1_encode(size_bytes, bytes.fromhex(hash_hex), hashfn))
+
+
+def verify_with_key(n: int, e: int, checks: Sequence[SignatureCheck]) -> int:
+	"""Bitmap of the checks whose signature is valid for the key (n, e)"""
+	size_bytes = (n.bit_length() + 7) // 8
+	n = gmpy2_mpz(n)
+	bitmap = 0
+	for i, check in enumerate(checks):
+		if len(check.signature) > size_bytes:
+			continue
+		try:
+			message = encoded_digest(size_bytes, check.hash_hex, check.hashfn)
+		except ValueError:
+			# unknown hash function, malformed hash or a modulus too small for the padding
+			continue
+		if gmpy2_powmod(gmpy2_mpz(int.from_bytes(check.signature, 'big')), e, n) == message:
+			bitmap |= 1 << i
+	return bitmap
+
+
+def verify_batch(key_base64: str, checks: Sequence[SignatureCheck]) -> int:
+	"""Bitmap of the checks whose signature is valid for the base64 DER key, 0 if the key cannot be parsed"""
+	try:
+		n, e = parse_key(key_base64)
+	except (ValueError, IndexError, TypeError, binascii.Error):
+		return 0
+	return verify_with_key(n, e, checks)
+
+
+def verify_pairs(pairs: Sequence[tuple[str, SignatureCheck]]) -> int:
+	"""Bitmap of the (base64 DER key, check) pairs that are valid, verified in one batch per key"""
+	by_key: dict[str, list[int]] = {}
+	for i, (key_base64, _) in enumerate(pairs):
+		by_key.setdefault(key_base64, []).append(i)
+	bitmap = 0
+	for key_base64, positions in by_key.items():
+		key_bitmap = verify_batch(key_base64, [pairs[i][1] for i in positions])
+		for j, i in enumerate(positions):
+			if key_bitmap >> j & 1:
+				bitmap |= 1 << i
+	return bitmap
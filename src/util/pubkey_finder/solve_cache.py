@@ -0,0 +1,98 @@
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+
+# On-disk cache of find_n results per signature pair, so re-running find_public_keys.py over overlapping .datasig files
+# does not repeat the solves, including the ones that found nothing (like EmailPairGcdResult does for email_sigs_gcd.py).
+# The key is a digest of the pair, independent of the order of the two messages, and of the solver settings that can change its result
+# (the candidate exponents, the mode and the refine signatures), so a pair without a key, or with an n larger than the modulus,
+# is solved again when it is tried with more exponents or refine signatures.
+# Failed solves are stored with n = 0.
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS solve_result (
+	pair_digest TEXT PRIMARY KEY,
+	n_hex TEXT NOT NULL,
+	e INTEGER NOT NULL,
+	created_at REAL NOT NULL,
+	last_used_at REAL NOT NULL
+)
+'''
+
+
+# part of every digest, changed when the results of the solver change, which invalidates the cached results
+DIGEST_VERSION = 2
+
+
+def pair_digest(message_hashes_hex: list[str],
+                signatures: list[bytes],
+                hashfn: str,
+                exponents: list[int],
+                mode: str = 'reduced',
+                refine_hashes_hex: list[str] = [],
+                refine_signatures: list[bytes] = []) -> str:
+	# the order of the exponents only changes which one is tried first
+	h = hashlib.sha256(f'{DIGEST_VERSION}:{hashfn}:{mode}:{",".join(str(e) for e in sorted(set(exponents)))}'.encode())
+	for pairs in (zip(message_hashes_hex, signatures), zip(refine_hashes_hex, refine_signatures)):
+		h.update(b'|')
+		for hash_hex, signature in sorted((m.lower(), s) for m, s in pairs):
+			h.update(bytes.fromhex(hash_hex))
+			h.update(len(signature).to_bytes(4, 'big'))
+			h.update(signature)
+	return h.hexdigest()
+
+
+class SolveCache:
+
+	def __init__(self, path: str, max_age_days: float | None = None, max_entries: int | None = None):
+		self.path = path
+		self.max_age_days = max_age_days
+		self.max_entries = max_entries
+		self.lock = threading.Lock()
+		# shared by the solver threads, access is serialized by the lock
+		self.db = sqlite3.connect(path, check_same_thread=False)
+		self.db.execute(SCHEMA)
+		self.db.execute('CREATE INDEX IF NOT EXISTS solve_result_last_used_at ON solve_result (last_used_at)')
+		self.db.commit()
+		self.evict()
+
+	def get(self, digest: str) -> tuple[int, int] | None:
+		"""Returns the cached (n, e) for the pair, (0, 0) for a pair without a result, or None if the pair was not solved yet"""
+		with self.lock:
+			row = self.db.execute('SELECT n_hex, e, created_at FROM solve_result WHERE pair_digest = ?', (digest, )).fetchone()
+			if row is None:
+				return None
+			n_hex, e, created_at = row
+			if self.max_age_days is not None and created_at < time.time() - self.max_age_days * 86400:
+				return None
+			self.db.execute('UPDATE solve_result SET last_used_at = ? WHERE pair_digest = ?', (time.time(), digest))
+			self.db.commit()
+		return int(n_hex, 16), e
+
+	def put(self, digest: str, n: int, e: int):
+		now = time.time()
+		with self.lock:
+			self.db.execute('INSERT OR REPLACE INTO solve_result (pair_digest, n_hex, e, created_at, last_used_at) VALUES (?, ?, ?, ?, ?)',
+			                (digest, hex(n) if n > 1 else '0x0', e if n > 1 else 0, now, now))
+			self.db.commit()
+
+	def evict(self):
+		"""Deletes the entries older than max_age_days, then the least recently used ones above max_entries"""
+		with self.lock:
+			deleted = 0
+			if self.max_age_days is not None:
+				deleted += self.db.execute('DELETE FROM solve_result WHERE created_at < ?', (time.time() - self.max_age_days * 86400, )).rowcount
+			if self.max_entries is not None:
+				deleted += self.db.execute(
+				    'DELETE FROM solve_result WHERE pair_digest IN (SELECT pair_digest FROM solve_result ORDER BY last_used_at DESC LIMIT -1 OFFSET ?)',
+				    (self.max_entries, )).rowcount
+			self.db.commit()
+			count = self.db.execute('SELECT COUNT(*) FROM solve_result').fetchone()[0]
+		logging.info(f'solve cache {self.path}: {count} entries, evicted {deleted}')
+
+	def close(self):
+		self.evict()
+		with self.lock:
+			self.db.close()
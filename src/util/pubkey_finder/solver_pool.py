@@ -0,0 +1,243 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from multiprocessing.connection import Connection, wait
+from multiprocessing.process import BaseProcess
+from gcd_solver import DEFAULT_EXPONENTS, candidate_exponents, find_n
+from solve_cache import pair_digest
+
+# Runs gcd_solver.find_n in long-lived worker processes (no GIL contention, imports and prime tables stay warm).
+# Jobs are admitted while the sum of their estimated memory footprints fits in the memory budget,
+# and a worker whose job runs past the time limit is killed and replaced.
+
+# resident size of an idle worker, counted once per worker on top of the job estimates
+WORKER_BASE_BYTES = 64 * 1024 * 1024
+
+
+class SolveTimeout(Exception):
+	pass
+
+
+class SolverWorkerDied(Exception):
+	pass
+
+
+@dataclass
+class SolveJob:
+	message_hashes_hex: list[str]
+	signatures: list[bytes]
+	hashfn: str
+	mode: str = 'reduced'
+	refine_hashes_hex: list[str] = field(default_factory=list)
+	refine_signatures: list[bytes] = field(default_factory=list)
+	exponents: list[int] | None = None
+	known_keys: list[tuple[int, int]] | None = None
+	domain: str | None = None
+	selector: str | None = None
+
+	def cache_digest(self) -> str:
+		"""The key of the result in SolveCache"""
+		return pair_digest(self.message_hashes_hex, self.signatures, self.hashfn, self.exponents or DEFAULT_EXPONENTS, self.mode, self.refine_hashes_hex,
+		                   self.refine_signatures)
+
+	def solve(self) -> tuple[int, int]:
+		return find_n(self.message_hashes_hex, self.signatures, self.hashfn, self.mode, self.refine_hashes_hex, self.refine_signatures, self.exponents, self.known_keys,
+		              self.domain, self.selector)
+
+
+def estimate_job_memory(job: SolveJob) -> int:
+	"""Estimated peak memory of find_n for the job, in bytes. A term s**e - m has about size_bytes * e bytes.
+	In reduced mode at most two terms are alive, plus the top square of the exponent ladder and gmp's gcd scratch space of about one term.
+	In full mode all terms are alive at once."""
+	size_bytes = len(job.signatures[0])
+	exponents = candidate_exponents(size_bytes, job.hashfn, job.exponents or DEFAULT_EXPONENTS, job.known_keys or [])
+	if not exponents:
+		return 0
+	term_bytes = size_bytes * max(exponents)
+	terms = 4 if job.mode == 'reduced' else len(job.signatures) + 2
+	return terms * term_bytes
+
+
+def default_memory_budget() -> int:
+	# 75% of the physical memory
+	return int(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') * 0.75)
+
+
+def worker_main(conn: Connection):
+	while True:
+		try:
+			job: SolveJob | None = conn.recv()
+		except EOFError:
+			return
+		if job is None:
+			return
+		try:
+			conn.send(('ok', job.solve()))
+		except Exception as e:
+			conn.send(('error', f'{e.__class__.__name__}: {e}'))
+
+
+@dataclass
+class Worker:
+	process: BaseProcess
+	conn: Connection
+	future: 'Future[tuple[int, int]] | None' = None
+	memory: int = 0
+	started_at: float = 0.0
+	time_limit: float | None = None
+
+
+class SolverPool:
+
+	def __init__(self, workers: int | None = None, memory_budget: int | None = None, time_limit: float | None = None):
+		self.num_workers = workers or os.cpu_count() or 1
+		self.memory_budget = memory_budget or default_memory_budget()
+		self.time_limit = time_limit
+		# The workers are forked by a forkserver, a single-threaded process with this module (and so gcd_solver) preloaded, so new workers start warm,
+		# and without copying the locks held by the threads of this process (the dispatcher, the asyncio.to_thread callers, the HTTP server of solver_service.py),
+		# which a plain fork from replace_worker could deadlock on.
+		self.context = multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+		if self.context.get_start_method() == 'forkserver':
+			self.context.set_forkserver_preload([__name__])
+		self.pending: deque[tuple[SolveJob, Future[tuple[int, int]], int, float | None]] = deque()
+		self.lock = threading.Condition()
+		self.workers = [self.start_worker() for _ in range(self.num_workers)]
+		self.stopped = False
+		self.completed = 0
+		self.dispatcher = threading.Thread(target=self.dispatch, daemon=True)
+		self.dispatcher.start()
+		logging.info(f'started solver pool with {self.num_workers} workers and a memory budget of {self.memory_budget // (1024 * 1024)} MB')
+
+	def start_worker(self) -> Worker:
+		parent_conn, child_conn = self.context.Pipe()
+		process = self.context.Process(target=worker_main, args=(child_conn, ), daemon=True)
+		process.start()
+		child_conn.close()
+		return Worker(process, parent_conn)
+
+	def submit(self, job: SolveJob, time_limit: float | None = None) -> 'Future[tuple[int, int]]':
+		"""Queues a job and returns a future with the (n, e) result of find_n. time_limit overrides the pool's limit for this job."""
+		future: Future[tuple[int, int]] = Future()
+		memory = estimate_job_memory(job)
+		if memory > self.memory_budget - WORKER_BASE_BYTES * self.num_workers:
+			logging.warning(f'job for {job.domain}/{job.selector} needs about {memory // (1024 * 1024)} MB, more than the memory budget, it will run alone')
+		with self.lock:
+			if self.stopped:
+				raise RuntimeError('solver pool is shut down')
+			self.pending.append((job, future, memory, time_limit if time_limit is not None else self.time_limit))
+			self.lock.notify()
+		return future
+
+	def queue_depth(self) -> int:
+		with self.lock:
+			return len(self.pending)
+
+	def running(self) -> int:
+		with self.lock:
+			return sum(1 for w in self.workers if w.future is not None)
+
+	def used_memory(self) -> int:
+		return WORKER_BASE_BYTES * len(self.workers) + sum(w.memory for w in self.workers)
+
+	def admit(self):
+		# called with the lock held, start pending jobs on idle workers while they fit in the budget
+		while self.pending:
+			idle = [w for w in self.workers if w.future is None]
+			if not idle:
+				return
+			job, future, memory, time_limit = self.pending[0]
+			nothing_running = len(idle) == len(self.workers)
+			# a job larger than the whole budget still runs, but only when nothing else does
+			if not nothing_running and self.used_memory() + memory > self.memory_budget:
+				return
+			self.pending.popleft()
+			if not future.set_running_or_notify_cancel():
+				continue
+			worker = idle[0]
+			worker.future = future
+			worker.memory = memory
+			worker.started_at = time.monotonic()
+			worker.time_limit = time_limit
+			worker.conn.send(job)
+
+	def replace_worker(self, worker: Worker, error: Exception):
+		# called with the lock held
+		if worker.future is not None and not worker.future.done():
+			worker.future.set_exception(error)
+		worker.process.kill()
+		worker.process.join()
+		worker.conn.close()
+		self.workers[self.workers.index(worker)] = self.start_worker()
+
+	def dispatch(self):
+		while True:
+			with self.lock:
+				if self.stopped:
+					return
+				self.admit()
+				busy = [w for w in self.workers if w.future is not None]
+				if not busy and not self.pending:
+					self.lock.wait(0.5)
+					continue
+			ready = wait([w.conn for w in busy], timeout=0.1) if busy else []
+			with self.lock:
+				for worker in busy:
+					if worker.conn in ready:
+						try:
+							status, value = worker.conn.recv()
+						except (EOFError, OSError):
+							logging.error(f'solver worker {worker.process.pid} died, exit code {worker.process.exitcode}')
+							self.replace_worker(worker, SolverWorkerDied(f'solver worker died with exit code {worker.process.exitcode}'))
+							continue
+						future = worker.future
+						worker.future = None
+						worker.memory = 0
+						self.completed += 1
+						if future is not None and not future.done():
+							if status == 'ok':
+								future.set_result(value)
+							else:
+								future.set_exception(RuntimeError(value))
+					elif worker.time_limit is not None and time.monotonic() - worker.started_at > worker.time_limit:
+						logging.warning(f'solve exceeded the time limit of {worker.time_limit} s, killing worker {worker.process.pid}')
+						self.replace_worker(worker, SolveTimeout(f'solve exceeded the time limit of {worker.time_limit} s'))
+
+	def cancel_all(self):
+		"""Cancels the pending jobs and kills the running ones"""
+		with self.lock:
+			while self.pending:
+				_job, future, _memory, _time_limit = self.pending.popleft()
+				future.cancel()
+			for worker in [w for w in self.workers if w.future is not None]:
+				self.replace_worker(worker, SolveTimeout('solve was cancelled'))
+
+	def shutdown(self, cancel: bool = False):
+		if cancel:
+			self.cancel_all()
+		else:
+			# wait for the queued and running jobs
+			while self.queue_depth() or self.running():
+				time.sleep(0.1)
+		with self.lock:
+			self.stopped = True
+			self.lock.notify()
+		self.dispatcher.join()
+		for worker in self.workers:
+			try:
+				worker.conn.send(None)
+			except (BrokenPipeError, OSError):
+				pass
+			worker.process.join(timeout=1)
+			if worker.process.is_alive():
+				worker.process.kill()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc, tb):
+		self.shutdown(cancel=exc_type is not None)
@@ -0,0 +1,308 @@
+import argparse
+import base64
+import binascii
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import OrderedDict, deque
+from dataclasses import asdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+from solve_cache import SolveCache
+from signature_verifier import SignatureCheck, parse_key, verify_with_key
+from solver_pool import SolveJob, SolverPool, SolveTimeout, SolverWorkerDied
+
+# Resident solver on localhost HTTP, so that short interactive runs of the CLIs skip the startup cost of the solver
+# (imports, prime tables, worker processes) and share its caches of recent results and parsed keys.
+# find_public_keys.py, extract_and_solve.py and email_sigs_gcd.py send their pairs here when the service is running.
+#
+# POST /solve   {"jobs": [SolveJob as JSON, signatures in base64]} -> {"results": [{"n_hex": ..., "e": ...} or {"error": ..., "error_type": ...}]}
+# POST /verify  {"jobs": [{"key": base64 DER key, or "n_hex" and "e", "hash_hex": ..., "signature": base64, "hashfn": ...}]} -> {"results": [true, false, ...]}
+# GET  /stats   queue depth, running solves, throughput and cache hits
+
+SOLVER_SERVICE_URL_ENV_VAR = 'SOLVER_SERVICE_URL'
+DEFAULT_SOLVER_SERVICE_URL = 'http://127.0.0.1:8573'
+
+# The client gives up on a request after the time limit of the service's solves (its --pair-timeout) plus CLIENT_TIMEOUT_SLACK seconds
+# for the queueing and the round trip, or after DEFAULT_CLIENT_TIMEOUT seconds when the service has no time limit
+DEFAULT_CLIENT_TIMEOUT = 600.0
+CLIENT_TIMEOUT_SLACK = 30.0
+
+ERROR_TIMEOUT = 'timeout'
+ERROR_WORKER_DIED = 'worker_died'
+ERROR_OTHER = 'error'
+
+
+def job_to_json(job: SolveJob) -> dict[str, Any]:
+	data = asdict(job)
+	data['signatures'] = [base64.b64encode(s).decode() for s in job.signatures]
+	data['refine_signatures'] = [base64.b64encode(s).decode() for s in job.refine_signatures]
+	data['known_keys'] = [list(k) for k in job.known_keys] if job.known_keys is not None else None
+	return data
+
+
+def job_from_json(data: dict[str, Any]) -> SolveJob:
+	data = dict(data)
+	data['signatures'] = [base64.b64decode(s) for s in data['signatures']]
+	data['refine_signatures'] = [base64.b64decode(s) for s in data.get('refine_signatures', [])]
+	if data.get('known_keys') is not None:
+		data['known_keys'] = [tuple(k) for k in data['known_keys']]
+	return SolveJob(**data)
+
+
+class SolverService:
+
+	def __init__(self, pool: SolverPool, solve_cache: SolveCache | None = None, max_recent_results: int = 10000):
+		self.pool = pool
+		self.solve_cache = solve_cache
+		self.max_recent_results = max_recent_results
+		# (n, e) of recently solved pairs by pair_digest, in front of the optional SQLite cache
+		self.recent_results: OrderedDict[str, tuple[int, int]] = OrderedDict()
+		self.lock = threading.Lock()
+		self.started_at = time.monotonic()
+		self.completed_at: deque[float] = deque()
+		self.solved = 0
+		self.cache_hits = 0
+		self.verified = 0
+
+	def cached(self, digest: str) -> tuple[int, int] | None:
+		with self.lock:
+			result = self.recent_results.get(digest)
+			if result is not None:
+				self.recent_results.move_to_end(digest)
+				self.cache_hits += 1
+				return result
+		result = self.solve_cache.get(digest) if self.solve_cache else None
+		if result is not None:
+			with self.lock:
+				self.cache_hits += 1
+		return result
+
+	def store(self, digest: str, result: tuple[int, int]):
+		with self.lock:
+			self.recent_results[digest] = result
+			self.recent_results.move_to_end(digest)
+			while len(self.recent_results) > self.max_recent_results:
+				self.recent_results.popitem(last=False)
+			self.solved += 1
+			self.completed_at.append(time.monotonic())
+		if self.solve_cache:
+			self.solve_cache.put(digest, *result)
+
+	def solve(self, jobs: list[SolveJob]) -> list[dict[str, Any]]:
+		"""Solves the jobs in the pool at the same time, returns their results in order"""
+		results: list[dict[str, Any] | None] = [None] * len(jobs)
+		submitted = []
+		for i, job in enumerate(jobs):
+			digest = job.cache_digest()
+			cached = self.cached(digest)
+			if cached is not None:
+				results[i] = {'n_hex': hex(cached[0]), 'e': cached[1]}
+			else:
+				submitted.append((i, digest, self.pool.submit(job)))
+		for i, digest, future in submitted:
+			try:
+				n, e = future.result()
+			except SolveTimeout as ex:
+				# not cached, the pair can be tried again
+				results[i] = {'error': str(ex), 'error_type': ERROR_TIMEOUT}
+				continue
+			except SolverWorkerDied as ex:
+				results[i] = {'error': str(ex), 'error_type': ERROR_WORKER_DIED}
+				continue
+			except Exception as ex:
+				results[i] = {'error': str(ex), 'error_type': ERROR_OTHER}
+				continue
+			self.store(digest, (n, e))
+			results[i] = {'n_hex': hex(n), 'e': e}
+		return results  # type: ignore
+
+	def verify(self, jobs: list[dict[str, Any]]) -> list[bool]:
+		results = [False] * len(jobs)
+		# the checks of each key are verified in one batch
+		checks_by_key: dict[tuple[int, int], list[tuple[int, SignatureCheck]]] = {}
+		for i, job in enumerate(jobs):
+			try:
+				key = (int(job['n_hex'], 16), int(job['e'])) if 'n_hex' in job else parse_key(job['key'])
+				check = SignatureCheck(base64.b64decode(job['signature']), job['hash_hex'], job['hashfn'])
+			except (KeyError, ValueError, TypeError, binascii.Error, IndexError) as ex:
+				logging.debug(f'cannot verify {job}: {ex}')
+				continue
+			checks_by_key.setdefault(key, []).append((i, check))
+		for (n, e), checks in checks_by_key.items():
+			bitmap = verify_with_key(n, e, [check for _, check in checks])
+			for j, (i, _) in enumerate(checks):
+				results[i] = bool(bitmap >> j & 1)
+		with self.lock:
+			self.verified += len(jobs)
+		return results
+
+	def stats(self) -> dict[str, Any]:
+		now = time.monotonic()
+		with self.lock:
+			while self.completed_at and self.completed_at[0] < now - 60:
+				self.completed_at.popleft()
+			return {
+			    'uptime_seconds': round(now - self.started_at, 1),
+			    'workers': self.pool.num_workers,
+			    'pair_timeout': self.pool.time_limit,
+			    'queue_depth': self.pool.queue_depth(),
+			    'running': self.pool.running(),
+			    'solved': self.solved,
+			    'solved_last_minute': len(self.completed_at),
+			    'solved_per_second': round(self.solved / (now - self.started_at), 4),
+			    'cache_hits': self.cache_hits,
+			    'recent_results': len(self.recent_results),
+			    'verified': self.verified,
+			    'parsed_keys': parse_key.cache_info().currsize,
+			}
+
+
+def make_handler(service: SolverService):
+
+	class Handler(BaseHTTPRequestHandler):
+		protocol_version = 'HTTP/1.1'
+
+		def send_json(self, status: int, data: Any):
+			body = json.dumps(data).encode()
+			self.send_response(status)
+			self.send_header('Content-Type', 'application/json')
+			self.send_header('Content-Length', str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+
+		def do_GET(self):
+			if self.path == '/stats':
+				self.send_json(200, service.stats())
+			else:
+				self.send_json(404, {'error': 'not found'})
+
+		def do_POST(self):
+			try:
+				jobs = json.loads(self.rfile.read(int(self.headers['Content-Length'])))['jobs']
+				if self.path == '/solve':
+					self.send_json(200, {'results': service.solve([job_from_json(job) for job in jobs])})
+				elif self.path == '/verify':
+					self.send_json(200, {'results': service.verify(jobs)})
+				else:
+					self.send_json(404, {'error': 'not found'})
+			except (KeyError, ValueError, TypeError, binascii.Error) as ex:
+				self.send_json(400, {'error': f'invalid request: {ex}'})
+
+		def log_message(self, format: str, *args: Any):
+			logging.debug(format % args)
+
+	return Handler
+
+
+class SolverServiceClient:
+
+	def __init__(self, url: str, timeout: float = DEFAULT_CLIENT_TIMEOUT):
+		self.url = url.rstrip('/')
+		self.timeout = timeout
+
+	def request(self, path: str, data: Any = None, timeout: float | None = None) -> Any:
+		body = json.dumps(data).encode() if data is not None else None
+		request = urllib.request.Request(self.url + path, data=body, headers={'Content-Type': 'application/json'})
+		with urllib.request.urlopen(request, timeout=timeout or self.timeout) as response:
+			return json.loads(response.read())
+
+	def stats(self, timeout: float | None = None) -> dict[str, Any]:
+		return self.request('/stats', timeout=timeout)
+
+	def solve_many(self, jobs: list[SolveJob]) -> list[tuple[int, int] | Exception]:
+		"""Raises SolveTimeout when the service does not answer within the timeout, e.g. when it is stuck or was stopped"""
+		try:
+			response = self.request('/solve', {'jobs': [job_to_json(job) for job in jobs]})
+		except socket.timeout as ex:
+			raise SolveTimeout(f'no answer from the solver service within {self.timeout} s') from ex
+		except urllib.error.URLError as ex:
+			if not isinstance(ex.reason, socket.timeout):
+				raise
+			raise SolveTimeout(f'no answer from the solver service within {self.timeout} s') from ex
+		results: list[tuple[int, int] | Exception] = []
+		for result in response['results']:
+			if 'error' not in result:
+				results.append((int(result['n_hex'], 16), int(result['e'])))
+			elif result['error_type'] == ERROR_TIMEOUT:
+				results.append(SolveTimeout(result['error']))
+			elif result['error_type'] == ERROR_WORKER_DIED:
+				results.append(SolverWorkerDied(result['error']))
+			else:
+				results.append(RuntimeError(result['error']))
+		return results
+
+	def solve(self, job: SolveJob) -> tuple[int, int]:
+		"""(n, e) like SolveJob.solve, raises SolveTimeout or SolverWorkerDied like SolverPool"""
+		result = self.solve_many([job])[0]
+		if isinstance(result, Exception):
+			raise result
+		return result
+
+	def verify(self, jobs: list[dict[str, Any]]) -> list[bool]:
+		return self.request('/verify', {'jobs': jobs})['results']
+
+
+def connect_solver_service(url: str | None = None) -> SolverServiceClient | None:
+	"""A client for the solver service at url (default: $SOLVER_SERVICE_URL or DEFAULT_SOLVER_SERVICE_URL) if it is running, otherwise None"""
+	client = SolverServiceClient(url or os.environ.get(SOLVER_SERVICE_URL_ENV_VAR, DEFAULT_SOLVER_SERVICE_URL))
+	try:
+		stats = client.stats(timeout=0.5)
+	except (urllib.error.URLError, OSError, ValueError):
+		return None
+	if stats.get('pair_timeout'):
+		client.timeout = stats['pair_timeout'] + CLIENT_TIMEOUT_SLACK
+	logging.info(f'using the solver service at {client.url} with {stats["workers"]} workers')
+	return client
+
+
+class ProgramArgs(argparse.Namespace):
+	host: str
+	port: int
+	workers: int | None
+	memory_budget_mb: int | None
+	pair_timeout: float | None
+	cache_file: str | None
+	max_recent_results: int
+	loglevel: int
+
+
+def main():
+	parser = argparse.ArgumentParser(description='resident solver for find_public_keys.py, extract_and_solve.py and email_sigs_gcd.py, on localhost HTTP',
+	                                 allow_abbrev=False)
+	parser.add_argument('--host', type=str, default='127.0.0.1', help='address to listen on (default: 127.0.0.1)')
+	parser.add_argument('--port', type=int, default=8573, help='port to listen on (default: 8573)')
+	parser.add_argument('--workers', type=int, help='number of solver worker processes (default: number of CPUs)')
+	parser.add_argument('--memory-budget-mb', type=int, help='limit the estimated memory of the running solves (default: 75%% of the RAM)')
+	parser.add_argument('--pair-timeout', type=float, help='give up on a pair after this many seconds')
+	parser.add_argument('--cache-file', type=str, help='SQLite file with the solver results, see find_public_keys.py')
+	parser.add_argument('--max-recent-results', type=int, default=10000, help='number of recent results kept in memory (default: 10000)')
+	parser.add_argument('--debug', action="store_const", dest="loglevel", const=logging.DEBUG, default=logging.INFO, help='enable debug logging')
+	args = parser.parse_args(namespace=ProgramArgs)
+
+	logging.root.name = os.path.basename(__file__)
+	logging.basicConfig(level=args.loglevel, format='%(name)s: %(levelname)s: %(message)s')
+
+	pool = SolverPool(args.workers, args.memory_budget_mb * 1024 * 1024 if args.memory_budget_mb else None, args.pair_timeout)
+	solve_cache = SolveCache(args.cache_file) if args.cache_file else None
+	service = SolverService(pool, solve_cache, args.max_recent_results)
+	server = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+	logging.info(f'solver service listening on http://{args.host}:{args.port}')
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		logging.info('shutting down')
+	finally:
+		server.server_close()
+		pool.shutdown(cancel=True)
+		if solve_cache:
+			solve_cache.close()
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,119 @@
+import argparse
+import json
+import os
+import resource
+import sys
+import threading
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from typing import Any, TextIO
+
+# Structured per-solve records from gcd_solver.find_n, used to size worker machines and batch budgets.
+# Records are appended as JSON lines to the file in GCD_SOLVER_TELEMETRY (or the one passed to configure_telemetry),
+# and `python3 telemetry.py summarize FILE` reports percentiles.
+
+TELEMETRY_ENV_VAR = 'GCD_SOLVER_TELEMETRY'
+
+# outcomes of one exponent attempt in find_n
+OUTCOME_FOUND = 'found'
+OUTCOME_NO_GCD = 'no_gcd'
+OUTCOME_OVERSIZED = 'oversized'
+
+
+@dataclass
+class SolveRecord:
+	domain: str | None
+	selector: str | None
+	signature_bytes: int
+	signatures: int
+	hashfn: str
+	mode: str
+	exponent: int
+	# cpu seconds per stage
+	exponentiation_cpu: float
+	gcd_cpu: float
+	smooth_part_cpu: float
+	refine_cpu: float
+	max_term_bits: int
+	result_bits: int
+	outcome: str
+	# peak resident set size of the solving process so far, in kilobytes
+	peak_rss_kb: int = 0
+	timestamp: str = ''
+
+
+class TelemetrySink:
+
+	def __init__(self, path: str):
+		self.path = path
+		self.lock = threading.Lock()
+
+	def write(self, record: SolveRecord):
+		record.peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		record.timestamp = datetime.now(timezone.utc).isoformat()
+		line = json.dumps(asdict(record)) + '\n'
+		# one write per line in append mode, so lines from concurrent solver processes don't interleave
+		with self.lock, open(self.path, 'a') as f:
+			f.write(line)
+
+
+sink: TelemetrySink | None = TelemetrySink(os.environ[TELEMETRY_ENV_VAR]) if os.environ.get(TELEMETRY_ENV_VAR) else None
+
+
+def configure_telemetry(path: str | None):
+	"""Sets the JSONL file for solve records (None disables them). Also exported to the environment, so solver subprocesses write to the same file"""
+	global sink
+	sink = TelemetrySink(path) if path else None
+	if path:
+		os.environ[TELEMETRY_ENV_VAR] = path
+	else:
+		os.environ.pop(TELEMETRY_ENV_VAR, None)
+
+
+def record_solve(record: SolveRecord):
+	if sink is not None:
+		sink.write(record)
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+	if not sorted_values:
+		return 0.0
+	index = min(len(sorted_values) - 1, max(0, round(p / 100 * (len(sorted_values) - 1))))
+	return sorted_values[index]
+
+
+SUMMARY_FIELDS = ['exponentiation_cpu', 'gcd_cpu', 'smooth_part_cpu', 'refine_cpu', 'peak_rss_kb']
+
+
+def summarize(records: list[dict[str, Any]], group_by: list[str], out: TextIO):
+	groups: dict[tuple[Any, ...], list[dict[str, Any]]] = {}
+	for record in records:
+		groups.setdefault(tuple(record.get(g) for g in group_by), []).append(record)
+	for group, group_records in sorted(groups.items(), key=lambda item: str(item[0])):
+		outcomes: dict[str, int] = {}
+		for record in group_records:
+			outcomes[record['outcome']] = outcomes.get(record['outcome'], 0) + 1
+		out.write(f'{", ".join(f"{g}={v}" for g, v in zip(group_by, group))}: {len(group_records)} records, outcomes {outcomes}\n')
+		for field in SUMMARY_FIELDS:
+			values = sorted(float(r.get(field, 0)) for r in group_records)
+			p50, p90, p99 = (percentile(values, p) for p in (50, 90, 99))
+			out.write(f'\t{field}: p50={p50:.3f} p90={p90:.3f} p99={p99:.3f} max={values[-1]:.3f}\n')
+
+
+def main():
+	parser = argparse.ArgumentParser(description='summarize the solve records written by gcd_solver.py', allow_abbrev=False)
+	subparsers = parser.add_subparsers(dest='command', required=True)
+	summarize_parser = subparsers.add_parser('summarize', help='print percentiles of the per-stage cpu time and peak memory')
+	summarize_parser.add_argument('files', nargs='+', help='JSONL files with solve records')
+	summarize_parser.add_argument('--group-by', type=lambda s: s.split(','), default=['signature_bytes', 'exponent', 'hashfn'], help='comma separated record fields to group by')
+	args = parser.parse_args()
+
+	records: list[dict[str, Any]] = []
+	for path in args.files:
+		with open(path) as f:
+			records.extend(json.loads(line) for line in f if line.strip())
+	summarize(records, args.group_by, sys.stdout)
+
+
+if __name__ == '__main__':
+	main()